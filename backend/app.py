@@ -6,9 +6,13 @@ NextTranslate - Flask Backend
 
 import os
 import sys
+import re
 import json
 import uuid
 import base64
+import sqlite3
+import threading
+from contextlib import contextmanager
 from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, send_from_directory
 
 # 路径配置
@@ -44,6 +48,16 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
 os.makedirs(CONFIG_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# 上传大小限制，写盘过程中超限即中止
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', 20))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_REQUEST_MAX_BYTES = MAX_UPLOAD_BYTES + 64 * 1024  # multipart 表单有少量边界/字段开销
+
+# 所有请求体的上限，读取时超限即中止（413），分块传输、没有 Content-Length 的请求同样受限；
+# 上传接口在 check_upload_length 中收紧到 UPLOAD_REQUEST_MAX_BYTES
+MAX_REQUEST_MB = int(os.environ.get('MAX_REQUEST_MB', max(200, MAX_UPLOAD_MB)))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_MB * 1024 * 1024
+
 
 # ============ 配置管理 ============
 
@@ -64,6 +78,10 @@ def read_config():
         'DOUBAO_API_KEY': 'doubao_api_key',
         'DOUBAO_ENDPOINT_ID': 'doubao_endpoint_id',
         'DEEPSEEK_API_KEY': 'deepseek_api_key',
+        'OCR_BACKEND': 'ocr_backend',
+        'TESSERACT_PATH': 'tesseract_path',
+        'VISION_MAX_EDGE': 'vision_max_edge',
+        'VISION_GRAYSCALE': 'vision_grayscale',
     }
     for env_key, config_key in env_mappings.items():
         env_value = os.environ.get(env_key)
@@ -134,6 +152,11 @@ def get_settings():
     proxy_config = config.get('deepseek_proxy', {'enabled': False, 'http': '', 'https': ''})
     result['deepseek_proxy'] = proxy_config
 
+    # OCR 引擎配置
+    result['ocr_backend'] = config.get('ocr_backend', 'auto')
+    result['tesseract_path'] = config.get('tesseract_path', '')
+    result['tesseract_found'] = bool(find_tesseract(config))
+
     return jsonify({'success': True, **result})
 
 @app.route('/api/settings', methods=['POST'])
@@ -151,6 +174,11 @@ def save_settings():
     if 'deepseek_proxy' in data:
         config['deepseek_proxy'] = data['deepseek_proxy']
 
+    # 更新 OCR 引擎配置
+    for key in ['ocr_backend', 'tesseract_path', 'ocr_languages']:
+        if key in data:
+            config[key] = data[key]
+
     write_config(config)
     return jsonify({'success': True})
 
@@ -197,12 +225,9 @@ def test_api():
 
         # DeepSeek 使用代理
         if provider == 'deepseek':
-            opener = get_deepseek_opener()
-            with opener.open(req, timeout=15) as response:
-                result = json.loads(response.read().decode('utf-8'))
+            result = upstream_json(req, timeout=15, opener=get_deepseek_opener())
         else:
-            with urllib.request.urlopen(req, timeout=15) as response:
-                result = json.loads(response.read().decode('utf-8'))
+            result = upstream_json(req, timeout=15)
 
         if result.get('choices'):
             return jsonify({'success': True})
@@ -229,6 +254,10 @@ def test_api():
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """上传 PDF 文件并转换为图片"""
+    too_large = check_upload_length()
+    if too_large:
+        return jsonify({'success': False, 'error': too_large})
+
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': '没有上传文件'})
 
@@ -240,18 +269,16 @@ def upload_file():
     if not filename.endswith('.pdf'):
         return jsonify({'success': False, 'error': '请上传 PDF 文件（PPT 请先导出为 PDF）'})
 
-    file_id = uuid.uuid4().hex[:8]
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    os.makedirs(upload_dir, exist_ok=True)
-
     try:
-        file_path = os.path.join(upload_dir, 'source.pdf')
-        file.save(file_path)
-        pages = convert_pdf_to_images(file_path)
+        file_id, upload_dir, content_hash, content = ingest_upload(file, 'pdf')
+        pages = content['pages']
 
         if not pages:
+            delete_document(file_id, content_hash)
             return jsonify({'success': False, 'error': '无法解析 PDF 文件'})
 
+        create_document(file_id, 'pdf', file.filename, content_hash, content)
+
         return jsonify({
             'success': True,
             'file_id': file_id,
@@ -262,28 +289,123 @@ def upload_file():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-def convert_pdf_to_images(pdf_path):
-    """将 PDF 转换为图片（base64 格式）"""
+# ============ 页面渲染分辨率 ============
+#
+# PDF 页面按用途的目标像素（页面长边）渲染，而不是固定缩放倍数：display 为页面预览（也是
+# 合成预览图和截图翻译的底图），vision 为视觉模型输入（与 vision_max_edge 一致，不再先放大再
+# 缩小），export 为左右对照导出中的原文页（按页面在导出纸张上的尺寸取 RENDER_EXPORT_DPI）。
+# 缩放倍数限制在 [RENDER_MIN_ZOOM, RENDER_MAX_ZOOM]，
+# 单页像素不超过 RENDER_PAGE_MAX_PIXELS，一次请求内所有页面合计超过 RENDER_REQUEST_MAX_PIXELS
+# 时所有页面等比缩小 —— 海报尺寸的页面不会生成巨大的位图，小尺寸页面也不再模糊。
+
+RENDER_DISPLAY_EDGE = int(os.environ.get('RENDER_DISPLAY_EDGE', 1280))
+RENDER_EXPORT_DPI = int(os.environ.get('RENDER_EXPORT_DPI', 200))
+RENDER_MIN_ZOOM = 0.05
+RENDER_MAX_ZOOM = 4.0
+RENDER_PAGE_MAX_PIXELS = int(os.environ.get('RENDER_PAGE_MAX_PIXELS', 8 * 1000 * 1000))
+RENDER_REQUEST_MAX_PIXELS = int(os.environ.get('RENDER_REQUEST_MAX_PIXELS', 400 * 1000 * 1000))
+
+
+def render_zoom(rect, use, box=None):
+    """页面（rect 单位为点）按用途渲染的缩放倍数；export 需传入页面在导出纸张上的区域 box (宽, 高)"""
+    width, height = max(rect.width, 1), max(rect.height, 1)
+    if use == 'export':
+        zoom = min(box[0] / width, box[1] / height) * RENDER_EXPORT_DPI / 72
+    elif use == 'vision':
+        zoom = int(read_config().get('vision_max_edge') or VISION_DEFAULT_MAX_EDGE) / max(width, height)
+    else:
+        zoom = RENDER_DISPLAY_EDGE / max(width, height)
+    zoom = min(max(zoom, RENDER_MIN_ZOOM), RENDER_MAX_ZOOM)
+    if width * height * zoom * zoom > RENDER_PAGE_MAX_PIXELS:
+        zoom = (RENDER_PAGE_MAX_PIXELS / (width * height)) ** 0.5
+    return zoom
+
+
+def render_zooms(rects, use, box=None):
+    """一次请求中各页的缩放倍数；合计像素超出 RENDER_REQUEST_MAX_PIXELS 时等比缩小"""
+    zooms = [render_zoom(rect, use, box) for rect in rects]
+    total = sum(rect.width * rect.height * zoom * zoom for rect, zoom in zip(rects, zooms))
+    if total > RENDER_REQUEST_MAX_PIXELS:
+        factor = (RENDER_REQUEST_MAX_PIXELS / total) ** 0.5
+        print(f"Render budget: {total / 1e6:.0f}MP over {len(rects)} pages, scaling {use} renders by {factor:.2f}")
+        zooms = [zoom * factor for zoom in zooms]
+    return zooms
+
+
+def render_page_png(page, zoom):
+    import fitz
+
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False).tobytes("png")
+
+
+def render_page_data_url(page, zoom):
+    """渲染单页为 PNG data URL"""
+    b64_data = base64.b64encode(render_page_png(page, zoom)).decode('utf-8')
+    return f"data:image/png;base64,{b64_data}"
+
+
+def render_source_page(upload_dir, page_idx, use):
+    """按用途重新渲染 source.pdf 的一页为 data URL；没有源文件或渲染失败时返回 None"""
+    import fitz
+
+    source_path = os.path.join(upload_dir, 'source.pdf')
+    if not os.path.exists(source_path):
+        return None
+    try:
+        with fitz.open(source_path) as doc:
+            page = doc.load_page(page_idx)
+            return render_page_data_url(page, render_zoom(page.rect, use))
+    except Exception as e:
+        print(f"Page render failed ({use}): {e}")
+        return None
+
+
+def page_fingerprint(doc, page):
+    """页面渲染指纹：页面尺寸、内容流及其引用的图片/字体/表单对象
+
+    用于判断上传未完成时渲染的页面在完整文件中是否仍然相同。
+    """
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(repr(tuple(page.rect)).encode('utf-8'))
+    h.update(page.read_contents())
+    xrefs = [item[0] for item in page.get_images(full=True)]
+    xrefs += [item[0] for item in page.get_fonts(full=True)]
+    xrefs += [item[0] for item in page.get_xobjects()]
+    for xref in sorted(set(xrefs)):
+        if xref > 0:
+            h.update(doc.xref_object(xref, compressed=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def convert_pdf_to_images(pdf_path, prerendered=None):
+    """将 PDF 转换为图片（base64 格式）
+
+    prerendered: {page_num: (fingerprint, data_url)}，指纹与完整文件一致的页面直接复用
+    """
     pages = []
 
     try:
         import fitz  # PyMuPDF
         doc = fitz.open(pdf_path)
-
-        # 云环境下降低分辨率加快处理
-        is_cloud = os.environ.get('RENDER') or os.environ.get('PORT')
-        zoom = 1.2 if is_cloud else 1.5
+        zooms = render_zooms([page.rect for page in doc], 'display')
+        reused = 0
 
         for page_num in range(len(doc)):
             page = doc.load_page(page_num)
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-
-            img_data = pix.tobytes("png")
-            b64_data = base64.b64encode(img_data).decode('utf-8')
-            pages.append(f"data:image/png;base64,{b64_data}")
+            early = (prerendered or {}).get(page_num)
+            # 提前渲染时不知道总页数，整份文档超出请求预算而缩小时不能复用
+            if (early and early[0] == page_fingerprint(doc, page)
+                    and abs(zooms[page_num] - render_zoom(page.rect, 'display')) < 1e-6):
+                pages.append(early[1])
+                reused += 1
+                continue
+            pages.append(render_page_data_url(page, zooms[page_num]))
 
         doc.close()
+        if reused:
+            print(f"PDF render reused {reused}/{len(pages)} pages rendered during upload")
         return pages
 
     except ImportError:
@@ -293,304 +415,3800 @@ def convert_pdf_to_images(pdf_path):
         return []
 
 
-# ============ OCR 识别 ============
-
-def ocr_with_ocrspace(image_base64):
-    """使用免费的 OCR.space API 识别图片文字"""
-    import urllib.request
-    import urllib.parse
-
-    api_url = 'https://api.ocr.space/parse/image'
+# ============ 状态序列化 ============
+#
+# 持久化的文档状态（页面图片、翻译结果、数据库中的块数据）统一经 encode_state /
+# decode_state 编解码：'NTS' + 格式版本 + 编码标识 + 数据。编码按可用性选择
+# msgpack > orjson > 紧凑 JSON（可用 STATE_CODEC 指定），读取时按文件头自动识别；
+# 没有文件头的旧版 JSON 照常读取，文件在首次读取时转换为新格式。
+# 词汇表会在用户的编辑器中直接打开，保持带缩进的 JSON，不经过这里。
 
-    if ',' in image_base64:
-        image_base64 = image_base64.split(',')[1]
+STATE_MAGIC = b'NTS'
+STATE_FORMAT_VERSION = 1
 
-    payload = {
-        'apikey': 'helloworld',
-        'base64Image': f'data:image/png;base64,{image_base64}',
-        'language': 'chs',
-        'isOverlayRequired': 'false',
-        'detectOrientation': 'true',
-        'scale': 'true',
-        'OCREngine': '2'
-    }
 
-    data = urllib.parse.urlencode(payload).encode('utf-8')
-    req = urllib.request.Request(api_url, data=data)
-    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+def json_encode_state(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
-    with urllib.request.urlopen(req, timeout=30) as response:
-        result = json.loads(response.read().decode('utf-8'))
 
-        if result.get('IsErroredOnProcessing'):
-            error_msg = result.get('ErrorMessage', ['OCR 识别失败'])[0]
-            return None, error_msg
+def load_state_codecs():
+    """可用的编码 {name: (tag, encode, decode)}"""
+    codecs = {'json': (b'j', json_encode_state, json.loads)}
+    try:
+        import orjson
+        codecs['orjson'] = (b'o', orjson.dumps, orjson.loads)
+    except ImportError:
+        pass
+    try:
+        import msgpack
+        codecs['msgpack'] = (
+            b'm',
+            lambda value: msgpack.packb(value, use_bin_type=True),
+            lambda raw: msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        )
+    except ImportError:
+        pass
+    return codecs
 
-        parsed_results = result.get('ParsedResults', [])
-        if not parsed_results:
-            return None, '未识别到文字'
 
-        text = parsed_results[0].get('ParsedText', '').strip()
-        if not text:
-            return None, '未识别到文字'
+STATE_CODECS = load_state_codecs()
+STATE_CODEC = os.environ.get('STATE_CODEC') or next(
+    name for name in ('msgpack', 'orjson', 'json') if name in STATE_CODECS
+)
+if STATE_CODEC not in STATE_CODECS:
+    print(f"State codec {STATE_CODEC} unavailable, using json")
+    STATE_CODEC = 'json'
 
-        return text, None
 
-@app.route('/api/ocr', methods=['POST'])
-def ocr():
-    """OCR 识别截图"""
-    data = request.get_json()
-    image_data = data.get('image', '')
-    model = data.get('model', 'free')
+def encode_state(value):
+    """编码为带版本头的字节串"""
+    tag, encode, _ = STATE_CODECS[STATE_CODEC]
+    return STATE_MAGIC + bytes([STATE_FORMAT_VERSION]) + tag + encode(value)
 
-    if not image_data:
-        return jsonify({'success': False, 'error': '没有图片数据'})
 
-    try:
-        if model == 'doubao':
-            config = read_config()
-            api_key = config.get('doubao_api_key')
-            endpoint_id = config.get('doubao_endpoint_id')
+def decode_state(raw):
+    """解码 encode_state 的结果；兼容旧版 JSON 文本"""
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if not raw.startswith(STATE_MAGIC):
+        return json.loads(raw.decode('utf-8'))
 
-            if not api_key or not endpoint_id:
-                return jsonify({'success': False, 'error': '未配置豆包 API'})
+    version = raw[len(STATE_MAGIC)]
+    if version > STATE_FORMAT_VERSION:
+        raise ValueError(f'状态数据格式版本 {version} 高于当前程序支持的版本')
+    tag = raw[len(STATE_MAGIC) + 1:len(STATE_MAGIC) + 2]
+    for codec_tag, _, decode in STATE_CODECS.values():
+        if codec_tag == tag:
+            return decode(raw[len(STATE_MAGIC) + 2:])
+    raise ValueError(f'状态数据使用了未安装的编码 ({tag.decode("ascii", "replace")})')
 
-            ocr_text, ocr_error = ocr_with_doubao_vision(image_data, api_key, endpoint_id)
-        else:
-            ocr_text, ocr_error = ocr_with_ocrspace(image_data)
 
-        if ocr_error:
-            return jsonify({'success': False, 'error': ocr_error})
+def save_state_file(path, value):
+    """原子写入状态文件"""
+    tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_state(value))
+    os.replace(tmp_path, path)
 
-        return jsonify({'success': True, 'text': ocr_text})
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+def load_state_file(path, default=None):
+    """读取状态文件；只有旧版同名 .json 时读取并转换为新格式"""
+    try:
+        with open(path, 'rb') as f:
+            return decode_state(f.read())
+    except FileNotFoundError:
+        pass
+
+    legacy_path = os.path.splitext(path)[0] + '.json'
+    if legacy_path == path or not os.path.exists(legacy_path):
+        return default
+    with open(legacy_path, 'r', encoding='utf-8') as f:
+        value = json.load(f)
+    try:
+        save_state_file(path, value)
+        os.remove(legacy_path)
+    except OSError as e:
+        print(f"State file migration failed for {legacy_path}: {e}")
+    return value
+
+
+# ============ 内容寻址存储 ============
+#
+# 上传文件按 SHA-256 去重：data/content/<hash>/ 保存源文件、页面图片 (pages.state)、
+# 布局索引和机器翻译缓存；每次上传的 file_id 目录只保存会话文件，会话状态在
+# 文档状态存储中，源文件与索引以硬链接共享。refs/<file_id> 为引用计数，引用归零时删除内容目录。
+# 同一哈希的“检查是否已有 → 处理 → 登记引用”与释放引用由 content_lock 串行执行（按哈希前两位
+# 分为 256 把锁，进程内用线程锁，多个 gunicorn 进程之间用 .locks/ 下的文件锁），不会在复用途中
+# 被删除，两个同时上传的相同文件也只处理一次。
+
+CONTENT_DIR = os.path.join(DATA_DIR, 'data', 'content')
+os.makedirs(CONTENT_DIR, exist_ok=True)
+
+_pages_cache = {}  # content_hash -> pages
+_PAGES_CACHE_SIZE = 4
+_content_locks = {}  # 哈希前缀 -> threading.Lock
+_content_locks_guard = threading.Lock()
+
+
+@contextmanager
+def content_lock(content_hash):
+    """持有 content_hash 对应的内容锁"""
+    stripe = content_hash[:2]
+    with _content_locks_guard:
+        lock = _content_locks.setdefault(stripe, threading.Lock())
+
+    with lock:
+        if sys.platform == 'win32':
+            yield  # 桌面版为单进程，线程锁即可
+            return
+
+        import fcntl
+
+        lock_dir = os.path.join(CONTENT_DIR, '.locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, stripe), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
-# ============ 翻译功能 ============
+def save_upload_stream(stream, dest_path, max_bytes=None):
+    """流式写入上传文件并计算 SHA-256，返回 (hash, size)
 
-def translate_with_deepseek(text, target_lang, api_key):
-    """使用 DeepSeek 翻译文字（支持代理）"""
-    import urllib.request
+    超过 max_bytes 时立即中止并抛出 ValueError，不会把整个文件读完。
+    """
+    import hashlib
 
-    lang_names = {'zh': '中文', 'en': 'English'}
-    target_lang_name = lang_names.get(target_lang, '中文')
+    h = hashlib.sha256()
+    size = 0
+    with open(dest_path, 'wb') as out:
+        while True:
+            chunk = stream.read(1024 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise ValueError(upload_too_large_message())
+            h.update(chunk)
+            out.write(chunk)
+    return h.hexdigest(), size
 
-    prompt = f"""请将以下文字翻译成{target_lang_name}，只返回翻译结果，不要包含任何解释：
 
-{text}"""
+def upload_too_large_message():
+    return f'文件过大，请上传小于 {MAX_UPLOAD_MB}MB 的文件'
 
-    request_data = json.dumps({
-        "model": "deepseek-chat",
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 2000
-    }).encode('utf-8')
 
-    req = urllib.request.Request(
-        'https://api.deepseek.com/v1/chat/completions',
-        data=request_data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
-        }
-    )
+def check_upload_length():
+    """在读取请求体之前拒绝超限上传，返回错误信息或 None
 
-    opener = get_deepseek_opener()
-    with opener.open(req, timeout=30) as response:
-        result = json.loads(response.read().decode('utf-8'))
-        return result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+    有 Content-Length 时直接比较；没有时（分块传输）把本次请求的读取上限收紧到上传限制，
+    multipart 解析写临时文件的过程中超限即中止，不会先把整个请求体写到磁盘。
+    """
+    length = request.content_length
+    if length is not None and length > UPLOAD_REQUEST_MAX_BYTES:
+        return upload_too_large_message()
+    try:
+        request.max_content_length = UPLOAD_REQUEST_MAX_BYTES
+    except AttributeError:
+        pass  # Flask 3.1 之前只能使用全局上限 MAX_CONTENT_LENGTH
+    return None
 
-def translate_with_doubao(text, target_lang, api_key, endpoint_id):
-    """使用豆包翻译文字"""
-    import urllib.request
 
-    lang_names = {'zh': '中文', 'en': 'English'}
-    target_lang_name = lang_names.get(target_lang, '中文')
+@app.errorhandler(413)
+def request_too_large(e):
+    if request.max_content_length == UPLOAD_REQUEST_MAX_BYTES:
+        error = upload_too_large_message()
+    else:
+        error = f'请求内容过大（上限 {MAX_REQUEST_MB}MB）'
+    return jsonify({'success': False, 'error': error}), 413
 
-    prompt = f"""请将以下文字翻译成{target_lang_name}，只返回翻译结果，不要包含任何解释：
 
-{text}"""
+def link_or_copy(src, dst):
+    """硬链接共享文件，跨分区等不支持时复制"""
+    import shutil
 
-    request_data = json.dumps({
-        "model": endpoint_id,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 2000
-    }).encode('utf-8')
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def content_dir_for(content_hash):
+    """内容目录路径"""
+    return os.path.join(CONTENT_DIR, content_hash)
+
+
+def prepare_content(incoming_path, content_hash, doc_type, prerendered=None):
+    """把上传文件放入内容存储并生成页面图片/布局索引；内容已存在时直接复用
+
+    prerendered 为分片上传过程中提前渲染的页面（见 convert_pdf_to_images）。
+    返回 {'pages', 'texts', 'reused'}，无法解析时 pages 为空。
+    """
+    content_dir = content_dir_for(content_hash)
+    pages_path = os.path.join(content_dir, 'pages.state')
+    source_name = 'source.pdf' if doc_type == 'pdf' else 'source.pptx'
+
+    pages = load_content_pages(content_hash)
+    if pages:
+        os.remove(incoming_path)
+        texts = load_state_file(os.path.join(content_dir, 'texts.state'), [])
+        print(f"Upload reused content {content_hash[:12]}")
+        return {'pages': pages, 'texts': texts, 'reused': True}
+
+    os.makedirs(content_dir, exist_ok=True)
+    source_path = os.path.join(content_dir, source_name)
+    os.replace(incoming_path, source_path)
+
+    if doc_type == 'pdf':
+        pages = convert_pdf_to_images(source_path, prerendered)
+        texts = []  # PDF 文本结构保存在 layout.idx 中
+        if pages:
+            # 一次性提取文本布局索引，后续翻译/导出直接使用
+            try:
+                save_layout_index(content_dir, build_layout_index(source_path))
+            except Exception as e:
+                print(f"Layout index build failed: {e}")
+    else:
+        try:
+            pages = convert_ppt_to_images(source_path)
+            texts = extract_ppt_texts(source_path)
+        except Exception as e:
+            print(f"PPT parse failed: {e}")
+            pages, texts = [], []
+        if pages:
+            save_state_file(os.path.join(content_dir, 'texts.state'), texts)
 
-    req = urllib.request.Request(
-        'https://ark.cn-beijing.volces.com/api/v3/chat/completions',
-        data=request_data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
-        }
-    )
+    if pages:
+        # pages.state 最后写入，作为内容完整的标志
+        save_state_file(pages_path, pages)
 
-    with urllib.request.urlopen(req, timeout=30) as response:
-        result = json.loads(response.read().decode('utf-8'))
-        return result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+    return {'pages': pages, 'texts': texts, 'reused': False}
 
-def ocr_with_doubao_vision(image_base64, api_key, endpoint_id):
-    """使用豆包多模态模型识别图片文字"""
-    import urllib.request
 
-    api_url = 'https://ark.cn-beijing.volces.com/api/v3/chat/completions'
+def attach_content(file_id, content_hash, doc_type):
+    """为 file_id 建立会话目录，链接共享内容并登记引用"""
+    content_dir = content_dir_for(content_hash)
+    upload_dir = os.path.join(TEMP_DIR, file_id)
+    os.makedirs(upload_dir, exist_ok=True)
 
-    if not image_base64.startswith('data:'):
-        image_base64 = f'data:image/png;base64,{image_base64}'
+    source_name = 'source.pdf' if doc_type == 'pdf' else 'source.pptx'
+    for name in (source_name, LAYOUT_INDEX_FILENAME):
+        src = os.path.join(content_dir, name)
+        if os.path.exists(src):
+            link_or_copy(src, os.path.join(upload_dir, name))
 
-    request_data = json.dumps({
-        "model": endpoint_id,
-        "messages": [{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": "请识别这张图片中的所有文字，只返回识别出的文字内容。"},
-                {"type": "image_url", "image_url": {"url": image_base64}}
-            ]
-        }],
-        "max_tokens": 2000
-    }).encode('utf-8')
+    refs_dir = os.path.join(content_dir, 'refs')
+    os.makedirs(refs_dir, exist_ok=True)
+    open(os.path.join(refs_dir, file_id), 'w').close()
+    return upload_dir
 
-    req = urllib.request.Request(
-        api_url,
-        data=request_data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
-        }
-    )
 
-    with urllib.request.urlopen(req, timeout=30) as response:
-        result = json.loads(response.read().decode('utf-8'))
-        text = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-        return text, None
+def release_content(file_id, content_hash):
+    """释放 file_id 对内容的引用，引用归零时删除内容目录"""
+    import shutil
 
-def ocr_translate_with_doubao_vision(image_base64, target_lang, api_key, endpoint_id):
-    """使用豆包多模态模型一步完成 OCR + 翻译"""
-    import urllib.request
+    content_dir = content_dir_for(content_hash)
+    refs_dir = os.path.join(content_dir, 'refs')
+    with content_lock(content_hash):
+        try:
+            os.remove(os.path.join(refs_dir, file_id))
+        except OSError:
+            pass
 
-    lang_names = {'zh': '中文', 'en': 'English'}
-    target_lang_name = lang_names.get(target_lang, '中文')
+        if os.path.isdir(refs_dir) and not os.listdir(refs_dir):
+            shutil.rmtree(content_dir, ignore_errors=True)
+            _pages_cache.pop(content_hash, None)
 
-    api_url = 'https://ark.cn-beijing.volces.com/api/v3/chat/completions'
 
-    if not image_base64.startswith('data:'):
-        image_base64 = f'data:image/png;base64,{image_base64}'
+def ingest_content(incoming_path, content_hash, doc_type, prerendered=None):
+    """在内容锁内处理（或复用）内容并为新 file_id 登记引用，返回 (file_id, upload_dir, content)"""
+    with content_lock(content_hash):
+        content = prepare_content(incoming_path, content_hash, doc_type, prerendered)
+        file_id = uuid.uuid4().hex[:8]
+        upload_dir = attach_content(file_id, content_hash, doc_type)
+    return file_id, upload_dir, content
 
-    prompt = f"""请完成以下任务：
-1. 识别图片中的所有文字
-2. 将识别出的文字翻译成{target_lang_name}
 
-请按以下格式返回：
-【原文】
-(识别出的原文)
+def ingest_upload(file, doc_type):
+    """接收上传文件：边写边哈希，去重后建立 file_id 会话
 
-【译文】
-(翻译后的文字)"""
+    返回 (file_id, upload_dir, content_hash, content)，content 同 prepare_content。
+    """
+    incoming_dir = os.path.join(CONTENT_DIR, '.incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+    incoming_path = os.path.join(incoming_dir, uuid.uuid4().hex)
 
-    request_data = json.dumps({
-        "model": endpoint_id,
-        "messages": [{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": image_base64}}
-            ]
-        }],
-        "max_tokens": 2000
-    }).encode('utf-8')
+    try:
+        content_hash, _ = save_upload_stream(file.stream, incoming_path, MAX_UPLOAD_BYTES)
+        file_id, upload_dir, content = ingest_content(incoming_path, content_hash, doc_type)
+    finally:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
 
-    req = urllib.request.Request(
-        api_url,
-        data=request_data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
-        }
-    )
+    return file_id, upload_dir, content_hash, content
 
-    with urllib.request.urlopen(req, timeout=60) as response:
-        result = json.loads(response.read().decode('utf-8'))
-        content = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
 
-        original = ''
-        translation = ''
+def load_content_pages(content_hash):
+    """读取内容存储中的页面图片"""
+    if content_hash in _pages_cache:
+        return _pages_cache[content_hash]
 
-        if '【原文】' in content and '【译文】' in content:
-            parts = content.split('【译文】')
-            original = parts[0].replace('【原文】', '').strip()
-            translation = parts[1].strip() if len(parts) > 1 else ''
-        else:
-            translation = content
+    pages = load_state_file(os.path.join(content_dir_for(content_hash), 'pages.state'))
+    if not pages:
+        return []
 
-        return original, translation
+    if len(_pages_cache) >= _PAGES_CACHE_SIZE:
+        _pages_cache.pop(next(iter(_pages_cache)))
+    _pages_cache[content_hash] = pages
+    return pages
 
-@app.route('/api/translate', methods=['POST'])
-def translate():
-    """翻译文字"""
-    data = request.get_json()
-    text = data.get('text', '').strip()
-    model = data.get('model', 'deepseek')
-    target_lang = data.get('target_lang', 'zh')
 
-    if not text:
-        return jsonify({'success': False, 'error': '没有要翻译的文字'})
+def load_document_pages(document):
+    """文档页面图片（从内容存储读取）"""
+    content_hash = document.get('content_hash')
+    return load_content_pages(content_hash) if content_hash else []
 
-    try:
-        config = read_config()
 
-        if model == 'doubao':
-            api_key = config.get('doubao_api_key')
-            endpoint_id = config.get('doubao_endpoint_id')
+def delete_document(file_id, content_hash=None):
+    """删除 file_id 会话目录并释放共享内容"""
+    import shutil
 
-            if not api_key:
-                return jsonify({'success': False, 'error': '未配置豆包 API Key'})
+    if content_hash is None:
+        document = load_document(file_id)
+        content_hash = document['content_hash'] if document else None
 
-            translation = translate_with_doubao(text, target_lang, api_key, endpoint_id)
-        else:
-            api_key = config.get('deepseek_api_key')
+    delete_document_state(file_id)
+    shutil.rmtree(os.path.join(TEMP_DIR, file_id), ignore_errors=True)
+    if content_hash:
+        release_content(file_id, content_hash)
 
-            if not api_key:
-                return jsonify({'success': False, 'error': '未配置 DeepSeek API Key，请点击设置'})
 
-            translation = translate_with_deepseek(text, target_lang, api_key)
+_glossary_signature_cache = {}  # (mtime_ns, size) -> signature
 
-        return jsonify({'success': True, 'translation': translation})
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+def glossary_signature():
+    """词汇表内容签名，词汇表变化时机器翻译缓存失效（按文件 mtime 缓存，避免每页重新解析）"""
+    import hashlib
 
-@app.route('/api/doubao-direct', methods=['POST'])
-def doubao_direct():
-    """豆包直接翻译图片"""
-    data = request.get_json()
-    image_data = data.get('image', '')
-    target_lang = data.get('target_lang', 'zh')
+    try:
+        stat = os.stat(GLOSSARY_PATH)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stamp = None
+    if stamp in _glossary_signature_cache:
+        return _glossary_signature_cache[stamp]
+
+    terms = [(t.get('source', ''), t.get('target', '')) for t in load_glossary().get('glossary', [])]
+    raw = json.dumps(sorted(terms), ensure_ascii=False)
+    signature = hashlib.sha256(raw.encode('utf-8')).hexdigest()[:12]
+    _glossary_signature_cache.clear()
+    _glossary_signature_cache[stamp] = signature
+    return signature
+
+
+def translation_cache_path(content_hash, route, direction, page_num):
+    """共享内容上的页面机器翻译缓存路径"""
+    name = f'{route}_{direction}_p{page_num}_{glossary_signature()}.state'
+    return os.path.join(content_dir_for(content_hash), 'translations', name)
+
+
+def load_cached_translation(content_hash, route, direction, page_num):
+    """读取同一内容此前的页面机器翻译"""
+    if not content_hash:
+        return None
+    path = translation_cache_path(content_hash, route, direction, page_num)
+    try:
+        return load_state_file(path)
+    except (OSError, ValueError):
+        return None
 
-    if not image_data:
-        return jsonify({'success': False, 'error': '没有图片数据'})
 
+def save_cached_translation(content_hash, route, direction, page_num, trans_data):
+    """保存页面机器翻译，供同一内容的其他会话复用"""
+    if not content_hash:
+        return
+    path = translation_cache_path(content_hash, route, direction, page_num)
     try:
-        config = read_config()
-        api_key = config.get('doubao_api_key')
-        endpoint_id = config.get('doubao_endpoint_id')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_state_file(path, trans_data)
+    except OSError as e:
+        print(f"Translation cache write failed: {e}")
 
-        if not api_key or not endpoint_id:
-            return jsonify({'success': False, 'error': '未配置豆包 API'})
 
-        original, translation = ocr_translate_with_doubao_vision(
-            image_data, target_lang, api_key, endpoint_id
-        )
+@app.route('/api/doc/delete', methods=['POST'])
+def doc_delete():
+    """删除文档会话（共享内容在无引用时一并清理）"""
+    data = request.get_json()
+    file_id = data.get('file_id', '')
 
-        return jsonify({
-            'success': True,
-            'original_text': original,
-            'translation': translation
-        })
+    if not file_id or not file_id.isalnum() or not os.path.isdir(os.path.join(TEMP_DIR, file_id)):
+        return jsonify({'success': False, 'error': '文件不存在'})
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+    delete_document(file_id)
+    return jsonify({'success': True})
+
+
+# ============ 文档状态存储 ============
+#
+# 文档会话状态保存在 SQLite (data/state.db，WAL 模式)：documents / pages / blocks /
+# region_blocks 四张表，按 (file_id, page) 建索引。单个块的增删只写对应的行，读取单页
+# 无需加载整个文档；并发请求由事务串行化，不会再互相覆盖。旧版 metadata.json 首次访问时迁移。
+
+STATE_DB_PATH = os.path.join(DATA_DIR, 'data', 'state.db')
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    file_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL DEFAULT 'pdf',
+    filename TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    content_hash TEXT,
+    texts TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    file_id TEXT NOT NULL REFERENCES documents(file_id) ON DELETE CASCADE,
+    page INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (file_id, page)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_id TEXT NOT NULL REFERENCES documents(file_id) ON DELETE CASCADE,
+    page INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_page ON blocks (file_id, page, seq);
+CREATE TABLE IF NOT EXISTS region_blocks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_id TEXT NOT NULL REFERENCES documents(file_id) ON DELETE CASCADE,
+    page INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    width REAL NOT NULL,
+    height REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS region_blocks_page ON region_blocks (file_id, page, x, y);
+"""
+
+# 表结构升级，按 PRAGMA user_version 依次执行
+STATE_MIGRATIONS = [
+    # 1: 存储管理 —— 最近访问时间与占用空间
+    [
+        'ALTER TABLE documents ADD COLUMN accessed REAL',
+        'ALTER TABLE documents ADD COLUMN size INTEGER NOT NULL DEFAULT 0',
+        'UPDATE documents SET accessed = created',
+        'CREATE INDEX IF NOT EXISTS documents_accessed ON documents (accessed)',
+    ],
+    # 2: 块空间索引 —— 页面版本号，网格缓存据此失效
+    [
+        'ALTER TABLE pages ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+    ],
+    # 3: 词汇表增量重译 —— 翻译块原文倒排索引（已有文档首次重译时补建）、词汇表变更记录
+    [
+        'CREATE TABLE IF NOT EXISTS block_terms (file_id TEXT NOT NULL, token TEXT NOT NULL, '
+        'block_id INTEGER NOT NULL REFERENCES blocks(id) ON DELETE CASCADE)',
+        'CREATE INDEX IF NOT EXISTS block_terms_token ON block_terms (file_id, token)',
+        'CREATE INDEX IF NOT EXISTS block_terms_block ON block_terms (block_id)',
+        'CREATE TABLE IF NOT EXISTS glossary_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'term TEXT NOT NULL, changed REAL NOT NULL)',
+        'ALTER TABLE documents ADD COLUMN terms_indexed INTEGER NOT NULL DEFAULT 0',
+    ],
+    # 4: 模糊翻译记忆 —— 段落译文与 MinHash LSH 索引
+    [
+        'CREATE TABLE IF NOT EXISTS tm_segments (id INTEGER PRIMARY KEY AUTOINCREMENT, direction TEXT NOT NULL, '
+        'key TEXT NOT NULL, source TEXT NOT NULL, target TEXT NOT NULL, glossary TEXT NOT NULL, created REAL NOT NULL)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS tm_segments_key ON tm_segments (direction, key)',
+        'CREATE TABLE IF NOT EXISTS tm_bands (band INTEGER NOT NULL, '
+        'segment_id INTEGER NOT NULL REFERENCES tm_segments(id) ON DELETE CASCADE)',
+        'CREATE INDEX IF NOT EXISTS tm_bands_band ON tm_bands (band)',
+        'CREATE INDEX IF NOT EXISTS tm_bands_segment ON tm_bands (segment_id)',
+    ],
+    # 5: 可取消的翻译任务 —— 状态与已完成页面
+    [
+        'CREATE TABLE IF NOT EXISTS translation_jobs (job_id TEXT PRIMARY KEY, '
+        'file_id TEXT NOT NULL REFERENCES documents(file_id) ON DELETE CASCADE, kind TEXT NOT NULL, '
+        "status TEXT NOT NULL, reason TEXT, completed TEXT NOT NULL DEFAULT '[]', started REAL NOT NULL, updated REAL NOT NULL)",
+        'CREATE INDEX IF NOT EXISTS translation_jobs_file ON translation_jobs (file_id, status)',
+    ],
+    # 6: 断点续传 —— 任务的语言方向与失败页面
+    [
+        'ALTER TABLE translation_jobs ADD COLUMN direction TEXT',
+        "ALTER TABLE translation_jobs ADD COLUMN failed TEXT NOT NULL DEFAULT '[]'",
+    ],
+    # 7: 翻译记忆批量查询 —— 每个 band 只保留最近 32 条倒排（TM_BAND_POSTINGS），倒排改为覆盖索引
+    [
+        'DELETE FROM tm_bands WHERE rowid IN (SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER '
+        '(PARTITION BY band ORDER BY rowid DESC) AS n FROM tm_bands) WHERE n > 32)',
+        'CREATE INDEX IF NOT EXISTS tm_bands_band_segment ON tm_bands (band, segment_id)',
+        'DROP INDEX IF EXISTS tm_bands_band',
+    ],
+]
+
+_db_local = threading.local()
+
+
+def get_db():
+    """当前线程的数据库连接（连接不跨线程/进程共享）"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.executescript(STATE_SCHEMA)
+        migrate_state_schema(conn)
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+
+def migrate_state_schema(conn):
+    """执行尚未应用的表结构升级（多进程同时启动时由写锁串行化）"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(STATE_MIGRATIONS):
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for statements in STATE_MIGRATIONS[version:]:
+            for statement in statements:
+                conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {len(STATE_MIGRATIONS)}')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+@contextmanager
+def db_transaction():
+    """写事务：BEGIN IMMEDIATE 先取得写锁，读-改-写期间不会被其他请求插入"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def create_document(file_id, doc_type, filename, content_hash, content):
+    """登记新上传的文档（页面图片保存在内容存储中）"""
+    import time
+
+    with db_transaction() as conn:
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO documents (file_id, type, filename, total, content_hash, texts, created, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_id, doc_type, filename, len(content['pages']), content_hash,
+             encode_state(content['texts']), now, now)
+        )
+
+
+def load_document(file_id):
+    """读取文档信息 {file_id, type, filename, total, content_hash, texts}，不存在时返回 None
+
+    同时记录最近访问时间（供存储管理按 LRU 清理）。
+    """
+    import time
+
+    if not file_id or not file_id.isalnum():
+        return None
+
+    conn = get_db()
+    row = conn.execute('SELECT * FROM documents WHERE file_id = ?', (file_id,)).fetchone()
+    if row is None:
+        return migrate_legacy_metadata(file_id)
+
+    now = time.time()
+    if now - (row['accessed'] or 0) > STORAGE_ACCESS_RESOLUTION:
+        conn.execute('UPDATE documents SET accessed = ? WHERE file_id = ?', (now, file_id))
+
+    return {
+        'file_id': row['file_id'],
+        'type': row['type'],
+        'filename': row['filename'],
+        'total': row['total'],
+        'content_hash': row['content_hash'],
+        'texts': decode_state(row['texts']) if row['texts'] else []
+    }
+
+
+def write_page_translation(conn, file_id, page, trans_data, replace_region_blocks=False):
+    """在事务内写入一页翻译：页面字段一行，每个块一行"""
+    import time
+
+    fields = {k: v for k, v in trans_data.items() if k not in ('blocks', 'region_blocks')}
+    conn.execute(
+        'INSERT INTO pages (file_id, page, data, updated) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (file_id, page) DO UPDATE SET data = excluded.data, updated = excluded.updated, '
+        'version = version + 1',
+        (file_id, page, encode_state(fields), time.time())
+    )
+    conn.execute('DELETE FROM blocks WHERE file_id = ? AND page = ?', (file_id, page))
+    for seq, block in enumerate(trans_data.get('blocks', [])):
+        cursor = conn.execute(
+            'INSERT INTO blocks (file_id, page, seq, data) VALUES (?, ?, ?, ?)',
+            (file_id, page, seq, encode_state(strip_block_id(block)))
+        )
+        index_block_terms(conn, file_id, cursor.lastrowid, block)
+
+    if replace_region_blocks:
+        conn.execute('DELETE FROM region_blocks WHERE file_id = ? AND page = ?', (file_id, page))
+        for block in trans_data.get('region_blocks', []):
+            insert_region_block(conn, file_id, page, block)
+
+
+def save_page_translation(file_id, page, trans_data):
+    """保存一页机器翻译；用户添加的截图翻译块保留"""
+    with db_transaction() as conn:
+        write_page_translation(conn, file_id, page, trans_data)
+
+
+def strip_block_id(block):
+    """块的 id 即数据库行号，读取时附加，写入时去掉"""
+    return {k: v for k, v in block.items() if k != 'id'}
+
+
+def load_block_row(row):
+    return dict(decode_state(row['data']), id=row['id'])
+
+
+def assemble_page(fields, blocks, region_blocks):
+    trans_data = decode_state(fields)
+    trans_data['blocks'] = blocks
+    trans_data['region_blocks'] = region_blocks
+    return trans_data
+
+
+def load_page_translation(file_id, page):
+    """读取单页翻译（含 blocks / region_blocks，每个块带 id），未翻译时返回 None"""
+    conn = get_db()
+    row = conn.execute('SELECT data FROM pages WHERE file_id = ? AND page = ?', (file_id, page)).fetchone()
+    if row is None:
+        return None
+
+    blocks = [load_block_row(r) for r in conn.execute(
+        'SELECT id, data FROM blocks WHERE file_id = ? AND page = ? ORDER BY seq', (file_id, page))]
+    region_blocks = [load_block_row(r) for r in conn.execute(
+        'SELECT id, data FROM region_blocks WHERE file_id = ? AND page = ? ORDER BY id', (file_id, page))]
+    return assemble_page(row['data'], blocks, region_blocks)
+
+
+def load_translations(file_id):
+    """读取文档全部翻译 {page_str: trans_data}（导出用）"""
+    conn = get_db()
+    blocks = {}
+    for r in conn.execute('SELECT id, page, data FROM blocks WHERE file_id = ? ORDER BY page, seq', (file_id,)):
+        blocks.setdefault(r['page'], []).append(load_block_row(r))
+    region_blocks = {}
+    for r in conn.execute('SELECT id, page, data FROM region_blocks WHERE file_id = ? ORDER BY page, id', (file_id,)):
+        region_blocks.setdefault(r['page'], []).append(load_block_row(r))
+
+    translations = {}
+    for r in conn.execute('SELECT page, data FROM pages WHERE file_id = ? ORDER BY page', (file_id,)):
+        page = r['page']
+        translations[str(page)] = assemble_page(r['data'], blocks.get(page, []), region_blocks.get(page, []))
+    return translations
+
+
+def region_block_box(block):
+    x, y = block.get('x', 0), block.get('y', 0)
+    return x, y, block.get('width', 0), block.get('height', 0)
+
+
+def insert_region_block(conn, file_id, page, block):
+    x, y, width, height = region_block_box(block)
+    cursor = conn.execute(
+        'INSERT INTO region_blocks (file_id, page, x, y, width, height, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (file_id, page, x, y, width, height, encode_state(strip_block_id(block)))
+    )
+    return cursor.lastrowid
+
+
+def region_blocks_overlap(a, b):
+    """两个截图块 (x, y, width, height) 的重叠面积超过任一方的 30%"""
+    ax1, ay1, aw, ah = a
+    bx1, by1, bw, bh = b
+    overlap_x = max(0, min(ax1 + aw, bx1 + bw) - max(ax1, bx1))
+    overlap_y = max(0, min(ay1 + ah, by1 + bh) - max(ay1, by1))
+    overlap_area = overlap_x * overlap_y
+
+    area_a = (aw or 1) * (ah or 1)
+    area_b = (bw or 1) * (bh or 1)
+    return overlap_area > area_a * 0.3 or overlap_area > area_b * 0.3
+
+
+def delete_document_state(file_id):
+    """删除文档及其全部页面/块（外键级联）"""
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM documents WHERE file_id = ?', (file_id,))
+
+
+def adopt_legacy_pages(file_id, doc_type, pages, texts):
+    """旧版 metadata.json 内嵌的页面图片移入内容存储，返回内容哈希"""
+    import hashlib
+
+    upload_dir = os.path.join(TEMP_DIR, file_id)
+    source_name = 'source.pdf' if doc_type == 'pdf' else 'source.pptx'
+    source_path = os.path.join(upload_dir, source_name)
+    if os.path.exists(source_path):
+        content_hash = file_sha256(source_path)
+    else:
+        content_hash = hashlib.sha256(json.dumps(pages).encode('utf-8')).hexdigest()
+
+    content_dir = content_dir_for(content_hash)
+    with content_lock(content_hash):
+        os.makedirs(os.path.join(content_dir, 'refs'), exist_ok=True)
+        if os.path.exists(source_path) and not os.path.exists(os.path.join(content_dir, source_name)):
+            link_or_copy(source_path, os.path.join(content_dir, source_name))
+        if doc_type != 'pdf':
+            save_state_file(os.path.join(content_dir, 'texts.state'), texts)
+
+        pages_path = os.path.join(content_dir, 'pages.state')
+        if not os.path.exists(pages_path):
+            save_state_file(pages_path, pages)
+        open(os.path.join(content_dir, 'refs', file_id), 'w').close()
+    return content_hash
+
+
+def migrate_legacy_metadata(file_id):
+    """导入旧版 metadata.json，导入后重命名为 metadata.json.migrated"""
+    metadata_path = os.path.join(TEMP_DIR, file_id, 'metadata.json')
+    if not os.path.exists(metadata_path):
+        return None
+
+    try:
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    doc_type = metadata.get('type', 'pdf')
+    texts = metadata.get('texts', [])
+    content_hash = metadata.get('content_hash')
+    if not content_hash and metadata.get('pages'):
+        content_hash = adopt_legacy_pages(file_id, doc_type, metadata['pages'], texts)
+
+    with db_transaction() as conn:
+        conn.execute(
+            'INSERT OR IGNORE INTO documents (file_id, type, filename, total, content_hash, texts, created, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_id, doc_type, metadata.get('filename', 'document'), metadata.get('total', 0),
+             content_hash, encode_state(texts), os.path.getmtime(metadata_path), os.path.getmtime(metadata_path))
+        )
+        for page_key, trans_data in metadata.get('translations', {}).items():
+            write_page_translation(conn, file_id, int(page_key), trans_data, replace_region_blocks=True)
+
+    try:
+        os.replace(metadata_path, metadata_path + '.migrated')
+    except OSError:
+        pass  # 并发请求已完成迁移
+    print(f"Migrated legacy metadata for {file_id}")
+    return load_document(file_id)
+
+
+# ============ 块空间索引 ============
+#
+# 每页的翻译块 (blocks，PDF 坐标) 与截图翻译块 (region_blocks，百分比坐标) 统一换算为
+# 页面百分比坐标，放入 SPATIAL_GRID_CELLS x SPATIAL_GRID_CELLS 的网格。重叠移除、
+# 按位置删除和命中测试只检查查询区域覆盖的网格单元。
+# 网格按 pages.version 缓存在进程内；本进程的截图块增删直接增量更新网格。
+
+SPATIAL_GRID_CELLS = 20  # 每格 5%
+_PAGE_GRIDS_SIZE = 64
+
+_page_grids = {}  # (file_id, page) -> (version, grid)
+_page_grids_lock = threading.Lock()
+
+
+def grid_cells(x, y, width, height):
+    """矩形覆盖的网格单元"""
+    size = 100 / SPATIAL_GRID_CELLS
+    last = SPATIAL_GRID_CELLS - 1
+    c0 = min(last, max(0, int(x // size)))
+    c1 = min(last, max(0, int((x + width) // size)))
+    r0 = min(last, max(0, int(y // size)))
+    r1 = min(last, max(0, int((y + height) // size)))
+    return [(c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)]
+
+
+def grid_insert(grid, entry):
+    key = (entry['kind'], entry['id'])
+    grid['entries'][key] = entry
+    for cell in grid_cells(entry['x'], entry['y'], entry['width'], entry['height']):
+        grid['cells'].setdefault(cell, []).append(key)
+
+
+def grid_remove(grid, key):
+    entry = grid['entries'].pop(key, None)
+    if entry is None:
+        return
+    for cell in grid_cells(entry['x'], entry['y'], entry['width'], entry['height']):
+        keys = grid['cells'].get(cell)
+        if keys and key in keys:
+            keys.remove(key)
+
+
+def grid_query(grid, x, y, width=0, height=0):
+    """与矩形相交的条目（按插入顺序）"""
+    found = set()
+    hits = []
+    for cell in grid_cells(x, y, width, height):
+        for key in grid['cells'].get(cell, ()):
+            if key in found:
+                continue
+            found.add(key)
+            e = grid['entries'][key]
+            if e['x'] <= x + width and e['x'] + e['width'] >= x and e['y'] <= y + height and e['y'] + e['height'] >= y:
+                hits.append(e)
+    return hits
+
+
+def build_page_grid(conn, file_id, page, fields):
+    """从数据库构建一页的网格"""
+    grid = {'entries': {}, 'cells': {}}
+
+    page_width = fields.get('page_width')
+    page_height = fields.get('page_height')
+    if page_width and page_height:
+        for r in conn.execute('SELECT id, data FROM blocks WHERE file_id = ? AND page = ? ORDER BY seq',
+                              (file_id, page)):
+            bbox = decode_state(r['data']).get('bbox')
+            if not bbox or len(bbox) < 4:
+                continue
+            grid_insert(grid, {
+                'kind': 'block',
+                'id': r['id'],
+                'x': bbox[0] / page_width * 100,
+                'y': bbox[1] / page_height * 100,
+                'width': (bbox[2] - bbox[0]) / page_width * 100,
+                'height': (bbox[3] - bbox[1]) / page_height * 100
+            })
+
+    for r in conn.execute('SELECT id, x, y, width, height FROM region_blocks WHERE file_id = ? AND page = ? ORDER BY id',
+                          (file_id, page)):
+        grid_insert(grid, dict(r, kind='region'))
+    return grid
+
+
+def load_page_grid(conn, file_id, page):
+    """读取一页的网格，返回 (version, grid)；页面不存在时返回 (None, None)"""
+    row = conn.execute('SELECT data, version FROM pages WHERE file_id = ? AND page = ?', (file_id, page)).fetchone()
+    if row is None:
+        return None, None
+
+    key = (file_id, page)
+    with _page_grids_lock:
+        cached = _page_grids.get(key)
+        if cached and cached[0] == row['version']:
+            return cached
+
+    grid = build_page_grid(conn, file_id, page, decode_state(row['data']))
+    with _page_grids_lock:
+        if len(_page_grids) >= _PAGE_GRIDS_SIZE and key not in _page_grids:
+            _page_grids.pop(next(iter(_page_grids)))
+        _page_grids[key] = (row['version'], grid)
+    return row['version'], grid
+
+
+def update_page_grid(file_id, page, version, new_version, removed=(), added=()):
+    """提交后增量更新缓存的网格；缓存已被其他写入替换时丢弃，下次读取重建"""
+    key = (file_id, page)
+    with _page_grids_lock:
+        cached = _page_grids.get(key)
+        if not cached or cached[0] != version:
+            _page_grids.pop(key, None)
+            return
+        grid = cached[1]
+        for entry_key in removed:
+            grid_remove(grid, entry_key)
+        for entry in added:
+            grid_insert(grid, entry)
+        _page_grids[key] = (new_version, grid)
+
+
+def bump_page_version(conn, file_id, page):
+    conn.execute('UPDATE pages SET version = version + 1 WHERE file_id = ? AND page = ?', (file_id, page))
+    return conn.execute('SELECT version FROM pages WHERE file_id = ? AND page = ?', (file_id, page)).fetchone()[0]
+
+
+def add_region_block(file_id, page, block):
+    """添加截图翻译块，同时移除与之重叠的旧块，返回新块 id"""
+    import time
+
+    box = region_block_box(block)
+    with db_transaction() as conn:
+        conn.execute(
+            'INSERT OR IGNORE INTO pages (file_id, page, data, updated) VALUES (?, ?, ?, ?)',
+            (file_id, page, '{}', time.time())
+        )
+        version, grid = load_page_grid(conn, file_id, page)
+        with _page_grids_lock:
+            candidates = [e for e in grid_query(grid, *box) if e['kind'] == 'region']
+        stale = [e['id'] for e in candidates
+                 if region_blocks_overlap((e['x'], e['y'], e['width'], e['height']), box)]
+        conn.executemany('DELETE FROM region_blocks WHERE id = ?', [(i,) for i in stale])
+        block_id = insert_region_block(conn, file_id, page, block)
+        new_version = bump_page_version(conn, file_id, page)
+
+    x, y, width, height = box
+    update_page_grid(file_id, page, version, new_version,
+                     removed=[('region', i) for i in stale],
+                     added=[{'kind': 'region', 'id': block_id, 'x': x, 'y': y, 'width': width, 'height': height}])
+    return block_id
+
+
+def delete_region_block(file_id, page, block):
+    """按位置（左上角 ±0.5%）删除截图翻译块"""
+    x, y, _, _ = region_block_box(block)
+    with db_transaction() as conn:
+        version, grid = load_page_grid(conn, file_id, page)
+        if grid is None:
+            return
+        with _page_grids_lock:
+            matched = [e['id'] for e in grid_query(grid, x - 0.5, y - 0.5, 1, 1)
+                       if e['kind'] == 'region' and abs(e['x'] - x) < 0.5 and abs(e['y'] - y) < 0.5]
+        if not matched:
+            return
+        conn.executemany('DELETE FROM region_blocks WHERE id = ?', [(i,) for i in matched])
+        new_version = bump_page_version(conn, file_id, page)
+
+    update_page_grid(file_id, page, version, new_version, removed=[('region', i) for i in matched])
+
+
+def hit_test_page(file_id, page, x, y, width=0, height=0):
+    """命中测试：返回与点/矩形相交的块，最上层（后绘制的截图块）在前"""
+    conn = get_db()
+    _, grid = load_page_grid(conn, file_id, page)
+    if grid is None:
+        return []
+    with _page_grids_lock:
+        hits = [dict(e) for e in grid_query(grid, x, y, width, height)]
+
+    # 导出时截图块绘制在整页翻译块之上，后添加的在上
+    hits.sort(key=lambda e: (e['kind'] != 'region', -e['id'] if e['kind'] == 'region' else e['id']))
+    for e in hits:
+        table = 'region_blocks' if e['kind'] == 'region' else 'blocks'
+        row = conn.execute(f'SELECT data FROM {table} WHERE id = ?', (e['id'],)).fetchone()
+        data = decode_state(row['data']) if row else {}
+        e['text'] = data.get('text', '') if e['kind'] == 'region' else data.get('translated', '')
+    return hits
+
+
+@app.route('/api/pdf/hit-test', methods=['POST'])
+def pdf_hit_test():
+    """命中测试：点 {x, y} 或矩形 {x, y, width, height}，页面百分比坐标"""
+    data = request.get_json()
+    file_id = data.get('file_id', '')
+    page = data.get('page', 1)
+
+    if load_document(file_id) is None:
+        return jsonify({'success': False, 'error': '文件不存在'})
+
+    try:
+        hits = hit_test_page(
+            file_id, page,
+            float(data.get('x', 0)), float(data.get('y', 0)),
+            float(data.get('width', 0)), float(data.get('height', 0))
+        )
+        return jsonify({'success': True, 'page': page, 'hits': hits})
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '坐标无效'})
+
+
+# ============ 翻译块编辑 ============
+#
+# 前端对翻译块的新建、移动、缩放、编辑和删除以补丁形式即时提交。每个操作按 (kind, id)
+# 定位一行（kind 为 block 整页翻译块 / region 截图翻译块，id 为数据库行号），同一批新建的块
+# 在批内用前端生成的 ref 引用。一批操作在一个事务内执行，请求大小只与编辑次数有关；
+# 导出直接读取已保存的状态，不再回传全部翻译块。
+
+BLOCK_PATCH_FIELDS = {
+    'create': ('x', 'y', 'width', 'height', 'text', 'original'),
+    'move': ('x', 'y'),
+    'resize': ('width', 'height'),
+    'edit': ('text',),
+    'delete': (),
+}
+BLOCK_PATCH_MAX_OPS = 500
+BLOCK_TABLES = {'block': 'blocks', 'region': 'region_blocks'}
+
+
+def block_patch_values(op):
+    """补丁操作携带的字段（坐标为页面百分比）"""
+    if op.get('op') not in BLOCK_PATCH_FIELDS:
+        raise ValueError(f"未知操作 {op.get('op')!r}")
+
+    values = {}
+    for name in BLOCK_PATCH_FIELDS[op['op']]:
+        if name not in op:
+            continue
+        if name in ('text', 'original'):
+            values[name] = str(op[name])
+        else:
+            values[name] = float(op[name])
+    return values
+
+
+def patch_extracted_block(data, values, page_width, page_height):
+    """整页翻译块（PDF 坐标）应用补丁，返回新的百分比坐标"""
+    if 'text' in values:
+        data['translated'] = values['text']
+        data['edited'] = True  # 手动修改的译文，词汇表重译时不覆盖
+
+    x0, y0, x1, y1 = data['bbox'][:4]
+    box = {
+        'x': x0 / page_width * 100,
+        'y': y0 / page_height * 100,
+        'width': (x1 - x0) / page_width * 100,
+        'height': (y1 - y0) / page_height * 100
+    }
+    geometry = {k: v for k, v in values.items() if k in box}
+    if geometry:
+        box.update(geometry)
+        data['bbox'] = [
+            box['x'] / 100 * page_width,
+            box['y'] / 100 * page_height,
+            (box['x'] + box['width']) / 100 * page_width,
+            (box['y'] + box['height']) / 100 * page_height
+        ]
+    return box
+
+
+def apply_block_patch(file_id, total_pages, ops):
+    """在一个事务内执行一批翻译块补丁，返回 (created, missing)
+
+    created 为新建块 [{ref, kind, id}]；missing 为已不存在的块（例如该页已重新翻译）。
+    """
+    import time
+
+    created = []
+    missing = []
+    refs = {}
+    touched = {}  # page -> {'version': 提交前版本, 'fields': 页面字段, 'entries': {(kind, id): 网格条目或 None}}
+
+    with db_transaction() as conn:
+        def touch(page):
+            if page not in touched:
+                conn.execute(
+                    'INSERT OR IGNORE INTO pages (file_id, page, data, updated) VALUES (?, ?, ?, ?)',
+                    (file_id, page, '{}', time.time())
+                )
+                row = conn.execute('SELECT data, version FROM pages WHERE file_id = ? AND page = ?',
+                                   (file_id, page)).fetchone()
+                touched[page] = {'version': row['version'], 'fields': decode_state(row['data']), 'entries': {}}
+            return touched[page]
+
+        for op in ops:
+            values = block_patch_values(op)
+
+            if op['op'] == 'create':
+                page = int(op['page'])
+                if not 1 <= page <= total_pages:
+                    raise ValueError(f'页码无效 {page}')
+                block = {'x': 0, 'y': 0, 'width': 10, 'height': 5, 'text': ''}
+                block.update(values)
+                info = touch(page)
+                block_id = insert_region_block(conn, file_id, page, block)
+                info['entries'][('region', block_id)] = {
+                    'kind': 'region', 'id': block_id,
+                    'x': block['x'], 'y': block['y'], 'width': block['width'], 'height': block['height']
+                }
+                if op.get('ref') is not None:
+                    refs[op['ref']] = ('region', block_id)
+                created.append({'ref': op.get('ref'), 'kind': 'region', 'id': block_id})
+                continue
+
+            if op.get('ref') is not None and op['ref'] in refs:
+                kind, block_id = refs[op['ref']]
+            else:
+                kind, block_id = op.get('kind'), op.get('id')
+            table = BLOCK_TABLES.get(kind)
+            row = None
+            if table and block_id is not None:
+                row = conn.execute(f'SELECT * FROM {table} WHERE id = ? AND file_id = ?',
+                                   (int(block_id), file_id)).fetchone()
+            if row is None:
+                missing.append({'kind': kind, 'id': block_id})
+                continue
+
+            info = touch(row['page'])
+            key = (kind, row['id'])
+            if op['op'] == 'delete':
+                conn.execute(f'DELETE FROM {table} WHERE id = ?', (row['id'],))
+                info['entries'][key] = None
+                continue
+
+            data = decode_state(row['data'])
+            if kind == 'region':
+                box = {'x': row['x'], 'y': row['y'], 'width': row['width'], 'height': row['height']}
+                box.update({k: v for k, v in values.items() if k in box})
+                data.update(values)
+                conn.execute('UPDATE region_blocks SET x = ?, y = ?, width = ?, height = ?, data = ? WHERE id = ?',
+                             (box['x'], box['y'], box['width'], box['height'], encode_state(data), row['id']))
+            else:
+                page_width = info['fields'].get('page_width')
+                page_height = info['fields'].get('page_height')
+                if not page_width or not page_height or len(data.get('bbox') or []) < 4:
+                    raise ValueError('翻译块缺少页面坐标')
+                box = patch_extracted_block(data, values, page_width, page_height)
+                conn.execute('UPDATE blocks SET data = ? WHERE id = ?', (encode_state(data), row['id']))
+            info['entries'][key] = dict(box, kind=kind, id=row['id'])
+
+        versions = {page: bump_page_version(conn, file_id, page) for page in touched}
+
+    # 每个块只保留本批最后的状态：先移除全部涉及的条目，再插入仍存在的
+    for page, info in touched.items():
+        update_page_grid(file_id, page, info['version'], versions[page],
+                         removed=list(info['entries']),
+                         added=[e for e in info['entries'].values() if e])
+    return created, missing
+
+
+@app.route('/api/pdf/blocks/patch', methods=['POST'])
+def pdf_patch_blocks():
+    """翻译块补丁：ops 为 [{op: create|move|resize|edit|delete, kind, id | ref, ...}]"""
+    data = request.get_json()
+    file_id = data.get('file_id', '')
+    ops = data.get('ops')
+
+    if not file_id or not isinstance(ops, list):
+        return jsonify({'success': False, 'error': '缺少参数'})
+
+    if len(ops) > BLOCK_PATCH_MAX_OPS:
+        return jsonify({'success': False, 'error': f'单次最多 {BLOCK_PATCH_MAX_OPS} 个操作'})
+
+    document = load_document(file_id)
+    if document is None:
+        return jsonify({'success': False, 'error': '文件不存在'})
+
+    try:
+        created, missing = apply_block_patch(file_id, document['total'], ops)
+        return jsonify({'success': True, 'created': created, 'missing': missing})
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'补丁无效: {e}'})
+
+
+# ============ 分片上传 ============
+#
+# 大文件按分片上传：init 登记文件名和总大小，PUT 按 offset 追加分片（边写边哈希），
+# 断线后 GET 查询已接收字节数从断点继续，complete 后进入内容存储。
+# PDF 在上传过程中即开始渲染已完整到达的前几页，完成时按页面指纹复用。
+
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_MB', 4)) * 1024 * 1024
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))  # 秒
+UPLOAD_PRERENDER_STEP = 1024 * 1024  # 每新到 1MB 尝试一次提前渲染
+
+_upload_sessions = {}  # upload_id -> 进程内状态（增量哈希、提前渲染结果）
+_upload_sessions_lock = threading.Lock()
+
+
+def upload_incoming_dir():
+    incoming_dir = os.path.join(CONTENT_DIR, '.incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+    return incoming_dir
+
+
+def upload_doc_type(filename):
+    """按扩展名判断文档类型"""
+    filename = filename.lower()
+    if filename.endswith('.pdf'):
+        return 'pdf'
+    if filename.endswith('.pptx') or filename.endswith('.ppt'):
+        return 'ppt'
+    return None
+
+
+def cleanup_stale_uploads():
+    """清理超过有效期仍未完成的分片上传"""
+    import time
+
+    incoming_dir = upload_incoming_dir()
+    now = time.time()
+    for name in os.listdir(incoming_dir):
+        if not name.endswith('.part'):
+            continue
+        upload_id = name[:-len('.part')]
+        try:
+            if now - os.path.getmtime(os.path.join(incoming_dir, name)) <= UPLOAD_SESSION_TTL:
+                continue
+        except OSError:
+            continue
+        _upload_sessions.pop(upload_id, None)
+        for stale in (name, f'{upload_id}.json'):
+            try:
+                os.remove(os.path.join(incoming_dir, stale))
+            except OSError:
+                pass
+
+
+def get_upload_session(upload_id):
+    """读取分片上传会话；进程内哈希状态与磁盘不一致时（重启/多 worker）从分片文件重建"""
+    import hashlib
+
+    if not upload_id or not upload_id.isalnum():
+        return None
+    incoming_dir = upload_incoming_dir()
+    info_path = os.path.join(incoming_dir, f'{upload_id}.json')
+    part_path = os.path.join(incoming_dir, f'{upload_id}.part')
+    if not os.path.exists(info_path) or not os.path.exists(part_path):
+        return None
+
+    with _upload_sessions_lock:
+        session = _upload_sessions.get(upload_id)
+        if session is None:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            session = dict(info, upload_id=upload_id, part_path=part_path, lock=threading.Lock(),
+                           hash=None, received=-1, prerendered={}, prerender_future=None,
+                           prerender_at=0)
+            _upload_sessions[upload_id] = session
+
+    with session['lock']:
+        on_disk = os.path.getsize(part_path)
+        if session['received'] != on_disk:
+            h = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            session['hash'] = h
+            session['received'] = on_disk
+    return session
+
+
+def prerender_partial_pdf(part_path, length, start_page):
+    """（在导出进程池中执行）渲染部分到达的 PDF 中已完整的页面
+
+    MuPDF 会修复截断的文件；渲染时出现任何警告（对象缺失、流不完整）即停止，
+    只返回确定完整的页面 {page_num: (fingerprint, data_url)}。
+    完成上传时再按 page_fingerprint 与完整文件校验后复用。
+    """
+    import fitz
+
+    with open(part_path, 'rb') as f:
+        data = f.read(length)
+
+    rendered = {}
+    # 截断文件的修复错误属预期，不输出到日志
+    fitz.TOOLS.mupdf_display_errors(False)
+    try:
+        doc = fitz.open('pdf', data)
+        fitz.TOOLS.mupdf_warnings()  # 清空修复截断文件产生的警告
+
+        for page_num in range(start_page, len(doc)):
+            try:
+                page = doc.load_page(page_num)
+                fingerprint = page_fingerprint(doc, page)
+                data_url = render_page_data_url(page, render_zoom(page.rect, 'display'))
+            except Exception:
+                break
+            if fitz.TOOLS.mupdf_warnings():
+                break
+            rendered[page_num] = (fingerprint, data_url)
+        doc.close()
+    except Exception:
+        pass  # 文件头/页面树尚未到达
+    finally:
+        fitz.TOOLS.mupdf_display_errors(True)
+    return rendered
+
+
+def collect_prerendered(session, wait=False):
+    """合并已完成的提前渲染结果"""
+    future = session['prerender_future']
+    if future is None or not (wait or future.done()):
+        return
+    session['prerender_future'] = None
+    try:
+        session['prerendered'].update(future.result())
+    except Exception as e:
+        print(f"Upload prerender failed: {e}")
+
+
+def schedule_prerender(session):
+    """每到达一定数据量后在后台进程中尝试渲染已到达的页面"""
+    if session['doc_type'] != 'pdf' or EXPORT_WORKERS <= 1:
+        return
+    collect_prerendered(session)
+    if session['prerender_future'] is not None:
+        return
+    if session['received'] - session['prerender_at'] < UPLOAD_PRERENDER_STEP:
+        return
+
+    session['prerender_at'] = session['received']
+    try:
+        session['prerender_future'] = get_export_pool().submit(
+            prerender_partial_pdf, session['part_path'], session['received'], len(session['prerendered']))
+    except Exception as e:
+        print(f"Upload prerender unavailable: {e}")
+
+
+@app.route('/api/upload/init', methods=['POST'])
+def upload_init():
+    """创建分片上传会话"""
+    import time
+
+    data = request.get_json()
+    filename = data.get('filename', '')
+    size = data.get('size', 0)
+
+    if not filename:
+        return jsonify({'success': False, 'error': '文件名为空'})
+    doc_type = upload_doc_type(filename)
+    if not doc_type:
+        return jsonify({'success': False, 'error': '不支持的文件格式，请上传 PDF 或 PPT'})
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'success': False, 'error': '文件大小无效'})
+    if size > MAX_UPLOAD_BYTES:
+        return jsonify({'success': False, 'error': upload_too_large_message()})
+
+    cleanup_stale_uploads()
+
+    upload_id = uuid.uuid4().hex
+    incoming_dir = upload_incoming_dir()
+    info = {'filename': filename, 'size': size, 'doc_type': doc_type, 'created': time.time()}
+    open(os.path.join(incoming_dir, f'{upload_id}.part'), 'wb').close()
+    with open(os.path.join(incoming_dir, f'{upload_id}.json'), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'chunk_size': UPLOAD_CHUNK_BYTES,
+        'received': 0
+    })
+
+
+@app.route('/api/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """查询已接收字节数，用于断点续传"""
+    session = get_upload_session(upload_id)
+    if not session:
+        return jsonify({'success': False, 'error': '上传会话不存在或已过期'})
+
+    return jsonify({
+        'success': True,
+        'received': session['received'],
+        'size': session['size'],
+        'prerendered': len(session['prerendered'])
+    })
+
+
+@app.route('/api/upload/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """追加一个分片（请求体为原始字节，?offset= 为分片起始位置）"""
+    session = get_upload_session(upload_id)
+    if not session:
+        return jsonify({'success': False, 'error': '上传会话不存在或已过期'})
+
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if length is None or length > UPLOAD_CHUNK_BYTES:
+        return jsonify({'success': False, 'error': f'分片大小无效（最大 {UPLOAD_CHUNK_BYTES // (1024 * 1024)}MB）'})
+
+    with session['lock']:
+        if offset != session['received']:
+            # 客户端据此从服务器实际接收位置续传
+            return jsonify({'success': False, 'error': '分片偏移不匹配', 'received': session['received']})
+        if session['received'] + length > session['size']:
+            return jsonify({'success': False, 'error': '分片超出文件大小', 'received': session['received']})
+
+        remaining = length
+        with open(session['part_path'], 'ab') as out:
+            while remaining > 0:
+                chunk = request.stream.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break  # 连接中断，已写入部分保留，客户端查询后续传
+                session['hash'].update(chunk)
+                out.write(chunk)
+                session['received'] += len(chunk)
+                remaining -= len(chunk)
+
+        schedule_prerender(session)
+        received = session['received']
+
+    return jsonify({'success': True, 'received': received, 'size': session['size']})
+
+
+@app.route('/api/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    """分片全部到达后校验、去重并建立文档会话，返回与 /api/doc/upload 相同的结构"""
+    session = get_upload_session(upload_id)
+    if not session:
+        return jsonify({'success': False, 'error': '上传会话不存在或已过期'})
+    if session['received'] != session['size']:
+        return jsonify({'success': False, 'error': '文件尚未上传完整', 'received': session['received']})
+
+    incoming_dir = upload_incoming_dir()
+    doc_type = session['doc_type']
+    collect_prerendered(session, wait=True)
+
+    try:
+        content_hash = session['hash'].hexdigest()
+        file_id, _, content = ingest_content(session['part_path'], content_hash, doc_type, session['prerendered'])
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+    finally:
+        _upload_sessions.pop(upload_id, None)
+        for name in (f'{upload_id}.part', f'{upload_id}.json'):
+            try:
+                os.remove(os.path.join(incoming_dir, name))
+            except OSError:
+                pass
+
+    pages = content['pages']
+    if not pages:
+        delete_document(file_id, content_hash)
+        return jsonify({'success': False, 'error': f'无法解析 {doc_type.upper()} 文件'})
+
+    create_document(file_id, doc_type, session['filename'], content_hash, content)
+
+    return jsonify({
+        'success': True,
+        'file_id': file_id,
+        'type': doc_type,
+        'pages': pages,
+        'total': len(pages),
+        'texts': content['texts']
+    })
+
+
+# ============ 存储管理 ============
+#
+# data/temp 与 data/content 会持续增长。后台线程定期统计每个文档的占用空间
+# (会话目录 + 按引用数分摊的共享内容)，删除超过 TTL 未访问的文档，总占用超过配额时
+# 按最近访问时间 (LRU) 继续清理，直到降到配额的 90%。正在使用的文档不会被清理。
+
+STORAGE_QUOTA_MB = int(os.environ.get('STORAGE_QUOTA_MB', 1024))
+STORAGE_TTL_HOURS = float(os.environ.get('STORAGE_TTL_HOURS', 72))
+STORAGE_SWEEP_INTERVAL = int(os.environ.get('STORAGE_SWEEP_INTERVAL', 600))  # 秒
+STORAGE_MIN_IDLE = 15 * 60  # 最近 15 分钟内访问过的文档不参与配额清理
+STORAGE_ACCESS_RESOLUTION = 60  # 访问时间最多每分钟写一次
+
+_storage_thread = None
+_storage_lock = threading.Lock()
+_storage_stats = {
+    'last_sweep': None,
+    'sweep_seconds': 0,
+    'temp_bytes': 0,
+    'content_bytes': 0,
+    'total_bytes': 0,
+    'evicted_ttl': 0,
+    'evicted_quota': 0,
+    'freed_bytes': 0
+}
+
+
+def walk_file_stats(path):
+    """递归列出目录下所有文件的 stat"""
+    stats = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stats.append(os.stat(os.path.join(root, name)))
+            except OSError:
+                pass
+    return stats
+
+
+def unique_size(paths):
+    """目录总占用，硬链接只计一次"""
+    seen = set()
+    total = 0
+    for path in paths:
+        for st in walk_file_stats(path):
+            key = (st.st_dev, st.st_ino)
+            if key not in seen:
+                seen.add(key)
+                total += st.st_size
+    return total
+
+
+def content_refs(content_hash):
+    try:
+        return len(os.listdir(os.path.join(content_dir_for(content_hash), 'refs')))
+    except OSError:
+        return 0
+
+
+def measure_documents(rows):
+    """每个文档的占用：会话目录自有文件 + 共享内容按引用数分摊
+
+    返回 {file_id: (size, reclaimable)}，reclaimable 为删除该文档可释放的字节数。
+    """
+    content_sizes = {}
+    sizes = {}
+    for row in rows:
+        file_id, content_hash = row['file_id'], row['content_hash']
+        # 硬链接到内容存储的源文件/索引计入共享内容
+        own = sum(st.st_size for st in walk_file_stats(os.path.join(TEMP_DIR, file_id)) if st.st_nlink <= 1)
+
+        shared = reclaim_shared = 0
+        if content_hash:
+            if content_hash not in content_sizes:
+                content_sizes[content_hash] = (unique_size([content_dir_for(content_hash)]), content_refs(content_hash))
+            content_size, refs = content_sizes[content_hash]
+            shared = content_size // max(1, refs)
+            reclaim_shared = content_size if refs <= 1 else 0
+        sizes[file_id] = (own + shared, own + reclaim_shared)
+    return sizes
+
+
+def content_ref_owners():
+    """{file_id: [内容哈希, ...]}，来自各内容目录 refs/ 下的引用标记"""
+    owners = {}
+    for content_hash in os.listdir(CONTENT_DIR):
+        if content_hash.startswith('.'):
+            continue
+        try:
+            file_ids = os.listdir(os.path.join(content_dir_for(content_hash), 'refs'))
+        except OSError:
+            continue
+        for file_id in file_ids:
+            owners.setdefault(file_id, []).append(content_hash)
+    return owners
+
+
+def remove_orphans(known_ids, now):
+    """清理没有文档记录的会话目录和无引用的内容目录（超过 TTL / 1 小时的才处理）
+
+    删除孤立会话目录时一并释放它对共享内容的引用；会话目录已不存在的悬空引用
+    （超过 1 小时）同样释放，否则内容目录永远不会被回收。
+    """
+    import shutil
+
+    freed = 0
+    ttl = STORAGE_TTL_HOURS * 3600
+    owners = content_ref_owners()
+
+    def release(file_id, content_hash):
+        size = unique_size([content_dir_for(content_hash)]) if content_refs(content_hash) <= 1 else 0
+        release_content(file_id, content_hash)
+        return size
+    for name in os.listdir(TEMP_DIR):
+        path = os.path.join(TEMP_DIR, name)
+        if name in known_ids or not os.path.isdir(path):
+            continue
+        if os.path.exists(os.path.join(path, 'metadata.json')):
+            continue  # 旧版文档，首次访问时迁移
+        if now - os.path.getmtime(path) > ttl:
+            freed += unique_size([path])
+            shutil.rmtree(path, ignore_errors=True)
+            for content_hash in owners.pop(name, []):
+                freed += release(name, content_hash)
+
+    for file_id, hashes in owners.items():
+        if file_id in known_ids or os.path.isdir(os.path.join(TEMP_DIR, file_id)):
+            continue
+        for content_hash in hashes:
+            ref_path = os.path.join(content_dir_for(content_hash), 'refs', file_id)
+            try:
+                stale = now - os.path.getmtime(ref_path) > 3600
+            except OSError:
+                continue
+            if stale:
+                freed += release(file_id, content_hash)
+
+    for name in os.listdir(CONTENT_DIR):
+        path = os.path.join(CONTENT_DIR, name)
+        if name.startswith('.') or not os.path.isdir(path) or content_refs(name):
+            continue
+        # 刚上传、尚未登记引用的内容目录保留
+        if now - os.path.getmtime(path) > 3600:
+            with content_lock(name):
+                if content_refs(name):
+                    continue  # 等待锁期间被新上传复用
+                freed += unique_size([path])
+                shutil.rmtree(path, ignore_errors=True)
+                _pages_cache.pop(name, None)
+    return freed
+
+
+def sweep_storage():
+    """执行一次清理：刷新占用统计，按 TTL 和配额 (LRU) 删除文档"""
+    import time
+
+    with _storage_lock:
+        start = time.time()
+        cleanup_stale_uploads()
+
+        conn = get_db()
+        rows = conn.execute(
+            'SELECT file_id, content_hash, accessed FROM documents ORDER BY accessed'
+        ).fetchall()
+        sizes = measure_documents(rows)
+        with db_transaction() as tx:
+            tx.executemany('UPDATE documents SET size = ? WHERE file_id = ?',
+                           [(size, file_id) for file_id, (size, _) in sizes.items()])
+
+        freed = remove_orphans({row['file_id'] for row in rows}, start)
+        ttl_cutoff = start - STORAGE_TTL_HOURS * 3600
+        remaining = []
+        for row in rows:
+            if (row['accessed'] or 0) < ttl_cutoff:
+                freed += measure_documents([row])[row['file_id']][1]
+                delete_document(row['file_id'], row['content_hash'])
+                _storage_stats['evicted_ttl'] += 1
+            else:
+                remaining.append(row)
+
+        quota = STORAGE_QUOTA_MB * 1024 * 1024
+        total = unique_size([TEMP_DIR, CONTENT_DIR])
+        if total > quota:
+            # 从最久未访问的文档开始清理，删除后按实际占用重新计算可释放空间
+            target = int(quota * 0.9)
+            for row in remaining:
+                if total <= target:
+                    break
+                if start - (row['accessed'] or 0) < STORAGE_MIN_IDLE:
+                    break
+                reclaim = measure_documents([row])[row['file_id']][1]
+                delete_document(row['file_id'], row['content_hash'])
+                total -= reclaim
+                freed += reclaim
+                _storage_stats['evicted_quota'] += 1
+            if total > quota:
+                print(f"Storage over quota after sweep: {total / 1024 / 1024:.1f}MB (documents in use)")
+
+        temp_bytes = unique_size([TEMP_DIR])
+        content_bytes = unique_size([CONTENT_DIR])
+        _storage_stats.update({
+            'last_sweep': start,
+            'sweep_seconds': round(time.time() - start, 3),
+            'temp_bytes': temp_bytes,
+            'content_bytes': content_bytes,
+            'total_bytes': unique_size([TEMP_DIR, CONTENT_DIR]),
+            'freed_bytes': _storage_stats['freed_bytes'] + freed
+        })
+        if freed:
+            print(f"Storage sweep freed {freed / 1024 / 1024:.1f}MB")
+
+
+def storage_manager_loop():
+    import time
+
+    while True:
+        try:
+            sweep_storage()
+        except Exception as e:
+            print(f"Storage sweep failed: {e}")
+        time.sleep(STORAGE_SWEEP_INTERVAL)
+
+
+def start_storage_manager():
+    """启动后台清理线程（每个进程一个；gunicorn fork 后在各 worker 中各自启动）"""
+    global _storage_thread
+    if _storage_thread is not None and _storage_thread.is_alive():
+        return
+    _storage_thread = threading.Thread(target=storage_manager_loop, name='storage-manager', daemon=True)
+    _storage_thread.start()
+
+
+@app.before_request
+def ensure_storage_manager():
+    start_storage_manager()
+
+
+@app.route('/api/storage/stats', methods=['GET'])
+def storage_stats():
+    """存储占用统计"""
+    if _storage_stats['last_sweep'] is None:
+        sweep_storage()
+
+    conn = get_db()
+    count, documents_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents').fetchone()
+    largest = conn.execute(
+        'SELECT file_id, filename, size, accessed FROM documents ORDER BY size DESC LIMIT 10'
+    ).fetchall()
+
+    return jsonify({
+        'success': True,
+        'quota_bytes': STORAGE_QUOTA_MB * 1024 * 1024,
+        'ttl_hours': STORAGE_TTL_HOURS,
+        'documents': count,
+        'documents_bytes': documents_bytes,
+        **_storage_stats,
+        'largest': [dict(row) for row in largest]
+    })
+
+
+@app.route('/api/storage/sweep', methods=['POST'])
+def storage_sweep():
+    """立即执行一次清理"""
+    try:
+        sweep_storage()
+        return jsonify({'success': True, **_storage_stats})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+# ============ 文本布局索引 ============
+#
+# 上传时一次性提取全部页面的块/行/span 及其位置、字号，按列存储为紧凑的二进制文件
+# (layout.idx)，翻译、导出、命中测试直接读取，无需重新解析 PDF。
+
+LAYOUT_INDEX_FILENAME = 'layout.idx'
+LAYOUT_INDEX_MAGIC = b'NTLI'
+LAYOUT_INDEX_VERSION = 1
+
+_layout_index_cache = {}  # path -> (mtime, index)
+_LAYOUT_INDEX_CACHE_SIZE = 16
+
+
+def build_layout_index(pdf_path):
+    """提取 PDF 全部页面的文本布局，返回列式索引"""
+    import fitz
+    from array import array
+
+    index = {
+        'page_w': array('f'), 'page_h': array('f'), 'page_has_text': array('B'),
+        'page_block_start': array('I'), 'page_image_start': array('I'),
+        'image_bbox': array('f'),
+        'block_bbox': array('f'), 'block_line_start': array('I'),
+        'line_bbox': array('f'), 'line_dir': array('f'), 'line_span_start': array('I'),
+        'span_bbox': array('f'), 'span_size': array('f'), 'span_flags': array('I'),
+        'span_font': array('I'), 'span_text': [],
+        'fonts': []
+    }
+    font_ids = {}
+
+    doc = fitz.open(pdf_path)
+    try:
+        for pdf_page in doc:
+            rect = pdf_page.rect
+            index['page_w'].append(rect.width)
+            index['page_h'].append(rect.height)
+            index['page_block_start'].append(len(index['block_line_start']))
+            index['page_image_start'].append(len(index['image_bbox']) // 4)
+
+            has_text = False
+            text_blocks = pdf_page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)["blocks"]
+            for block in text_blocks:
+                if block.get("type") != 0:
+                    continue
+                index['block_bbox'].extend(block.get("bbox", (0, 0, 0, 0)))
+                index['block_line_start'].append(len(index['line_span_start']))
+
+                for line in block.get("lines", []):
+                    index['line_bbox'].extend(line.get("bbox", (0, 0, 0, 0)))
+                    index['line_dir'].extend(line.get("dir", (1, 0)))
+                    index['line_span_start'].append(len(index['span_size']))
+
+                    for span in line.get("spans", []):
+                        text = span.get("text", "").replace('\x00', '')
+                        font = span.get("font", "")
+                        if font not in font_ids:
+                            font_ids[font] = len(index['fonts'])
+                            index['fonts'].append(font)
+
+                        index['span_bbox'].extend(span.get("bbox", (0, 0, 0, 0)))
+                        index['span_size'].append(span.get("size", 12))
+                        index['span_flags'].append(span.get("flags", 0))
+                        index['span_font'].append(font_ids[font])
+                        index['span_text'].append(text)
+                        if text.strip():
+                            has_text = True
+
+            for info in pdf_page.get_image_info():
+                index['image_bbox'].extend(info.get("bbox", (0, 0, 0, 0)))
+
+            index['page_has_text'].append(1 if has_text else 0)
+    finally:
+        doc.close()
+
+    # 末尾哨兵，便于用 start[i]:start[i+1] 切片
+    index['page_block_start'].append(len(index['block_line_start']))
+    index['page_image_start'].append(len(index['image_bbox']) // 4)
+    index['block_line_start'].append(len(index['line_span_start']))
+    index['line_span_start'].append(len(index['span_size']))
+    return index
+
+
+def pack_layout_index(index):
+    """序列化列式索引：magic + 版本 + zlib(列名/类型/数据...)"""
+    import struct
+    import zlib
+    from array import array
+
+    body = bytearray()
+    for name, column in index.items():
+        if isinstance(column, array):
+            typecode = column.typecode
+            if sys.byteorder != 'little':
+                column = array(typecode, column)
+                column.byteswap()
+            data = column.tobytes()
+        else:
+            typecode = 's'
+            data = struct.pack('<I', len(column)) + '\x00'.join(column).encode('utf-8')
+        name_bytes = name.encode('utf-8')
+        body += struct.pack('<H', len(name_bytes)) + name_bytes
+        body += typecode.encode('ascii') + struct.pack('<I', len(data)) + data
+
+    return LAYOUT_INDEX_MAGIC + struct.pack('<B', LAYOUT_INDEX_VERSION) + zlib.compress(bytes(body), 6)
+
+
+def unpack_layout_index(raw):
+    """反序列化 pack_layout_index 的输出，格式不符时返回 None"""
+    import struct
+    import zlib
+    from array import array
+
+    if raw[:4] != LAYOUT_INDEX_MAGIC or raw[4] != LAYOUT_INDEX_VERSION:
+        return None
+
+    body = zlib.decompress(raw[5:])
+    index = {}
+    pos = 0
+    while pos < len(body):
+        (name_len,) = struct.unpack_from('<H', body, pos)
+        pos += 2
+        name = body[pos:pos + name_len].decode('utf-8')
+        pos += name_len
+        typecode = chr(body[pos])
+        (data_len,) = struct.unpack_from('<I', body, pos + 1)
+        pos += 5
+        data = body[pos:pos + data_len]
+        pos += data_len
+
+        if typecode == 's':
+            (count,) = struct.unpack_from('<I', data, 0)
+            index[name] = data[4:].decode('utf-8').split('\x00') if count else []
+        else:
+            column = array(typecode)
+            column.frombytes(data)
+            if sys.byteorder != 'little':
+                column.byteswap()
+            index[name] = column
+    return index
+
+
+def save_layout_index(upload_dir, index):
+    """写入 layout.idx"""
+    path = os.path.join(upload_dir, LAYOUT_INDEX_FILENAME)
+    with open(path, 'wb') as f:
+        f.write(pack_layout_index(index))
+
+
+def load_layout_index(upload_dir):
+    """读取文档布局索引；旧文档没有索引时从 source.pdf 构建并保存"""
+    path = os.path.join(upload_dir, LAYOUT_INDEX_FILENAME)
+
+    if os.path.exists(path):
+        mtime = os.path.getmtime(path)
+        cached = _layout_index_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            index = unpack_layout_index(f.read())
+    else:
+        index = None
+
+    if index is None:
+        source_path = os.path.join(upload_dir, 'source.pdf')
+        if not os.path.exists(source_path):
+            return None
+        index = build_layout_index(source_path)
+        save_layout_index(upload_dir, index)
+        mtime = os.path.getmtime(path)
+
+    if len(_layout_index_cache) >= _LAYOUT_INDEX_CACHE_SIZE:
+        _layout_index_cache.pop(next(iter(_layout_index_cache)))
+    _layout_index_cache[path] = (mtime, index)
+    return index
+
+
+def layout_page_count(index):
+    """索引中的页数"""
+    return len(index['page_w'])
+
+
+def layout_page_info(index, page_idx):
+    """页面尺寸、是否有文本层、图片区域"""
+    img_start, img_end = index['page_image_start'][page_idx], index['page_image_start'][page_idx + 1]
+    image_bboxes = [
+        list(index['image_bbox'][i * 4:i * 4 + 4]) for i in range(img_start, img_end)
+    ]
+    return {
+        'width': index['page_w'][page_idx],
+        'height': index['page_h'][page_idx],
+        'has_text': bool(index['page_has_text'][page_idx]),
+        'image_bboxes': image_bboxes
+    }
+
+
+def layout_page_blocks(index, page_idx):
+    """返回与 get_text("dict") 相同结构的文本块列表"""
+    fonts = index['fonts']
+    blocks = []
+    for b in range(index['page_block_start'][page_idx], index['page_block_start'][page_idx + 1]):
+        lines = []
+        for ln in range(index['block_line_start'][b], index['block_line_start'][b + 1]):
+            spans = []
+            for s in range(index['line_span_start'][ln], index['line_span_start'][ln + 1]):
+                spans.append({
+                    'text': index['span_text'][s],
+                    'size': index['span_size'][s],
+                    'flags': index['span_flags'][s],
+                    'font': fonts[index['span_font'][s]],
+                    'bbox': tuple(index['span_bbox'][s * 4:s * 4 + 4])
+                })
+            lines.append({
+                'bbox': tuple(index['line_bbox'][ln * 4:ln * 4 + 4]),
+                'dir': tuple(index['line_dir'][ln * 2:ln * 2 + 2]),
+                'spans': spans
+            })
+        blocks.append({
+            'type': 0,
+            'bbox': tuple(index['block_bbox'][b * 4:b * 4 + 4]),
+            'lines': lines
+        })
+    return blocks
+
+
+# 页面分类阈值：没有文本层，或图片占满页面而文字很少时交给视觉模型
+PAGE_ROUTE_IMAGE_COVERAGE = float(os.environ.get('PAGE_ROUTE_IMAGE_COVERAGE', 0.6))
+PAGE_ROUTE_MIN_TEXT_COVERAGE = float(os.environ.get('PAGE_ROUTE_MIN_TEXT_COVERAGE', 0.02))
+PAGE_ROUTE_MAX_UNREADABLE = 0.3
+
+
+def classify_page_route(index, page_idx):
+    """根据文本层覆盖率与图片面积判断页面走文本路径还是视觉模型"""
+    info = layout_page_info(index, page_idx)
+    page_w, page_h = info['width'], info['height']
+    page_area = max(page_w * page_h, 1)
+
+    def clipped_area(bbox):
+        w = min(bbox[2], page_w) - max(bbox[0], 0)
+        h = min(bbox[3], page_h) - max(bbox[1], 0)
+        return max(w, 0) * max(h, 0)
+
+    line_start = index['block_line_start'][index['page_block_start'][page_idx]]
+    line_end = index['block_line_start'][index['page_block_start'][page_idx + 1]]
+    span_start = index['line_span_start'][line_start]
+    span_end = index['line_span_start'][line_end]
+
+    chars = 0
+    unreadable = 0
+    text_area = 0
+    for s in range(span_start, span_end):
+        text = index['span_text'][s]
+        visible = sum(1 for ch in text if not ch.isspace())
+        if not visible:
+            continue
+        chars += visible
+        # 缺失 ToUnicode 映射的字体会提取出替换符或私用区字符
+        unreadable += sum(1 for ch in text if ch == '\ufffd' or 0xE000 <= ord(ch) <= 0xF8FF)
+        text_area += clipped_area(index['span_bbox'][s * 4:s * 4 + 4])
+
+    image_area = sum(clipped_area(b) for b in info['image_bboxes'])
+    text_coverage = min(text_area / page_area, 1.0)
+    image_coverage = min(image_area / page_area, 1.0)
+
+    if chars == 0:
+        route, reason = 'vision', 'no_text_layer'
+    elif unreadable / chars > PAGE_ROUTE_MAX_UNREADABLE:
+        route, reason = 'vision', 'unreadable_text'
+    elif image_coverage >= PAGE_ROUTE_IMAGE_COVERAGE and text_coverage < PAGE_ROUTE_MIN_TEXT_COVERAGE:
+        route, reason = 'vision', 'image_heavy'
+    else:
+        route, reason = 'text', 'text_layer'
+
+    return {
+        'route': route,
+        'reason': reason,
+        'chars': chars,
+        'text_coverage': round(text_coverage, 3),
+        'image_coverage': round(image_coverage, 3)
+    }
+
+
+# ============ 段落重建 ============
+#
+# PyMuPDF 的 block 经常把一个段落拆成多块、或把多栏内容切碎。这里按行重新组合：
+# 同栏、行距正常、字号相近的行合并为段落，再按阅读顺序（XY-cut）排序。
+
+PARAGRAPH_MAX_CHARS = 1500
+SENTENCE_END_CHARS = '.!?:;。！？：；'
+BULLET_CHARS = '•·▪●○◦-–—*'
+
+
+def is_cjk(ch):
+    """是否为中日韩文字或全角标点"""
+    code = ord(ch)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or
+            0x3000 <= code <= 0x303F or 0xFF00 <= code <= 0xFFEF or
+            0x3040 <= code <= 0x30FF or 0xAC00 <= code <= 0xD7AF)
+
+
+def join_text_pieces(left, right, gap_is_space=True):
+    """拼接两段文字：拉丁文之间补空格，中文之间不加，处理行尾连字符"""
+    if not left:
+        return right
+    if not right:
+        return left
+    if left[-1].isspace() or right[0].isspace():
+        return left + right
+    if left.endswith('-') and len(left) > 1 and left[-2].isalpha() and right[0].islower():
+        return left[:-1] + right
+    if is_cjk(left[-1]) or is_cjk(right[0]) or not gap_is_space:
+        return left + right
+    return left + ' ' + right
+
+
+def build_layout_lines(text_blocks):
+    """把文本块展开为行：合并 span 文字，记录各 span 字号及字符数"""
+    lines = []
+    for block_no, block in enumerate(text_blocks):
+        if block.get('type', 0) != 0:
+            continue
+        for line in block.get('lines', []):
+            text = ''
+            sizes = {}
+            prev_bbox = None
+            for span in line.get('spans', []):
+                span_text = span.get('text', '')
+                if not span_text:
+                    continue
+                size = round(span.get('size', 12), 1)
+                bbox = span.get('bbox', (0, 0, 0, 0))
+                # span 之间有明显间距才视为空格
+                gap_is_space = prev_bbox is None or bbox[0] - prev_bbox[2] > size * 0.15
+                text = join_text_pieces(text, span_text, gap_is_space)
+                sizes[size] = sizes.get(size, 0) + len(span_text.strip())
+                prev_bbox = bbox
+
+            if not text.strip():
+                continue
+            direction = line.get('dir', (1, 0))
+            lines.append({
+                'text': text.strip(),
+                'bbox': list(line.get('bbox', (0, 0, 0, 0))),
+                'sizes': sizes,
+                'size': max(sizes, key=sizes.get) if sizes else 12,
+                'block': block_no,
+                'horizontal': abs(direction[1]) < 0.1
+            })
+    return lines
+
+
+def can_merge_line(para, line):
+    """判断一行是否是段落的下一行"""
+    last = para['lines'][-1]
+    size = max(last['size'], line['size'])
+
+    if not last['horizontal'] or not line['horizontal']:
+        return False
+    if len(para['text']) + len(line['text']) > PARAGRAPH_MAX_CHARS:
+        return False
+
+    # 字号相近
+    if max(last['size'], line['size']) > min(last['size'], line['size']) * 1.25:
+        return False
+
+    # 行距正常（允许轻微重叠）
+    gap = line['bbox'][1] - last['bbox'][3]
+    if gap < -size * 0.5 or gap > size * 0.9:
+        return False
+
+    # 同一栏：水平区间大部分重叠
+    overlap = min(last['bbox'][2], line['bbox'][2]) - max(last['bbox'][0], line['bbox'][0])
+    narrower = min(last['bbox'][2] - last['bbox'][0], line['bbox'][2] - line['bbox'][0])
+    if narrower <= 0 or overlap < narrower * 0.5:
+        return False
+
+    if line['text'][0] in BULLET_CHARS and len(line['text']) > 1 and line['text'][1].isspace():
+        return False
+
+    # 原本属于不同块的行：上一行需写满且未以句末标点结束，避免把表格单元格粘在一起
+    if last['block'] != line['block']:
+        para_width = para['bbox'][2] - para['bbox'][0]
+        last_width = last['bbox'][2] - last['bbox'][0]
+        if last_width < para_width * 0.8 or last['text'][-1] in SENTENCE_END_CHARS:
+            return False
+        if last['bbox'][2] < line['bbox'][2] - size * 2:
+            return False
+
+    return True
+
+
+def order_paragraphs(paragraphs):
+    """阅读顺序（递归 XY-cut）：优先按栏间空白纵向切分，其次按段间空白横向切分"""
+    if len(paragraphs) <= 1:
+        return list(paragraphs)
+
+    for axis in (0, 1):  # 0: 纵向切分成栏（左→右）, 1: 横向切分成带（上→下）
+        groups = []
+        group_end = None
+        for para in sorted(paragraphs, key=lambda p: (p['bbox'][axis], p['bbox'][1 - axis])):
+            start, end = para['bbox'][axis], para['bbox'][axis + 2]
+            if group_end is None or start >= group_end:
+                groups.append([])
+                group_end = end
+            else:
+                group_end = max(group_end, end)
+            groups[-1].append(para)
+        if len(groups) > 1:
+            ordered = []
+            for group in groups:
+                ordered.extend(order_paragraphs(group))
+            return ordered
+
+    return sorted(paragraphs, key=lambda p: (p['bbox'][1], p['bbox'][0]))
+
+
+def build_page_segments(text_blocks):
+    """把页面文本块重建为阅读顺序的段落
+
+    返回 [{text, bbox, font_size, font_sizes, source_bboxes}]，
+    source_bboxes 为组成该段落的原始行位置。
+    """
+    lines = build_layout_lines(text_blocks)
+    paragraphs = []
+
+    for line in sorted(lines, key=lambda l: (l['bbox'][1], l['bbox'][0])):
+        candidates = [p for p in paragraphs if p['open'] and can_merge_line(p, line)]
+        if candidates:
+            para = min(candidates, key=lambda p: line['bbox'][1] - p['lines'][-1]['bbox'][3])
+            para['text'] = join_text_pieces(para['text'], line['text'])
+            para['lines'].append(line)
+            bbox = para['bbox']
+            para['bbox'] = [min(bbox[0], line['bbox'][0]), min(bbox[1], line['bbox'][1]),
+                            max(bbox[2], line['bbox'][2]), max(bbox[3], line['bbox'][3])]
+        else:
+            para = {'text': line['text'], 'lines': [line], 'bbox': list(line['bbox']), 'open': True}
+            paragraphs.append(para)
+
+        # 已经被新行越过的段落不再接收后续行
+        for p in paragraphs:
+            if p is not para and p['open'] and line['bbox'][1] - p['bbox'][3] > line['size'] * 2:
+                p['open'] = False
+
+    segments = []
+    for para in order_paragraphs(paragraphs):
+        sizes = {}
+        for line in para['lines']:
+            for size, count in line['sizes'].items():
+                sizes[size] = sizes.get(size, 0) + count
+        segments.append({
+            'text': para['text'],
+            'bbox': para['bbox'],
+            'font_size': max(sizes, key=sizes.get) if sizes else 12,
+            'font_sizes': sorted(sizes),
+            'source_bboxes': [line['bbox'] for line in para['lines']]
+        })
+    return segments
+
+
+# ============ OCR 识别 ============
+
+def ocr_with_ocrspace(image_base64):
+    """使用免费的 OCR.space API 识别图片文字"""
+    import urllib.request
+    import urllib.parse
+
+    api_url = 'https://api.ocr.space/parse/image'
+
+    if ',' in image_base64:
+        image_base64 = image_base64.split(',')[1]
+
+    payload = {
+        'apikey': 'helloworld',
+        'base64Image': f'data:image/png;base64,{image_base64}',
+        'language': 'chs',
+        'isOverlayRequired': 'false',
+        'detectOrientation': 'true',
+        'scale': 'true',
+        'OCREngine': '2'
+    }
+
+    data = urllib.parse.urlencode(payload).encode('utf-8')
+    req = urllib.request.Request(api_url, data=data)
+    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
+
+    result = upstream_json(req, timeout=30)
+
+    if result.get('IsErroredOnProcessing'):
+        error_msg = result.get('ErrorMessage', ['OCR 识别失败'])[0]
+        return None, error_msg
+
+    parsed_results = result.get('ParsedResults', [])
+    if not parsed_results:
+        return None, '未识别到文字'
+
+    text = parsed_results[0].get('ParsedText', '').strip()
+    if not text:
+        return None, '未识别到文字'
+
+    return text, None
+
+# 本地 OCR 进程数、单次识别的 tesseract 超时（秒）与默认识别语言
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 2))
+OCR_TIMEOUT = int(os.environ.get('OCR_TIMEOUT', 30))
+OCR_DEFAULT_LANGUAGES = 'chi_sim+eng'
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+_tesseract_langs_cache = {}  # binary -> 已安装语言集合
+
+
+def get_ocr_pool():
+    """获取本地 OCR 进程池（懒加载）"""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+        return _ocr_pool
+
+
+def reset_ocr_pool(pool):
+    """关闭出错的进程池（子进程崩溃、识别超时），下次调用时重建"""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is pool:
+            _ocr_pool = None
+    try:
+        pool.shutdown(wait=False, cancel_futures=True)
+    except Exception:
+        pass
+
+
+def find_tesseract(config=None):
+    """查找 Tesseract 可执行文件：配置路径 > PATH > Windows 默认安装位置"""
+    import shutil
+
+    config = config if config is not None else read_config()
+    candidates = [config.get('tesseract_path'), shutil.which('tesseract')]
+    if sys.platform == 'win32':
+        candidates += [
+            r'C:\Program Files\Tesseract-OCR\tesseract.exe',
+            os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Programs', 'Tesseract-OCR', 'tesseract.exe'),
+        ]
+    for path in candidates:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def tesseract_languages(binary):
+    """已安装的 Tesseract 语言包"""
+    import subprocess
+
+    if binary not in _tesseract_langs_cache:
+        try:
+            result = subprocess.run([binary, '--list-langs'], capture_output=True, timeout=10)
+            lines = result.stdout.decode('utf-8', 'ignore').splitlines()
+            _tesseract_langs_cache[binary] = {l.strip() for l in lines[1:] if l.strip()}
+        except Exception:
+            _tesseract_langs_cache[binary] = set()
+    return _tesseract_langs_cache[binary]
+
+
+def run_tesseract(binary, image_bytes, lang, timeout=30):
+    """子进程：预处理图片后调用 tesseract，返回 (text, error)"""
+    import re
+    import subprocess
+    from io import BytesIO
+    from PIL import Image
+
+    # 灰度化；截图通常分辨率偏低，放大后识别率更高
+    img = Image.open(BytesIO(image_bytes)).convert('L')
+    if max(img.size) < 1000:
+        img = img.resize((img.width * 2, img.height * 2), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = 0x08000000  # CREATE_NO_WINDOW
+
+    try:
+        result = subprocess.run(
+            [binary, 'stdin', 'stdout', '-l', lang, '--psm', '3'],
+            input=buffer.getvalue(), capture_output=True, timeout=timeout, **kwargs
+        )
+    except subprocess.TimeoutExpired:
+        return None, f'Tesseract 识别超时（{timeout} 秒）'
+    if result.returncode != 0:
+        return None, f"Tesseract 错误: {result.stderr.decode('utf-8', 'ignore').strip()[:200]}"
+
+    text = result.stdout.decode('utf-8', 'ignore').strip()
+    # 中文识别结果会在汉字之间插入空格
+    text = re.sub(r'(?<=[\u4e00-\u9fff])[ \t]+(?=[\u4e00-\u9fff])', '', text)
+    if not text:
+        return None, '未识别到文字'
+    return text, None
+
+
+def ocr_with_tesseract(image_base64):
+    """使用本地 Tesseract 识别图片文字（进程池中执行，离线可用）"""
+    config = read_config()
+    binary = find_tesseract(config)
+    if not binary:
+        return None, '未找到 Tesseract，请安装或在设置中配置路径'
+
+    # 只使用已安装的语言包
+    wanted = config.get('ocr_languages', OCR_DEFAULT_LANGUAGES).split('+')
+    installed = tesseract_languages(binary)
+    langs = [l for l in wanted if l in installed] or ['eng']
+
+    if ',' in image_base64:
+        image_base64 = image_base64.split(',')[1]
+    image_bytes = base64.b64decode(image_base64)
+
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+    from concurrent.futures.process import BrokenProcessPool
+
+    # 子进程崩溃或被杀死后进程池不可再用：重建后重试一次
+    for _ in range(2):
+        pool = get_ocr_pool()
+        try:
+            future = pool.submit(run_tesseract, binary, image_bytes, '+'.join(langs), OCR_TIMEOUT)
+            return future.result(timeout=OCR_TIMEOUT + 30)
+        except BrokenProcessPool as e:
+            print(f"OCR pool broken, recreating: {e}")
+            reset_ocr_pool(pool)
+        except FutureTimeoutError:
+            # 卡住的子进程仍占用槽位，换一个新进程池，旧进程完成后退出
+            print("OCR worker timed out, recreating pool")
+            reset_ocr_pool(pool)
+            return None, 'OCR 识别超时'
+    return None, '本地 OCR 进程异常退出'
+
+
+# 可选 OCR 引擎：name -> fn(image_base64) -> (text, error)
+OCR_BACKENDS = {
+    'ocrspace': ocr_with_ocrspace,
+    'tesseract': ocr_with_tesseract,
+}
+
+
+def get_ocr_backend(config=None):
+    """按配置选择 OCR 引擎；auto 时优先使用本地 Tesseract"""
+    config = config if config is not None else read_config()
+    name = config.get('ocr_backend', 'auto')
+    if name == 'auto':
+        return 'tesseract' if find_tesseract(config) else 'ocrspace'
+    return name if name in OCR_BACKENDS else 'ocrspace'
+
+
+def run_ocr(image_base64, config=None):
+    """使用配置的 OCR 引擎识别，返回 (text, error, engine)"""
+    config = config if config is not None else read_config()
+    engine = get_ocr_backend(config)
+
+    try:
+        text, error = OCR_BACKENDS[engine](image_base64)
+    except Exception as e:
+        text, error = None, str(e)
+
+    # auto 模式下本地引擎异常时退回在线 OCR
+    if error and error != '未识别到文字' and engine != 'ocrspace' and config.get('ocr_backend', 'auto') == 'auto':
+        print(f"OCR engine {engine} failed, falling back to ocrspace: {error}")
+        engine = 'ocrspace'
+        text, error = ocr_with_ocrspace(image_base64)
+
+    return text, error, engine
+
+
+@app.route('/api/ocr', methods=['POST'])
+def ocr():
+    """OCR 识别截图"""
+    data = request.get_json()
+    image_data = data.get('image', '')
+    model = data.get('model', 'free')
+
+    if not image_data:
+        return jsonify({'success': False, 'error': '没有图片数据'})
+
+    try:
+        if model == 'doubao':
+            config = read_config()
+            api_key = config.get('doubao_api_key')
+            endpoint_id = config.get('doubao_endpoint_id')
+
+            if not api_key or not endpoint_id:
+                return jsonify({'success': False, 'error': '未配置豆包 API'})
+
+            ocr_text, ocr_error = ocr_with_doubao_vision(image_data, api_key, endpoint_id)
+            engine = 'doubao'
+        else:
+            config = read_config()
+            scope = f"ocr|{get_ocr_backend(config)}|{config.get('ocr_languages', OCR_DEFAULT_LANGUAGES)}"
+            ocr_text, ocr_error, engine = cached_image_call(
+                scope, image_data, lambda: run_ocr(image_data, config),
+                ok=lambda result: bool(result[0]) and not result[1]
+            )
+
+        if ocr_error:
+            return jsonify({'success': False, 'error': ocr_error, 'engine': engine})
+
+        return jsonify({'success': True, 'text': ocr_text, 'engine': engine})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+# ============ 免译预筛 ============
+#
+# 发送翻译请求前先对段落分类，以下段落原样保留、不占用请求：纯数字/符号（页码、数值表格）、
+# URL、邮箱、代码、已是目标语言的文字，以及只由词汇表“保持原文”术语（原文与译文相同，
+# 如 API）组成的段落。分类只用正则和字符统计，每段为微秒级。
+
+SKIP_URL_RE = re.compile(r'^(?:https?://|ftp://|www\.)\S+$', re.IGNORECASE)
+SKIP_EMAIL_RE = re.compile(r'^[\w.+-]+@[\w-]+(?:\.[\w-]+)+$')
+SKIP_NUMBER_TOKEN_RE = re.compile(r'^[^\w]*(?:[A-Za-z]{1,3}[\s.]?)?[-+]?\d[\d.,:/%-]*(?:[A-Za-z]{1,3}|%)?[^\w]*$')
+SKIP_CODE_TOKEN_RES = [
+    re.compile(r'^[A-Za-z_][\w.]*\(.*\)[;,]?$'),                # 函数调用
+    re.compile(r'^[a-z0-9]+(?:_[a-z0-9]+)+$'),                  # snake_case
+    re.compile(r'^[a-z]+(?:[A-Z][a-z0-9]*)+$'),                 # camelCase
+    re.compile(r'^[A-Za-z_]\w+(?:\.[A-Za-z_]\w+)+$'),           # 模块/属性/文件名
+    re.compile(r'^(?:[A-Za-z]:\\|\.{0,2}/)[\w.\\/-]+$'),        # 路径
+    re.compile(r'^--?[a-z][\w-]*(?:=\S*)?$'),                   # 命令行参数
+]
+# 整行代码需要结构证据：关键字后接代码结构、整行调用、赋值语句、含标识符的花括号块，或运算符
+# 密度高；行尾分号、单个箭头/比较符在要点列表和幻灯片文字中很常见，单独出现不算代码
+SKIP_CODE_KEYWORD_RE = re.compile(
+    r'^\s*(?:(?:def|function|func|fn)\s+[A-Za-z_]\w*\s*\('
+    r'|class\s+[A-Za-z_]\w*\s*[:({]'
+    r'|import\s+[\w.]+(?:\s+as\s+\w+)?(?:\s*,\s*[\w.]+)*\s*;?\s*$'
+    r'|from\s+[\w.]+\s+import\s+[\w.*, ]+$'
+    r'|(?:const|let|var)\s+[A-Za-z_$][\w$]*\s*[=:;]'
+    r'|(?:public|private|protected|static)\s+[\w<>\[\], ]*[\w>\]]\s+[A-Za-z_]\w*\('
+    r'|(?:if|elif|while|switch)\s*\(.*\)\s*[:{]?\s*$'
+    r'|for\s+[A-Za-z_]\w*(?:\s*,\s*[A-Za-z_]\w*)*\s+in\s+\S+\s*:\s*$'
+    r'|return\b.*;\s*$'
+    r'|#include\s*[<"])'
+)
+SKIP_CODE_CALL_LINE_RE = re.compile(r'^\s*(?:await\s+)?[A-Za-z_$][\w$.]*\((?:[^()]|\([^()]*\))*\)\s*;?\s*$')
+SKIP_CODE_CALL_RE = re.compile(r'[A-Za-z_$][\w$.]*\([^()]*\)')
+SKIP_CODE_ASSIGN_RE = re.compile(r'^\s*([A-Za-z_$][\w$.]*(?:\[[^\]]*\])?)\s*([-+*/%|&]?=)(?!=)\s*(\S.*)$')
+SKIP_CODE_BLOCK_RE = re.compile(r'\{[^{}]*[A-Za-z_]\w*[^{}]*[;=:][^{}]*\}')
+# 箭头和括号在文字中也常见，不计入运算符密度；比较符和分号也可能出现在文字中，密度判断还需
+# 至少一个只在代码中出现的运算符
+SKIP_CODE_OPERATOR_RE = re.compile(r'->|=>|==|!=|<=|>=|&&|\|\||::|\+\+|--|[-+*/%]=|[{}\[\]=<>;]')
+SKIP_CODE_STRONG_OPERATORS = frozenset(['==', '!=', '&&', '||', '::', '++', '--', '+=', '-=', '*=', '/=', '%=',
+                                        '{', '}', '[', ']'])
+SKIP_IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*')
+SKIP_WORD_RE = re.compile(r'[A-Za-z]{2,}')
+
+_glossary_keep_cache = {}  # (mtime_ns, size) -> 保持原文的术语（小写）
+
+
+def glossary_keep_terms():
+    """词汇表中原文与译文相同的术语（如 API），按文件 mtime 缓存"""
+    try:
+        stat = os.stat(GLOSSARY_PATH)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stamp = None
+    if stamp in _glossary_keep_cache:
+        return _glossary_keep_cache[stamp]
+
+    terms = frozenset(
+        t['source'].strip().lower() for t in load_glossary().get('glossary', [])
+        if t.get('source', '').strip() and t['source'].strip().lower() == t.get('target', '').strip().lower()
+    )
+    _glossary_keep_cache.clear()
+    _glossary_keep_cache[stamp] = terms
+    return terms
+
+
+def is_code_token(token):
+    return any(pattern.match(token) for pattern in SKIP_CODE_TOKEN_RES)
+
+
+def is_code_line(text):
+    """整行是否为代码（见 SKIP_CODE_KEYWORD_RE 上方说明）"""
+    if SKIP_CODE_KEYWORD_RE.match(text) or SKIP_CODE_CALL_LINE_RE.match(text):
+        return True
+    if SKIP_CODE_BLOCK_RE.search(text):
+        return True
+    if text.endswith('{') and SKIP_CODE_CALL_RE.search(text):
+        return True
+
+    assign = SKIP_CODE_ASSIGN_RE.match(text)
+    if assign:
+        target, operator, value = assign.groups()
+        # "Margin = 20%;" 这类首字母大写的标签按文字处理
+        if operator != '=' or SKIP_CODE_CALL_RE.search(value) or (text.endswith(';') and not target[0].isupper()):
+            return True
+
+    operators = [op for op in SKIP_CODE_OPERATOR_RE.findall(text) if op not in ('->', '=>')]
+    return (len(operators) >= 3 and len(operators) * 2 >= len(SKIP_IDENTIFIER_RE.findall(text))
+            and any(op in SKIP_CODE_STRONG_OPERATORS for op in operators))
+
+
+def classify_skip_segment(text, direction, keep_terms=frozenset()):
+    """判断段落是否免译，返回原因（numeric/url/email/glossary/code/target_language），需要翻译时返回 None"""
+    text = text.strip()
+    if not any(ch.isalpha() for ch in text):
+        return 'numeric'
+
+    tokens = text.split()
+    if all(SKIP_URL_RE.match(t) for t in tokens):
+        return 'url'
+    if all(SKIP_EMAIL_RE.match(t.strip('<>()[],;')) for t in tokens):
+        return 'email'
+    if all(SKIP_NUMBER_TOKEN_RE.match(t) for t in tokens):
+        return 'numeric'
+
+    if keep_terms:
+        lowered = text.lower().strip('.,:;!?()[]"\'')
+        if lowered in keep_terms:
+            return 'glossary'
+        words = SKIP_WORD_RE.findall(text)
+        if words and all(w.lower() in keep_terms for w in words) and not any(is_cjk(ch) for ch in text):
+            return 'glossary'
+
+    if len(tokens) == 1 and is_code_token(tokens[0]):
+        return 'code'
+    if is_code_line(text):
+        return 'code'
+
+    cjk = sum(1 for ch in text if is_cjk(ch))
+    words = [w for w in SKIP_WORD_RE.findall(text) if w.lower() not in keep_terms]
+    if direction == 'en2zh':
+        # 中文为主（夹杂少量英文术语）
+        if cjk and len(words) * 2 <= cjk:
+            return 'target_language'
+    elif not cjk and words:
+        return 'target_language'
+    return None
+
+
+def classify_skip_segments(texts, direction):
+    """批量分类，返回 {序号: 原因}（只含免译的段落）"""
+    keep_terms = glossary_keep_terms()
+    skips = {}
+    for i, text in enumerate(texts):
+        reason = classify_skip_segment(text, direction, keep_terms)
+        if reason:
+            skips[i] = reason
+    return skips
+
+
+# ============ 模糊翻译记忆 ============
+#
+# 翻译成功的段落按语言方向写入翻译记忆 tm_segments，并建 MinHash LSH 索引 tm_bands：文本
+# 归一化后取字符 3-gram，单次哈希分桶（one permutation hashing，空桶从右侧非空桶补齐）得到
+# 32 维签名，每 4 维一个 band，任一 band 相同即为候选。只使用与当前词汇表签名一致的记忆（词汇表
+# 变化前的译文不会把模型带回旧术语）。归一化原文完全相同且数字一致时直接复用译文，不再请求；
+# 其余候选用 difflib 计算相似度，达到 TM_REFERENCE_SIMILARITY 时只作为参考译文随请求发送 ——
+# 一两个字的差别（available / unavailable、is / is not）相似度仍在 0.98 以上，不能直接复用。
+# 查找按整批段落进行：一次按原文键精确匹配，其余段落的全部 band 一次取出倒排（写入时每个 band
+# 只保留最近的 TM_BAND_POSTINGS 条），候选条目再一次读取，计票和打分在内存中完成。每段耗时见
+# benchmarks/bench_translation_memory.py（合成数据，每批 40 段：100 万条记忆近似命中 p50 约 0.8ms、
+# 未命中约 0.7ms，200 万条约 0.4ms；精确命中约 0.03ms）。
+
+TRANSLATION_MEMORY = os.environ.get('TRANSLATION_MEMORY', '1') != '0'
+TM_REFERENCE_SIMILARITY = float(os.environ.get('TM_REFERENCE_SIMILARITY', 0.75))
+TM_REUSE_SIMILARITY = float(os.environ.get('TM_REUSE_SIMILARITY', 1.0))  # 默认只复用完全相同的原文
+TM_MAX_SEGMENTS = int(os.environ.get('TM_MAX_SEGMENTS', 2000000))  # 超出后淘汰最早写入的
+TM_MIN_CHARS = 4
+TM_SHINGLE = 3
+TM_BINS = 32
+TM_BAND_ROWS = 4
+TM_BAND_POSTINGS = 32  # 每个 band 最多读取的条目
+TM_MAX_CANDIDATES = 8
+TM_MIN_JACCARD = 0.4  # 粗筛阈值
+TM_VERIFY_CANDIDATES = 3  # 计算编辑相似度的候选数
+TM_MAX_REFERENCES = 20  # 单次请求附带的参考译文上限
+TM_LOOKUP_CHUNK = 900  # 单条查询的参数个数上限（低于旧版 SQLite 的 999）
+TM_NUMBER_RE = re.compile(r'\d+(?:[.,:]\d+)*')
+
+
+def tm_normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def tm_signature(key):
+    """字符 3-gram 的 MinHash 签名（单次哈希分桶）"""
+    import zlib
+
+    signature = [None] * TM_BINS
+    for shingle in tm_shingles(key):
+        h = zlib.crc32(shingle.encode('utf-8'))
+        b = h % TM_BINS
+        v = h // TM_BINS
+        if signature[b] is None or v < signature[b]:
+            signature[b] = v
+
+    # 空桶取右侧最近的非空桶，并带上距离，保证签名仍可比较
+    filled = list(signature)
+    for b in range(TM_BINS):
+        if signature[b] is None:
+            for distance in range(1, TM_BINS):
+                v = signature[(b + distance) % TM_BINS]
+                if v is not None:
+                    filled[b] = v * TM_BINS + distance
+                    break
+    return filled
+
+
+def tm_band_keys(direction, key):
+    import hashlib
+
+    signature = tm_signature(key)
+    keys = []
+    for band in range(0, TM_BINS, TM_BAND_ROWS):
+        raw = f'{direction}|{band}|{signature[band:band + TM_BAND_ROWS]}'.encode('utf-8')
+        keys.append(int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'big', signed=True))
+    return keys
+
+
+def tm_shingles(key):
+    padded = f' {key} '
+    return {padded[i:i + TM_SHINGLE] for i in range(max(1, len(padded) - TM_SHINGLE + 1))}
+
+
+def tm_similarity(a, b):
+    from difflib import SequenceMatcher
+
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    if matcher.real_quick_ratio() < TM_REFERENCE_SIMILARITY or matcher.quick_ratio() < TM_REFERENCE_SIMILARITY:
+        return 0.0
+    return matcher.ratio()
+
+
+def tm_query_in(conn, sql, params, values, chunk=TM_LOOKUP_CHUNK):
+    """sql 中的 {} 替换为 values 的 IN 占位符执行，返回全部行（按 chunk 分批，不超过 SQLite 变量数上限）"""
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), chunk):
+        part = values[start:start + chunk]
+        rows.extend(conn.execute(sql.format(','.join('?' * len(part))), params + part).fetchall())
+    return rows
+
+
+def tm_lookup(texts, direction):
+    """为每段查找最相似的翻译记忆，返回 {序号: (相似度, 原文, 译文, 可直接复用)}
+
+    整批段落合并查询：一次按原文键精确匹配，其余段落的 band 一次取出倒排，候选条目再一次读取，
+    打分在内存中完成。
+    """
+    from collections import Counter
+
+    conn = get_db()
+    signature = glossary_signature()
+    keys = {}
+    for i, text in enumerate(texts):
+        key = tm_normalize(text)
+        if len(key) >= TM_MIN_CHARS:
+            keys[i] = key
+    if not keys:
+        return {}
+
+    exact = {row['key']: row for row in tm_query_in(
+        conn, 'SELECT key, source, target FROM tm_segments WHERE direction = ? AND glossary = ? AND key IN ({})',
+        [direction, signature], set(keys.values()))}
+    best = {i: (1.0, exact[key]) for i, key in keys.items() if key in exact}
+
+    fuzzy_keys = [key for key in dict.fromkeys(keys.values()) if key not in exact]
+    if fuzzy_keys:
+        key_bands = {key: tm_band_keys(direction, key) for key in fuzzy_keys}
+        # 写入时每个 band 只保留最近的 TM_BAND_POSTINGS 条，整批的倒排一次取出
+        postings = {band: list(map(int, ids.split(','))) for band, ids in tm_query_in(
+            conn, 'SELECT band, group_concat(segment_id) FROM tm_bands WHERE band IN ({}) GROUP BY band', [],
+            {band for bands in key_bands.values() for band in bands})}
+
+        # 按命中 band 数取候选
+        key_ids = {}
+        for key, bands in key_bands.items():
+            votes = Counter()
+            for band in bands:
+                votes.update(postings.get(band, ()))
+            if votes:
+                key_ids[key] = [segment_id for segment_id, _ in votes.most_common(TM_MAX_CANDIDATES)]
+
+        rows = {row['id']: row for row in tm_query_in(
+            conn, 'SELECT id, key, source, target FROM tm_segments WHERE glossary = ? AND id IN ({})',
+            [signature], {segment_id for ids in key_ids.values() for segment_id in ids})}
+        key_candidates = {key: [rows[segment_id] for segment_id in ids if segment_id in rows]
+                          for key, ids in key_ids.items()}
+
+        key_best = {}
+        candidate_shingles = {}  # 常见候选在多段之间共用
+        for key, rows in key_candidates.items():
+            # 先按 3-gram Jaccard 粗筛，只对最接近的几条计算编辑相似度
+            shingles = tm_shingles(key)
+            scored = []
+            for candidate in rows:
+                other = candidate_shingles.get(candidate['id'])
+                if other is None:
+                    other = candidate_shingles[candidate['id']] = tm_shingles(candidate['key'])
+                jaccard = len(shingles & other) / len(shingles | other)
+                if jaccard >= TM_MIN_JACCARD:
+                    scored.append((jaccard, candidate))
+            scored.sort(key=lambda item: item[0], reverse=True)
+
+            result = (0.0, None)
+            for _, candidate in scored[:TM_VERIFY_CANDIDATES]:
+                similarity = tm_similarity(key, candidate['key'])
+                if similarity > result[0]:
+                    result = (similarity, candidate)
+            key_best[key] = result
+
+        for i, key in keys.items():
+            if key in key_best:
+                best[i] = key_best[key]
+
+    matches = {}
+    for i, (similarity, row) in best.items():
+        if row is None or similarity < TM_REFERENCE_SIMILARITY:
+            continue
+        text = texts[i]
+        reusable = (similarity >= TM_REUSE_SIMILARITY
+                    and TM_NUMBER_RE.findall(text) == TM_NUMBER_RE.findall(row['source']))
+        matches[i] = (similarity, row['source'], row['target'], reusable)
+    return matches
+
+
+def tm_add(pairs, direction):
+    """写入翻译记忆 [(原文, 译文)]；同一原文以最新译文为准"""
+    import time
+
+    rows = {}
+    for source, target in pairs:
+        key = tm_normalize(source)
+        if len(key) >= TM_MIN_CHARS and target.strip():
+            rows[key] = (source.strip(), target.strip())
+    if not rows:
+        return
+
+    signature = glossary_signature()
+    touched = set()
+    with db_transaction() as conn:
+        now = time.time()
+        for key, (source, target) in rows.items():
+            conn.execute('DELETE FROM tm_segments WHERE direction = ? AND key = ?', (direction, key))
+            cursor = conn.execute(
+                'INSERT INTO tm_segments (direction, key, source, target, glossary, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (direction, key, source, target, signature, now)
+            )
+            bands = tm_band_keys(direction, key)
+            conn.executemany('INSERT INTO tm_bands (band, segment_id) VALUES (?, ?)',
+                             [(band, cursor.lastrowid) for band in bands])
+            touched.update(bands)
+        # 每个 band 只保留最近写入的 TM_BAND_POSTINGS 条，查询时可一次取出全部倒排
+        conn.executemany(
+            'DELETE FROM tm_bands WHERE band = ? AND rowid < (SELECT MIN(rowid) FROM '
+            '(SELECT rowid FROM tm_bands WHERE band = ? ORDER BY rowid DESC LIMIT ?))',
+            [(band, band, TM_BAND_POSTINGS) for band in touched]
+        )
+        conn.execute('DELETE FROM tm_segments WHERE id <= (SELECT MAX(id) FROM tm_segments) - ?', (TM_MAX_SEGMENTS,))
+
+
+def build_reference_text(references):
+    """相似段落的已有译文，随翻译请求发送"""
+    return "\n\n".join(f"原文: {source}\n译文: {target}" for source, target in references)
+
+
+# ============ 跨页批量翻译 ============
+#
+# 翻译请求按 token 预算打包：多页的段落按顺序装入同一个请求，直到估算 token 数达到当前
+# 预算。段落在批内的位置就是它的身份，译文拆分后按原顺序散回各页；返回的段数与请求不符时
+# 对半拆分重试，不会错位到其他段落。预算按观测到的每 token 耗时调整，使单次请求接近
+# TRANSLATE_BATCH_TARGET_SECONDS；请求失败或段数不符时减半。失败的批次逐段记录，所在页面
+# 不写入缓存，全部翻译时记为失败页、续传时重新翻译。
+
+TRANSLATE_BATCH_TOKENS = int(os.environ.get('TRANSLATE_BATCH_TOKENS', 1500))  # 初始预算
+TRANSLATE_BATCH_MIN_TOKENS = 200
+TRANSLATE_BATCH_MAX_TOKENS = int(os.environ.get('TRANSLATE_BATCH_MAX_TOKENS', 3000))  # 译文受 max_tokens 限制
+TRANSLATE_BATCH_TARGET_SECONDS = float(os.environ.get('TRANSLATE_BATCH_TARGET_SECONDS', 20))
+
+_batch_tuning = {'budget': TRANSLATE_BATCH_TOKENS, 'seconds_per_token': None}
+_batch_tuning_lock = threading.Lock()
+
+
+class TranslationFailed(Exception):
+    """翻译请求失败（见 translate_text_with_api 的 raise_errors）"""
+
+
+def estimate_text_tokens(text):
+    """粗略估算 token 数：汉字约 1 个，其他字符约 4 个一个"""
+    cjk = sum(1 for ch in text if is_cjk(ch))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def current_batch_budget():
+    with _batch_tuning_lock:
+        return _batch_tuning['budget']
+
+
+def tune_batch_budget(tokens, elapsed, ok):
+    """根据一次请求的结果调整预算：成功时按每 token 耗时（指数平滑）逼近目标时长，失败减半"""
+    with _batch_tuning_lock:
+        budget = _batch_tuning['budget']
+        if ok:
+            seconds_per_token = elapsed / max(tokens, 1)
+            previous = _batch_tuning['seconds_per_token']
+            if previous is not None:
+                seconds_per_token = previous * 0.7 + seconds_per_token * 0.3
+            _batch_tuning['seconds_per_token'] = seconds_per_token
+            budget = min(int(budget * 1.5), int(TRANSLATE_BATCH_TARGET_SECONDS / max(seconds_per_token, 1e-6)))
+        else:
+            budget //= 2
+        _batch_tuning['budget'] = max(TRANSLATE_BATCH_MIN_TOKENS, min(TRANSLATE_BATCH_MAX_TOKENS, budget))
+
+
+def next_batch_end(texts, start, budget):
+    """从 start 起装入预算内的段落，至少一段"""
+    used = 0
+    end = start
+    while end < len(texts):
+        tokens = estimate_text_tokens(texts[end])
+        if end > start and used + tokens > budget:
+            break
+        used += tokens
+        end += 1
+    return end
+
+
+def split_batch_result(result, separator):
+    """按分隔符拆分译文，容忍分隔符两侧多余的空白"""
+    import re
+
+    pattern = r'[ \t]*\n\s*' + re.escape(separator.strip()) + r'[ \t]*\n\s*'
+    return re.split(pattern, result.strip())
+
+
+def translate_batch(texts, call, separator, references=None):
+    """翻译一批段落，返回 (与 texts 等长的译文, 失败段落的序号集合)；段数不符时对半拆分重试
+
+    references 与 texts 等长，为各段的参考译文 (原文, 译文) 或 None。call 抛出 TranslationFailed
+    时整批记为失败、原样返回原文，其他异常向上抛出。
+    """
+    import time
+
+    references = references or [None] * len(texts)
+    batch_references = list(dict.fromkeys(r for r in references if r))[:TM_MAX_REFERENCES]
+    combined = separator.join(texts)
+    tokens = estimate_text_tokens(combined)
+    started = time.perf_counter()
+    try:
+        result = call(combined, batch_references) if batch_references else call(combined)
+    except TranslationFailed:
+        tune_batch_budget(tokens, 0, False)
+        return list(texts), set(range(len(texts)))
+    except Exception:
+        tune_batch_budget(tokens, 0, False)
+        raise
+
+    parts = split_batch_result(result, separator)
+    matched = len(parts) == len(texts)
+    # translate_text_with_api 失败时原样返回原文
+    tune_batch_budget(tokens, time.perf_counter() - started, matched and result.strip() != combined.strip())
+
+    if matched:
+        return [p.strip() for p in parts], set()
+    if len(texts) == 1:
+        return [result.strip()], set()
+
+    print(f"Batch returned {len(parts)} segments for {len(texts)}, splitting")
+    mid = len(texts) // 2
+    head, head_failed = translate_batch(texts[:mid], call, separator, references[:mid])
+    tail, tail_failed = translate_batch(texts[mid:], call, separator, references[mid:])
+    return head + tail, head_failed | {mid + i for i in tail_failed}
+
+
+def translate_texts_batched(texts, call, separator='\n[SEP]\n', stats=None, direction=None, skips=None,
+                            memory=None, on_batch=None, failed=None):
+    """按 token 预算打包翻译（可跨页），返回与 texts 等长的译文
+
+    call(combined_text[, references]) 发起一次翻译请求，有参考译文时才传入 references。
+    传入 direction 时先做免译预筛（也可直接传入 classify_skip_segments 的结果 skips），免译
+    段落原样返回。memory 为语言方向时查询并写入翻译记忆：原文相同的段落直接复用，相似的
+    附带参考译文。stats 传入时累计请求次数 stats['calls']、各原因的免译段数 stats['skipped']、
+    记忆复用段数 stats['memory_reused'] 和附带参考的段数 stats['memory_references']。
+    on_batch(indices, translated) 在部分段落完成时调用（免译/复用的段落先报告一次，之后每批一次），
+    调用方据此逐页保存进度。failed 传入集合时加入请求失败（原样返回原文）的段落序号，在对应的
+    on_batch 调用之前写入。
+    """
+    def counted_call(text, references=None):
+        if stats is not None:
+            stats['calls'] = stats.get('calls', 0) + 1
+        return call(text, references) if references else call(text)
+
+    if skips is None:
+        skips = classify_skip_segments(texts, direction) if direction else {}
+    if skips:
+        print(f"Skipped {len(skips)} of {len(texts)} segments")
+        if stats is not None:
+            skipped = stats.setdefault('skipped', {})
+            for reason in skips.values():
+                skipped[reason] = skipped.get(reason, 0) + 1
+
+    pending = [i for i in range(len(texts)) if i not in skips]
+    translated = list(texts)
+    references = {}
+    if memory and TRANSLATION_MEMORY and pending:
+        matches = tm_lookup([texts[i] for i in pending], memory)
+        reused = set()
+        for j, (similarity, source, target, reusable) in matches.items():
+            if reusable:
+                translated[pending[j]] = target
+                reused.add(pending[j])
+            else:
+                references[pending[j]] = (source, target)
+        pending = [i for i in pending if i not in reused]
+        if matches:
+            print(f"Translation memory: {len(reused)} reused, {len(references)} with references")
+        if stats is not None:
+            stats['memory_reused'] = stats.get('memory_reused', 0) + len(reused)
+            stats['memory_references'] = stats.get('memory_references', 0) + len(references)
+
+    if on_batch is not None and len(pending) < len(texts):
+        pending_set = set(pending)
+        on_batch([i for i in range(len(texts)) if i not in pending_set], translated)
+
+    pending_texts = [texts[i] for i in pending]
+    start = 0
+    while start < len(pending_texts):
+        end = next_batch_end(pending_texts, start, current_batch_budget())
+        batch = pending[start:end]
+        results, batch_failed = translate_batch(pending_texts[start:end], counted_call, separator,
+                                                [references.get(i) for i in batch])
+        for i, result in zip(batch, results):
+            translated[i] = result
+        batch_failed = {batch[j] for j in batch_failed}
+        if batch_failed:
+            print(f"Translation failed for {len(batch_failed)} of {len(batch)} segments")
+            if failed is not None:
+                failed.update(batch_failed)
+        if memory and TRANSLATION_MEMORY:
+            # 每批写入记忆，中途中断时已翻译的段落不再付费；失败或原样返回的段落不写入
+            tm_add([(texts[i], translated[i]) for i in batch
+                    if i not in batch_failed and translated[i].strip() != texts[i].strip()], memory)
+        if on_batch is not None:
+            on_batch(batch, translated)
+        start = end
+
+    return translated
+
+
+# ============ 上游请求调度 ============
+#
+# 所有上游 API 请求（翻译、视觉、OCR）经 upstream_json 发出，由进程内调度器分配并发槽位。
+# 请求分三类：interactive（实时翻译、截图识别/翻译）、page（单页翻译）、bulk（全部翻译、
+# 词汇表重译），由路由用 @upstream_class 标注，默认 interactive。总并发为
+# UPSTREAM_CONCURRENCY，各类别最多占用 UPSTREAM_SHARES 比例的槽位（bulk 最多一半，其余
+# 始终留给单页和实时请求）；有空闲槽位时按类别优先级分配，同级先到先得。排队每超过
+# UPSTREAM_AGING_SECONDS 提升一级，批量任务不会被持续的实时请求饿死。
+
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', 6))
+UPSTREAM_AGING_SECONDS = float(os.environ.get('UPSTREAM_AGING_SECONDS', 10))
+UPSTREAM_CLASSES = ('interactive', 'page', 'bulk')  # 优先级从高到低
+UPSTREAM_SHARES = {'interactive': 1.0, 'page': 0.75, 'bulk': 0.5}
+UPSTREAM_STATS_WINDOW = 200
+
+_upstream_cond = threading.Condition()
+_upstream_running = {cls: 0 for cls in UPSTREAM_CLASSES}
+_upstream_waiting = []  # [(序号, 类别, 入队时间)]
+_upstream_seq = [0]
+_upstream_waits = {cls: [] for cls in UPSTREAM_CLASSES}  # 最近排队等待时间（秒）
+_upstream_context = threading.local()
+
+
+def upstream_class_limit(cls):
+    return max(1, int(UPSTREAM_CONCURRENCY * UPSTREAM_SHARES[cls]))
+
+
+def upstream_rank(ticket, now):
+    """有效优先级（越小越优先）：类别优先级减去排队时间带来的提升"""
+    seq, cls, enqueued = ticket
+    return max(0, UPSTREAM_CLASSES.index(cls) - int((now - enqueued) / UPSTREAM_AGING_SECONDS)), seq
+
+
+def upstream_can_start(ticket):
+    """调用方持有 _upstream_cond：槽位有空且 ticket 是可启动请求中优先级最高的"""
+    import time
+
+    if sum(_upstream_running.values()) >= UPSTREAM_CONCURRENCY:
+        return False
+    eligible = [t for t in _upstream_waiting if _upstream_running[t[1]] < upstream_class_limit(t[1])]
+    if ticket not in eligible:
+        return False
+    now = time.monotonic()
+    return min(eligible, key=lambda t: upstream_rank(t, now)) is ticket
+
+
+@contextmanager
+def upstream_slot(cls, job=None):
+    """取得一个上游并发槽位，按类别份额、优先级和排队时间调度；job 被取消时放弃排队"""
+    import time
+
+    with _upstream_cond:
+        _upstream_seq[0] += 1
+        ticket = (_upstream_seq[0], cls, time.monotonic())
+        _upstream_waiting.append(ticket)
+        # 定时重新评估，使排队时间带来的提升及时生效
+        while not upstream_can_start(ticket):
+            if job_cancelled(job):
+                _upstream_waiting.remove(ticket)
+                _upstream_cond.notify_all()
+                raise JobCancelled()
+            _upstream_cond.wait(timeout=max(UPSTREAM_AGING_SECONDS / 4, 0.05))
+        _upstream_waiting.remove(ticket)
+        _upstream_running[cls] += 1
+        append_sample(_upstream_waits[cls], time.monotonic() - ticket[2], UPSTREAM_STATS_WINDOW)
+        _upstream_cond.notify_all()
+    try:
+        yield
+    finally:
+        with _upstream_cond:
+            _upstream_running[cls] -= 1
+            _upstream_cond.notify_all()
+
+
+def current_upstream_class():
+    return getattr(_upstream_context, 'cls', 'interactive')
+
+
+def upstream_class(cls):
+    """路由装饰器：请求期间发出的上游请求归入 cls 类别"""
+    import functools
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            previous = current_upstream_class()
+            _upstream_context.cls = cls
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _upstream_context.cls = previous
+        return wrapper
+    return decorator
+
+
+def upstream_json(req, timeout, opener=None):
+    """发出上游请求并解析 JSON 响应（先按当前请求类别排队取得并发槽位）
+
+    属于可取消任务的请求在任务取消时抛出 JobCancelled（进行中的连接会被关闭）。
+    """
+    import urllib.request
+
+    job = current_job()
+    if job is None:
+        with upstream_slot(current_upstream_class()):
+            open_url = opener.open if opener is not None else urllib.request.urlopen
+            with open_url(req, timeout=timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+
+    check_job_cancelled()
+    opener = opener or urllib.request.build_opener()
+    connections = []
+    for handler in job_connection_handlers(job, connections):
+        opener.add_handler(handler)
+    try:
+        with upstream_slot(current_upstream_class(), job):
+            with opener.open(req, timeout=timeout) as response:
+                result = json.loads(response.read().decode('utf-8'))
+    except Exception:
+        check_job_cancelled()
+        raise
+    finally:
+        with job['lock']:
+            job['connections'].difference_update(connections)
+    check_job_cancelled()
+    return result
+
+
+@app.route('/api/upstream/stats', methods=['GET'])
+def upstream_stats():
+    """上游请求调度统计：各类别运行中/排队数、上限和排队等待 p50/p95"""
+    with _upstream_cond:
+        waiting = [t[1] for t in _upstream_waiting]
+        classes = {
+            cls: {
+                'running': _upstream_running[cls],
+                'waiting': waiting.count(cls),
+                'limit': upstream_class_limit(cls),
+                'wait_ms_p50': percentile_ms(list(_upstream_waits[cls]), 50),
+                'wait_ms_p95': percentile_ms(list(_upstream_waits[cls]), 95)
+            }
+            for cls in UPSTREAM_CLASSES
+        }
+    return jsonify({'success': True, 'concurrency': UPSTREAM_CONCURRENCY, 'classes': classes})
+
+
+# ============ 翻译任务取消 ============
+#
+# 全部翻译 / 词汇表重译等长请求登记为任务（translation_jobs 表，多个 gunicorn worker 共享）。
+# 客户端可在请求中带 job_id，随后 POST /api/jobs/cancel 取消；后台监视线程每隔
+# JOB_WATCH_INTERVAL 秒检查客户端连接是否已断开（关闭页面、刷新）以及任务是否已被标记取消。
+# 取消后排队中的上游请求立即放弃，进行中的上游连接被关闭，处理流程在下一个检查点抛出
+# JobCancelled 结束请求；已完成的页面照常保存，并记录在任务中。任务的已完成/失败页面每页
+# 写入，进程被超时或重启终止后，全部翻译可带 resume 续传。
+
+JOB_WATCH_INTERVAL = float(os.environ.get('JOB_WATCH_INTERVAL', 0.5))
+
+_jobs = {}  # job_id -> 运行中的任务
+_jobs_lock = threading.Lock()
+
+
+class JobCancelled(BaseException):
+    """任务已取消（继承 BaseException，不会被翻译函数中的 except Exception 吞掉）"""
+
+
+def current_job():
+    return getattr(_upstream_context, 'job', None)
+
+
+def job_cancelled(job):
+    return job is not None and job['cancel'].is_set()
+
+
+def check_job_cancelled():
+    """检查点：当前任务已取消时抛出 JobCancelled"""
+    if job_cancelled(current_job()):
+        raise JobCancelled()
+
+
+def job_page_done(page, ok=True):
+    """记录当前任务的页面进度（每页写入，进程中断后可据此续传）：ok 为已完成（已保存），否则为失败"""
+    import time
+
+    job = current_job()
+    if job is None:
+        return
+    if ok:
+        job['completed'].append(page)
+        job['failed'].discard(page)
+    else:
+        job['failed'].add(page)
+    conn = get_db()
+    conn.execute(
+        'UPDATE translation_jobs SET completed = ?, failed = ?, updated = ? WHERE job_id = ?',
+        (json.dumps(sorted(set(job['completed']))), json.dumps(sorted(job['failed'])), time.time(), job['id'])
+    )
+
+
+def last_job_progress(file_id, kind, direction):
+    """同一文档、同一语言方向上一次任务（可能因超时/重启中断）的 (已完成页面, 失败页面)"""
+    job = current_job()
+    row = get_db().execute(
+        'SELECT completed, failed FROM translation_jobs WHERE file_id = ? AND kind = ? AND direction = ? '
+        'AND job_id != ? ORDER BY started DESC LIMIT 1',
+        (file_id, kind, direction, job['id'] if job else '')
+    ).fetchone()
+    if row is None:
+        return set(), set()
+    return set(json.loads(row['completed'])), set(json.loads(row['failed']))
+
+
+def cancel_job(job, reason):
+    """取消任务：唤醒排队中的上游请求，关闭进行中的上游连接"""
+    import socket
+
+    if job['cancel'].is_set():
+        return
+    job['reason'] = reason
+    job['cancel'].set()
+    with _upstream_cond:
+        _upstream_cond.notify_all()
+    with job['lock']:
+        connections = list(job['connections'])
+    for conn in connections:
+        try:
+            if conn.sock is not None:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    print(f"Job {job['id']} cancelled ({reason})")
+
+
+def job_connection_handlers(job, connections):
+    """记录任务发出的上游连接，取消时可从其他线程关闭"""
+    import http.client
+    import urllib.request
+
+    def tracked(connection_class):
+        def connect(host, **kwargs):
+            if job['cancel'].is_set():
+                raise JobCancelled()
+            conn = connection_class(host, **kwargs)
+            with job['lock']:
+                job['connections'].add(conn)
+            connections.append(conn)
+            return conn
+        return connect
+
+    class JobHTTPHandler(urllib.request.HTTPHandler):
+        handler_order = 499  # 先于默认处理器
+
+        def http_open(self, req):
+            return self.do_open(tracked(http.client.HTTPConnection), req)
+
+    class JobHTTPSHandler(urllib.request.HTTPSHandler):
+        handler_order = 499
+
+        def https_open(self, req):
+            return self.do_open(tracked(http.client.HTTPSConnection), req, context=self._context)
+
+    return [JobHTTPHandler(), JobHTTPSHandler()]
+
+
+def client_disconnected(sock):
+    """客户端是否已关闭连接（等待响应期间连接上出现 EOF）"""
+    import select
+    import socket
+
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # 已关闭的套接字或 TLS 套接字不支持 MSG_PEEK，无法判断
+        return False
+    except OSError:
+        return True
+
+
+def watch_job(job, sock):
+    """监视线程：客户端断开或任务被（其他进程）标记取消时取消任务"""
+    while not job['done'].wait(JOB_WATCH_INTERVAL):
+        if sock is not None and client_disconnected(sock):
+            cancel_job(job, 'disconnected')
+            return
+        try:
+            row = get_db().execute('SELECT status FROM translation_jobs WHERE job_id = ?', (job['id'],)).fetchone()
+        except sqlite3.Error:
+            continue
+        if row is not None and row['status'] == 'cancelling':
+            cancel_job(job, 'cancelled')
+            return
+
+
+def start_job(kind, file_id, job_id, direction, environ):
+    import time
+
+    if not job_id or not str(job_id).isalnum() or len(job_id) > 64:
+        job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'kind': kind,
+        'file_id': file_id,
+        'cancel': threading.Event(),
+        'done': threading.Event(),
+        'reason': None,
+        'completed': [],
+        'failed': set(),
+        'connections': set(),
+        'lock': threading.Lock()
+    }
+    now = time.time()
+    # 文档不存在时不登记（路由随后返回错误）
+    with db_transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO translation_jobs (job_id, file_id, kind, direction, status, completed, started, updated) "
+            "SELECT ?, ?, ?, ?, 'running', '[]', ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE file_id = ?)",
+            (job_id, file_id, kind, direction, now, now, file_id)
+        )
+    with _jobs_lock:
+        _jobs[job_id] = job
+
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    threading.Thread(target=watch_job, args=(job, sock), name=f'job-{job_id}', daemon=True).start()
+    return job
+
+
+def finish_job(job, status):
+    import time
+
+    job['done'].set()
+    with _jobs_lock:
+        _jobs.pop(job['id'], None)
+    conn = get_db()
+    conn.execute(
+        'UPDATE translation_jobs SET status = ?, reason = ?, updated = ? WHERE job_id = ?',
+        (status, job['reason'], time.time(), job['id'])
+    )
+
+
+def translation_job(kind, default_direction=None):
+    """路由装饰器：请求登记为可取消的任务（语言方向缺省为路由的默认值）；取消时返回已完成的页面"""
+    import functools
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            job = start_job(kind, data.get('file_id', ''), data.get('job_id'), data.get('direction', default_direction),
+                            request.environ)
+            _upstream_context.job = job
+            try:
+                response = fn(*args, **kwargs)
+                finish_job(job, 'cancelled' if job_cancelled(job) else 'finished')
+                return response
+            except JobCancelled:
+                finish_job(job, 'cancelled')
+                return jsonify({
+                    'success': False,
+                    'cancelled': True,
+                    'error': '翻译已取消',
+                    'job_id': job['id'],
+                    'completed_pages': sorted(set(job['completed'])),
+                    'failed_pages': sorted(job['failed'])
+                })
+            except BaseException:
+                finish_job(job, 'failed')
+                raise
+            finally:
+                _upstream_context.job = None
+        return wrapper
+    return decorator
+
+
+@app.route('/api/jobs/cancel', methods=['POST'])
+def jobs_cancel():
+    """取消任务：按 job_id，或取消 file_id 下所有运行中的任务"""
+    import time
+
+    data = request.get_json(silent=True) or {}
+    job_id = data.get('job_id', '')
+    file_id = data.get('file_id', '')
+    if not job_id and not file_id:
+        return jsonify({'success': False, 'error': '缺少 job_id 或 file_id'})
+
+    with _jobs_lock:
+        local = [job for job in _jobs.values() if job['id'] == job_id or (file_id and job['file_id'] == file_id)]
+    for job in local:
+        cancel_job(job, 'cancelled')
+
+    # 其他 worker 中的任务由其监视线程发现标记后取消
+    with db_transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE translation_jobs SET status = 'cancelling', updated = ? "
+            "WHERE status = 'running' AND (job_id = ? OR file_id = ?)",
+            (time.time(), job_id, file_id)
+        )
+    return jsonify({'success': True, 'cancelled': max(len(local), cursor.rowcount)})
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def jobs_status(job_id):
+    """任务状态与已完成的页面"""
+    row = get_db().execute('SELECT * FROM translation_jobs WHERE job_id = ?', (job_id,)).fetchone()
+    if row is None:
+        return jsonify({'success': False, 'error': '任务不存在'})
+    return jsonify({
+        'success': True,
+        'job_id': row['job_id'],
+        'file_id': row['file_id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'direction': row['direction'],
+        'reason': row['reason'],
+        'completed_pages': json.loads(row['completed']),
+        'failed_pages': json.loads(row['failed'])
+    })
+
+
+# ============ 翻译功能 ============
+
+# ============ 视觉请求图片预处理 ============
+#
+# 上传给视觉模型前裁掉空白边距、限制长边、可选灰度并重新编码，
+# 减少请求体积与图片 token 数。
+
+VISION_DEFAULT_MAX_EDGE = 1600
+VISION_TRIM_PADDING = 8
+VISION_TRIM_THRESHOLD = 24
+
+
+def estimate_image_tokens(width, height):
+    """估算视觉模型的图片 token 数（按 28x28 像素块计）"""
+    return -(-width // 28) * -(-height // 28)
+
+
+def flatten_image(img):
+    """转为 RGB，透明背景铺白"""
+    from PIL import Image
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def content_bbox(gray):
+    """灰度图中与左上角背景色不同的内容区域，全为背景时返回 None"""
+    from PIL import Image, ImageChops
+
+    background_value = gray.getpixel((0, 0))
+    mask = ImageChops.difference(gray, Image.new('L', gray.size, background_value))
+    return mask.point(lambda v: 255 if v > VISION_TRIM_THRESHOLD else 0).getbbox()
+
+
+def prepare_vision_image(image_data, config=None):
+    """预处理视觉模型输入图片，返回 data URL；解析失败时原样返回"""
+    from PIL import Image
+    from io import BytesIO
+
+    config = config if config is not None else read_config()
+    max_edge = int(config.get('vision_max_edge') or VISION_DEFAULT_MAX_EDGE)
+    grayscale = str(config.get('vision_grayscale', '')).lower() in ('1', 'true', 'yes')
+
+    if image_data.startswith('data:'):
+        header, b64_data = image_data.split(',', 1)
+    else:
+        header, b64_data = 'data:image/png;base64', image_data
+    original_url = f'{header},{b64_data}'
+
+    try:
+        raw = base64.b64decode(b64_data)
+        img = Image.open(BytesIO(raw))
+        img.load()
+    except Exception as e:
+        print(f"Vision image preprocess skipped: {e}")
+        return original_url
+
+    original_size = img.size
+    img = flatten_image(img)
+
+    # 裁掉与左上角背景色相近的空白边距
+    bbox = content_bbox(img.convert('L'))
+    if bbox:
+        bbox = (max(bbox[0] - VISION_TRIM_PADDING, 0), max(bbox[1] - VISION_TRIM_PADDING, 0),
+                min(bbox[2] + VISION_TRIM_PADDING, img.width), min(bbox[3] + VISION_TRIM_PADDING, img.height))
+        if bbox != (0, 0, img.width, img.height):
+            img = img.crop(bbox)
+
+    # 限制长边
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if grayscale:
+        img = img.convert('L')
+
+    # PNG / JPEG 取较小者
+    candidates = []
+    png_buffer = BytesIO()
+    img.save(png_buffer, format='PNG', compress_level=6)
+    candidates.append(('image/png', png_buffer.getvalue()))
+    jpeg_buffer = BytesIO()
+    img.save(jpeg_buffer, format='JPEG', quality=85)
+    candidates.append(('image/jpeg', jpeg_buffer.getvalue()))
+    mime, data = min(candidates, key=lambda c: len(c[1]))
+
+    if len(data) >= len(raw) and img.size == original_size:
+        return original_url
+
+    tokens_before = estimate_image_tokens(*original_size)
+    tokens_after = estimate_image_tokens(*img.size)
+    print(f"Vision payload: {len(raw)} -> {len(data)} bytes (saved {len(raw) - len(data)}), "
+          f"~{tokens_before} -> ~{tokens_after} image tokens (saved {tokens_before - tokens_after}), "
+          f"{original_size[0]}x{original_size[1]} -> {img.size[0]}x{img.size[1]} {mime}")
+
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+# ============ 视觉/OCR 结果缓存 ============
+#
+# 重新框选同一区域或重跑同一页时，识别/翻译结果直接取自缓存。图片先归一化（转灰度、裁掉空白
+# 边距），缓存键为归一化像素（16 级灰度）的哈希，框选位置不同但内容相同的截图也能命中。
+# 不做感知哈希等近似匹配：文字截图只差一个字符（"Revenue 2023" / "Revenue 2024"）时哈希也
+# 几乎相同，会返回另一张截图的识别结果。缓存键还包含调用类型、模型和目标语言，按 LRU 保留
+# 最近 VISION_CACHE_ENTRIES 条结果（进程内）。
+
+VISION_CACHE_ENTRIES = int(os.environ.get('VISION_CACHE_ENTRIES', 1000))
+
+_vision_cache = {}  # (scope, 指纹) -> 结果，按最近使用排序
+_vision_cache_lock = threading.Lock()
+_vision_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def image_fingerprint(image_data):
+    """归一化图片指纹（裁剪空白后的灰度像素哈希），无法解析时返回 None"""
+    import hashlib
+    from PIL import Image
+    from io import BytesIO
+
+    b64_data = image_data.split(',', 1)[1] if image_data.startswith('data:') else image_data
+    try:
+        img = Image.open(BytesIO(base64.b64decode(b64_data)))
+        img.load()
+    except Exception:
+        return None
+
+    gray = flatten_image(img).convert('L')
+    bbox = content_bbox(gray)
+    if bbox:
+        gray = gray.crop(bbox)
+
+    fingerprint = hashlib.blake2b(str(gray.size).encode('utf-8'), digest_size=16)
+    fingerprint.update(gray.point(lambda v: v >> 4 << 4).tobytes())
+    return fingerprint.hexdigest()
+
+
+def vision_cache_get(scope, fingerprint):
+    """按指纹读取缓存结果（命中后移到最近使用），未命中返回 None"""
+    import copy
+
+    with _vision_cache_lock:
+        key = (scope, fingerprint)
+        if key not in _vision_cache:
+            _vision_cache_stats['misses'] += 1
+            return None
+
+        value = _vision_cache.pop(key)
+        _vision_cache[key] = value
+        _vision_cache_stats['hits'] += 1
+        return copy.deepcopy(value)
+
+
+def vision_cache_put(scope, fingerprint, value):
+    import copy
+
+    with _vision_cache_lock:
+        _vision_cache.pop((scope, fingerprint), None)
+        _vision_cache[(scope, fingerprint)] = copy.deepcopy(value)
+        while len(_vision_cache) > VISION_CACHE_ENTRIES:
+            _vision_cache.pop(next(iter(_vision_cache)))
+
+
+def cached_image_call(scope, image_data, fn, ok=bool):
+    """归一化后相同的图片在同一 scope 下复用 fn() 的结果；ok(结果) 为真时才缓存"""
+    fingerprint = image_fingerprint(image_data) if VISION_CACHE_ENTRIES > 0 else None
+    if fingerprint is not None:
+        cached = vision_cache_get(scope, fingerprint)
+        if cached is not None:
+            print(f"Vision cache hit: {scope}")
+            return cached
+
+    value = fn()
+    if fingerprint is not None and ok(value):
+        vision_cache_put(scope, fingerprint, value)
+    return value
+
+
+def image_cached(kind, ok=bool):
+    """缓存 fn(image_data, [target_lang,] api_key, endpoint_id) 的结果，scope 为 kind、目标语言和模型"""
+    import functools
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(image_data, *args):
+            scope = '|'.join([kind] + [str(a) for a in args[:-2]] + [str(args[-1])])  # 不含 API Key
+            return cached_image_call(scope, image_data, lambda: fn(image_data, *args), ok)
+        return wrapper
+    return decorator
+
+
+def translate_with_deepseek(text, target_lang, api_key):
+    """使用 DeepSeek 翻译文字（支持代理）"""
+    import urllib.request
+
+    lang_names = {'zh': '中文', 'en': 'English'}
+    target_lang_name = lang_names.get(target_lang, '中文')
+
+    prompt = f"""请将以下文字翻译成{target_lang_name}，只返回翻译结果，不要包含任何解释：
+
+{text}"""
+
+    request_data = json.dumps({
+        "model": "deepseek-chat",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 2000
+    }).encode('utf-8')
+
+    req = urllib.request.Request(
+        'https://api.deepseek.com/v1/chat/completions',
+        data=request_data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        }
+    )
+
+    result = upstream_json(req, timeout=30, opener=get_deepseek_opener())
+    return result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+
+def translate_with_doubao(text, target_lang, api_key, endpoint_id, references=None):
+    """使用豆包翻译文字（references 为翻译记忆中相似段落的 (原文, 译文)）"""
+    import urllib.request
+
+    lang_names = {'zh': '中文', 'en': 'English'}
+    target_lang_name = lang_names.get(target_lang, '中文')
+
+    prompt = f"""请将以下文字翻译成{target_lang_name}，只返回翻译结果，不要包含任何解释：
+
+{text}"""
+    if references:
+        prompt += f"\n\n以下是相似内容的已有译文，请保持一致的用词和句式：\n{build_reference_text(references)}"
+
+    request_data = json.dumps({
+        "model": endpoint_id,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 2000
+    }).encode('utf-8')
+
+    req = urllib.request.Request(
+        'https://ark.cn-beijing.volces.com/api/v3/chat/completions',
+        data=request_data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        }
+    )
+
+    result = upstream_json(req, timeout=30)
+    return result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+
+@image_cached('ocr_doubao', ok=lambda result: bool(result[0]) and not result[1])
+def ocr_with_doubao_vision(image_base64, api_key, endpoint_id):
+    """使用豆包多模态模型识别图片文字"""
+    import urllib.request
+
+    api_url = 'https://ark.cn-beijing.volces.com/api/v3/chat/completions'
+
+    image_base64 = prepare_vision_image(image_base64)
+
+    request_data = json.dumps({
+        "model": endpoint_id,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "请识别这张图片中的所有文字，只返回识别出的文字内容。"},
+                {"type": "image_url", "image_url": {"url": image_base64}}
+            ]
+        }],
+        "max_tokens": 2000
+    }).encode('utf-8')
+
+    req = urllib.request.Request(
+        api_url,
+        data=request_data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        }
+    )
+
+    result = upstream_json(req, timeout=30)
+    text = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+    return text, None
+
+@image_cached('ocr_translate', ok=lambda result: bool(result[1]))
+def ocr_translate_with_doubao_vision(image_base64, target_lang, api_key, endpoint_id):
+    """使用豆包多模态模型一步完成 OCR + 翻译"""
+    import urllib.request
+
+    lang_names = {'zh': '中文', 'en': 'English'}
+    target_lang_name = lang_names.get(target_lang, '中文')
+
+    api_url = 'https://ark.cn-beijing.volces.com/api/v3/chat/completions'
+
+    image_base64 = prepare_vision_image(image_base64)
+
+    prompt = f"""请完成以下任务：
+1. 识别图片中的所有文字
+2. 将识别出的文字翻译成{target_lang_name}
+
+请按以下格式返回：
+【原文】
+(识别出的原文)
+
+【译文】
+(翻译后的文字)"""
+
+    request_data = json.dumps({
+        "model": endpoint_id,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": image_base64}}
+            ]
+        }],
+        "max_tokens": 2000
+    }).encode('utf-8')
+
+    req = urllib.request.Request(
+        api_url,
+        data=request_data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}'
+        }
+    )
+
+    result = upstream_json(req, timeout=60)
+    content = result.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+
+    original = ''
+    translation = ''
+
+    if '【原文】' in content and '【译文】' in content:
+        parts = content.split('【译文】')
+        original = parts[0].replace('【原文】', '').strip()
+        translation = parts[1].strip() if len(parts) > 1 else ''
+    else:
+        translation = content
+
+    return original, translation
+
+@app.route('/api/translate', methods=['POST'])
+def translate():
+    """翻译文字"""
+    data = request.get_json()
+    text = data.get('text', '').strip()
+    model = data.get('model', 'deepseek')
+    target_lang = data.get('target_lang', 'zh')
+
+    if not text:
+        return jsonify({'success': False, 'error': '没有要翻译的文字'})
+
+    try:
+        config = read_config()
+
+        if model == 'doubao':
+            api_key = config.get('doubao_api_key')
+            endpoint_id = config.get('doubao_endpoint_id')
+
+            if not api_key:
+                return jsonify({'success': False, 'error': '未配置豆包 API Key'})
+
+            translation = translate_with_doubao(text, target_lang, api_key, endpoint_id)
+        else:
+            api_key = config.get('deepseek_api_key')
+
+            if not api_key:
+                return jsonify({'success': False, 'error': '未配置 DeepSeek API Key，请点击设置'})
+
+            translation = translate_with_deepseek(text, target_lang, api_key)
+
+        return jsonify({'success': True, 'translation': translation})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/doubao-direct', methods=['POST'])
+def doubao_direct():
+    """豆包直接翻译图片"""
+    data = request.get_json()
+    image_data = data.get('image', '')
+    target_lang = data.get('target_lang', 'zh')
+
+    if not image_data:
+        return jsonify({'success': False, 'error': '没有图片数据'})
+
+    try:
+        config = read_config()
+        api_key = config.get('doubao_api_key')
+        endpoint_id = config.get('doubao_endpoint_id')
+
+        if not api_key or not endpoint_id:
+            return jsonify({'success': False, 'error': '未配置豆包 API'})
+
+        original, translation = ocr_translate_with_doubao_vision(
+            image_data, target_lang, api_key, endpoint_id
+        )
+
+        return jsonify({
+            'success': True,
+            'original_text': original,
+            'translation': translation
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
 
 # ============ PDF 翻译 API (SPEC-007) ============
@@ -598,6 +4216,10 @@ def doubao_direct():
 @app.route('/api/pdf/upload', methods=['POST'])
 def pdf_upload():
     """上传 PDF 文件"""
+    too_large = check_upload_length()
+    if too_large:
+        return jsonify({'success': False, 'error': too_large})
+
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': '没有上传文件'})
 
@@ -605,38 +4227,20 @@ def pdf_upload():
     if not file.filename:
         return jsonify({'success': False, 'error': '文件名为空'})
 
-    filename = file.filename.lower()
-    if not filename.endswith('.pdf'):
-        return jsonify({'success': False, 'error': '请上传 PDF 文件（PPT 请先用 Office 导出为 PDF）'})
-
-    # 文件大小限制 (20MB)
-    file.seek(0, 2)  # 移到文件末尾
-    file_size = file.tell()
-    file.seek(0)  # 回到开头
-    if file_size > 20 * 1024 * 1024:
-        return jsonify({'success': False, 'error': '文件过大，请上传小于 20MB 的 PDF'})
-
-    file_id = uuid.uuid4().hex[:8]
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    os.makedirs(upload_dir, exist_ok=True)
+    filename = file.filename.lower()
+    if not filename.endswith('.pdf'):
+        return jsonify({'success': False, 'error': '请上传 PDF 文件（PPT 请先用 Office 导出为 PDF）'})
 
     try:
-        file_path = os.path.join(upload_dir, 'source.pdf')
-        file.save(file_path)
-        pages = convert_pdf_to_images(file_path)
+        # 按内容哈希去重：相同文件复用已渲染的页面、布局索引和翻译缓存
+        file_id, upload_dir, content_hash, content = ingest_upload(file, 'pdf')
+        pages = content['pages']
 
         if not pages:
+            delete_document(file_id, content_hash)
             return jsonify({'success': False, 'error': '无法解析 PDF 文件'})
 
-        # 保存元数据
-        metadata = {
-            'filename': file.filename,
-            'total': len(pages),
-            'pages': pages,  # 保存 base64 图片以便后续使用
-            'translations': {}  # page_num -> translation data
-        }
-        with open(os.path.join(upload_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        create_document(file_id, 'pdf', file.filename, content_hash, content)
 
         return jsonify({
             'success': True,
@@ -650,10 +4254,9 @@ def pdf_upload():
 
 
 @app.route('/api/pdf/translate-page', methods=['POST'])
+@upstream_class('page')
 def pdf_translate_page():
     """翻译 PDF 单页 - 提取文字位置并精确覆盖翻译"""
-    import fitz
-
     data = request.get_json()
     file_id = data.get('file_id', '')
     page = data.get('page', 1)
@@ -663,17 +4266,13 @@ def pdf_translate_page():
         return jsonify({'success': False, 'error': '缺少 file_id'})
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
-    source_path = os.path.join(upload_dir, 'source.pdf')
+    document = load_document(file_id)
 
-    if not os.path.exists(metadata_path):
+    if document is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        pages = metadata.get('pages', [])
+        pages = load_document_pages(document)
         page_idx = page - 1
 
         if page_idx < 0 or page_idx >= len(pages):
@@ -686,67 +4285,21 @@ def pdf_translate_page():
         if not api_key or not endpoint_id:
             return jsonify({'success': False, 'error': '未配置豆包 API，请在设置中配置'})
 
-        target_lang = 'zh' if direction == 'en2zh' else 'en'
-
-        # 从 PDF 提取文字块及其位置
-        doc = fitz.open(source_path)
-        pdf_page = doc[page_idx]
-
-        # 获取页面尺寸
-        page_rect = pdf_page.rect
-        page_width = page_rect.width
-        page_height = page_rect.height
-
-        # 提取文字块 (包含位置信息)
-        text_blocks = pdf_page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)["blocks"]
+        # 从上传时建立的布局索引读取文字块及其位置
+        layout = load_layout_index(upload_dir)
+        if layout is None or page_idx >= layout_page_count(layout):
+            return jsonify({'success': False, 'error': '无法读取页面文本结构'})
 
-        extracted_blocks = []
-        for block in text_blocks:
-            if block.get("type") == 0:  # 文本块
-                bbox = block.get("bbox", [0, 0, 0, 0])
-                lines = block.get("lines", [])
-                block_text = ""
-                font_size = 12
-
-                for line in lines:
-                    for span in line.get("spans", []):
-                        block_text += span.get("text", "")
-                        font_size = span.get("size", 12)
-                    block_text += "\n"
-
-                block_text = block_text.strip()
-                if block_text and len(block_text) > 1:  # 忽略单字符
-                    extracted_blocks.append({
-                        "text": block_text,
-                        "bbox": bbox,  # [x0, y0, x1, y1]
-                        "font_size": font_size
-                    })
-
-        doc.close()
-
-        if not extracted_blocks:
+        stats = {}
+        trans_data = translate_pdf_page_text(
+            layout, page_idx, direction, api_key, endpoint_id, document['content_hash'], stats
+        )
+        if trans_data is None:
             return jsonify({'success': False, 'error': '未检测到文字'})
 
-        # 批量翻译所有文字块
-        all_texts = [b["text"] for b in extracted_blocks]
-        combined_text = "\n[SEP]\n".join(all_texts)
-
-        translated_combined = translate_text_with_api(combined_text, target_lang, api_key, endpoint_id, direction)
-        translated_texts = translated_combined.split("\n[SEP]\n")
-
-        # 确保翻译数量匹配
-        while len(translated_texts) < len(extracted_blocks):
-            translated_texts.append(extracted_blocks[len(translated_texts)]["text"])
-
-        # 构建带位置的翻译块
-        translation_blocks = []
-        for i, block in enumerate(extracted_blocks):
-            translation_blocks.append({
-                "original": block["text"],
-                "translated": translated_texts[i].strip() if i < len(translated_texts) else block["text"],
-                "bbox": block["bbox"],
-                "font_size": block["font_size"]
-            })
+        translation_blocks = trans_data['blocks']
+        page_width = trans_data['page_width']
+        page_height = trans_data['page_height']
 
         # 生成带翻译覆盖的预览图
         preview = generate_precise_preview(
@@ -756,28 +4309,18 @@ def pdf_translate_page():
             page_height
         )
 
-        # 保存翻译结果
-        trans_data = {
-            'page': page,
-            'blocks': translation_blocks,
-            'page_width': page_width,
-            'page_height': page_height
-        }
-
-        if 'translations' not in metadata:
-            metadata['translations'] = {}
-        metadata['translations'][str(page)] = trans_data
-
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 保存翻译结果，返回带 id 的块供前端提交编辑补丁
+        save_page_translation(file_id, page, trans_data)
+        saved = load_page_translation(file_id, page)
 
         return jsonify({
             'success': True,
             'page': page,
-            'blocks': translation_blocks,
+            'blocks': saved['blocks'] if saved else translation_blocks,
             'preview': preview,
             'page_width': page_width,
-            'page_height': page_height
+            'page_height': page_height,
+            'skipped': stats.get('skipped', {})
         })
 
     except Exception as e:
@@ -786,6 +4329,164 @@ def pdf_translate_page():
         return jsonify({'success': False, 'error': str(e)})
 
 
+def extract_page_segments(layout, page_idx):
+    """从布局索引提取页面的待翻译段落"""
+    text_blocks = layout_page_blocks(layout, page_idx)
+
+    # 按阅读顺序把行重建为段落，减少碎片化的翻译片段
+    return [
+        seg for seg in build_page_segments(text_blocks)
+        if len(seg["text"]) > 1  # 忽略单字符
+    ]
+
+
+def text_translation_call(direction, api_key, endpoint_id):
+    """文本层翻译的单次请求（供 translate_texts_batched 使用，失败时抛出 TranslationFailed）"""
+    target_lang = 'zh' if direction == 'en2zh' else 'en'
+    return lambda text, references=None: translate_text_with_api(
+        text, target_lang, api_key, endpoint_id, direction, references, raise_errors=True
+    )
+
+
+def segments_to_blocks(segments, translated_texts, skips=None, failed=None):
+    """段落与译文组合为带位置的翻译块；免译段落标记 skip（预览和导出不覆盖原文），
+    请求失败（保留原文）的段落标记 failed"""
+    skips = skips or {}
+    failed = failed or ()
+    translation_blocks = []
+    for i, block in enumerate(segments):
+        translation_block = {
+            "original": block["text"],
+            "translated": translated_texts[i].strip() if i < len(translated_texts) else block["text"],
+            "bbox": block["bbox"],
+            "font_size": block["font_size"],
+            "source_bboxes": block["source_bboxes"]
+        }
+        if i in skips:
+            translation_block["skip"] = skips[i]
+        elif i in failed:
+            translation_block["failed"] = True
+        translation_blocks.append(translation_block)
+    return translation_blocks
+
+
+def translate_pdf_pages_text(layout, page_indices, direction, api_key, endpoint_id, content_hash=None, stats=None,
+                             on_page=None):
+    """文本层路径（多页）：各页段落跨页打包翻译，返回 {page_idx: trans_data 或 None}
+
+    没有可翻译文字的页面为 None；传入 content_hash 时复用同一内容此前的机器翻译结果。
+    每页段落全部译完即写入缓存并调用 on_page(page_idx, trans_data)，不必等整批完成。
+    """
+    results = {}
+    pending = []  # (page_idx, segments)
+    for page_idx in page_indices:
+        cached = load_cached_translation(content_hash, 'text', direction, page_idx + 1)
+        if cached is not None:
+            results[page_idx] = cached
+            continue
+        segments = extract_page_segments(layout, page_idx)
+        if not segments:
+            results[page_idx] = None
+            continue
+        pending.append((page_idx, segments))
+
+    if not pending:
+        return results
+
+    texts = []
+    offsets = []
+    owner = []  # 段落所属的 pending 序号
+    for n, (_, segments) in enumerate(pending):
+        offsets.append(len(texts))
+        texts.extend(seg["text"] for seg in segments)
+        owner.extend([n] * len(segments))
+    remaining = [len(segments) for _, segments in pending]
+    skips = classify_skip_segments(texts, direction)
+    failed = set()
+
+    def finish_page(n, translated_texts):
+        page_idx, segments = pending[n]
+        offset = offsets[n]
+        page_skips = {i - offset: reason for i, reason in skips.items() if offset <= i < offset + len(segments)}
+        page_failed = {i - offset for i in failed if offset <= i < offset + len(segments)}
+        blocks = segments_to_blocks(segments, translated_texts[offset:offset + len(segments)], page_skips,
+                                    page_failed)
+
+        page_info = layout_page_info(layout, page_idx)
+        trans_data = {
+            'page': page_idx + 1,
+            'blocks': blocks,
+            'page_width': page_info['width'],
+            'page_height': page_info['height'],
+            'route': 'text'
+        }
+
+        # 有段落请求失败（保留原文）的页面不缓存，下次重新翻译
+        if not page_failed:
+            save_cached_translation(content_hash, 'text', direction, page_idx + 1, trans_data)
+        results[page_idx] = trans_data
+        if on_page is not None:
+            on_page(page_idx, trans_data)
+
+    def on_batch(indices, translated_texts):
+        for i in indices:
+            remaining[owner[i]] -= 1
+            if remaining[owner[i]] == 0:
+                finish_page(owner[i], translated_texts)
+
+    translate_texts_batched(
+        texts, text_translation_call(direction, api_key, endpoint_id), stats=stats, skips=skips, memory=direction,
+        on_batch=on_batch, failed=failed
+    )
+    return results
+
+
+def translate_pdf_page_text(layout, page_idx, direction, api_key, endpoint_id, content_hash=None, stats=None):
+    """文本层路径：提取段落并翻译，返回页面翻译数据；页面没有可翻译文字时返回 None
+
+    传入 content_hash 时复用同一内容此前的机器翻译结果。
+    """
+    return translate_pdf_pages_text(
+        layout, [page_idx], direction, api_key, endpoint_id, content_hash, stats
+    )[page_idx]
+
+
+def text_translation_succeeded(trans_data):
+    """文本层页面是否全部译出（任一段落请求失败即为失败；全部免译的页面也算完成）"""
+    return not any(b.get('failed') for b in trans_data['blocks'])
+
+
+def translate_pages_text_first(layout, page_indices, direction, api_key, endpoint_id, content_hash=None, stats=None,
+                               on_page=None):
+    """按页面分类选择翻译路径，返回 {page_idx: (trans_data, route)}
+
+    数字原生页面直接走文本层 + LLM（各页段落跨页打包请求）；扫描件或图片为主的页面
+    trans_data 为 None，由调用方走视觉模型。on_page 见 translate_pdf_pages_text（新译出的页面）。
+    """
+    routes = {}
+    for page_idx in page_indices:
+        if layout is None or page_idx >= layout_page_count(layout):
+            routes[page_idx] = {'route': 'vision', 'reason': 'no_layout_index'}
+        else:
+            routes[page_idx] = classify_page_route(layout, page_idx)
+
+    text_pages = [page_idx for page_idx in page_indices if routes[page_idx]['route'] == 'text']
+    translated = {}
+    if text_pages:
+        translated = translate_pdf_pages_text(
+            layout, text_pages, direction, api_key, endpoint_id, content_hash, stats, on_page
+        )
+
+    results = {}
+    for page_idx in page_indices:
+        route = routes[page_idx]
+        trans_data = translated.get(page_idx)
+        if route['route'] == 'text' and trans_data is None:
+            route = dict(route, route='vision', reason='no_segments')
+        results[page_idx] = (trans_data, route)
+    return results
+
+
 def build_glossary_text(direction):
     """构建词汇表文本用于 Prompt"""
     glossary_data = load_glossary()
@@ -803,8 +4504,12 @@ def build_glossary_text(direction):
     return "\n".join(lines)
 
 
-def translate_text_with_api(text, target_lang, api_key, endpoint_id, direction='en2zh'):
-    """使用 API 翻译文本，注入词汇表"""
+def translate_text_with_api(text, target_lang, api_key, endpoint_id, direction='en2zh', references=None,
+                            raise_errors=False):
+    """使用 API 翻译文本，注入词汇表和翻译记忆中的参考译文
+
+    请求失败时原样返回原文；raise_errors 为真时改为抛出 TranslationFailed。
+    """
     import urllib.request
 
     lang_names = {'zh': '中文', 'en': 'English'}
@@ -834,6 +4539,9 @@ def translate_text_with_api(text, target_lang, api_key, endpoint_id, direction='
     else:
         prompt = f"请将以下文本翻译成{target_name}，保持 [SEP] 分隔符不变，只返回翻译结果：\n\n{text}"
 
+    if references:
+        prompt += f"\n\n## 参考译文（相似内容的已有翻译，保持一致的用词和句式）\n{build_reference_text(references)}"
+
     payload = {
         "model": endpoint_id,
         "messages": [{"role": "user", "content": prompt}],
@@ -847,13 +4555,14 @@ def translate_text_with_api(text, target_lang, api_key, endpoint_id, direction='
         req.add_header('Content-Type', 'application/json')
         req.add_header('Authorization', f'Bearer {api_key}')
 
-        with urllib.request.urlopen(req, timeout=120) as response:
-            result = json.loads(response.read().decode('utf-8'))
+        result = upstream_json(req, timeout=120)
 
         return result['choices'][0]['message']['content'].strip()
 
     except Exception as e:
         print(f"Translation error: {e}")
+        if raise_errors:
+            raise TranslationFailed(str(e)) from e
         return text
 
 
@@ -891,7 +4600,7 @@ def generate_precise_preview(original_image, blocks, pdf_width, pdf_height):
             translated = block.get("translated", "")
             original_font_size = block.get("font_size", 12)
 
-            if not translated:
+            if not translated or block.get("skip"):  # 免译段落保留原文
                 continue
 
             # 转换坐标
@@ -966,6 +4675,7 @@ def wrap_text(text, font, max_width, draw):
     return lines
 
 
+@image_cached('page_vision', ok=lambda result: result.get('success'))
 def translate_page_with_vision(image_data, target_lang, api_key, endpoint_id):
     """使用豆包视觉模型翻译页面，返回文本块及位置"""
     import urllib.request
@@ -988,8 +4698,7 @@ Original: xxx | Translation: yyy | Position: top/middle/bottom
 Example:
 Original: 你好 | Translation: Hello | Position: top"""
 
-    if ',' in image_data:
-        image_data = image_data.split(',')[1]
+    image_url = prepare_vision_image(image_data)
 
     payload = {
         "model": endpoint_id,
@@ -998,7 +4707,7 @@ Original: 你好 | Translation: Hello | Position: top"""
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
+                    {"type": "image_url", "image_url": {"url": image_url}}
                 ]
             }
         ],
@@ -1013,8 +4722,7 @@ Original: 你好 | Translation: Hello | Position: top"""
         req.add_header('Authorization', f'Bearer {api_key}')
 
         try:
-            with urllib.request.urlopen(req, timeout=120) as response:
-                result = json.loads(response.read().decode('utf-8'))
+            result = upstream_json(req, timeout=120)
         except urllib.request.HTTPError as e:
             error_body = e.read().decode('utf-8')
             print(f"Doubao API Error: {e.code} - {error_body}")
@@ -1197,26 +4905,30 @@ def generate_translated_preview(original_image, blocks):
 
 
 @app.route('/api/pdf/translate-all', methods=['POST'])
+@upstream_class('bulk')
+@translation_job('translate_all', 'en2zh')
 def pdf_translate_all():
-    """批量翻译 PDF 所有页面"""
+    """批量翻译 PDF 所有页面
+
+    每页译完即保存并记录到任务进度。resume 为真时续传：上一次同方向任务已完成的页面直接
+    使用已保存的译文，只翻译缺失和失败的页面（同一内容已译过的页面还会命中内容缓存）。
+    """
     data = request.get_json()
     file_id = data.get('file_id', '')
     direction = data.get('direction', 'en2zh')
+    resume = bool(data.get('resume'))
 
     if not file_id:
         return jsonify({'success': False, 'error': '缺少 file_id'})
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
+    document = load_document(file_id)
 
-    if not os.path.exists(metadata_path):
+    if document is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        pages = metadata.get('pages', [])
+        pages = load_document_pages(document)
         total = len(pages)
 
         config = read_config()
@@ -1228,39 +4940,107 @@ def pdf_translate_all():
 
         target_lang = 'zh' if direction == 'en2zh' else 'en'
         translated_pages = []
-        all_translations = {}
+        routes = []
+
+        layout = load_layout_index(upload_dir)
+        content_hash = document['content_hash']
+
+        # 续传：上次已完成且仍有保存译文的页面不再翻译
+        resumed = {}
+        if resume:
+            completed, failed = last_job_progress(file_id, 'translate_all', direction)
+            for page_num in sorted(completed - failed):
+                trans_data = load_page_translation(file_id, page_num) if page_num <= total else None
+                if trans_data is not None:
+                    resumed[page_num - 1] = trans_data
+                    job_page_done(page_num)
+            print(f"Resuming {file_id}: {len(resumed)} of {total} pages already translated")
+
+        # 文本层页面每页译完立即保存（检查点），不必等所有批次完成
+        saved = set()
+
+        def checkpoint_text_page(page_idx, trans_data):
+            ok = text_translation_succeeded(trans_data)
+            if ok:
+                save_page_translation(file_id, page_idx + 1, trans_data)
+                saved.add(page_idx)
+            job_page_done(page_idx + 1, ok)
+
+        # 有文本层的页面直接提取文字翻译（全部页面的段落跨页打包请求），只有扫描件/图片页才调用视觉模型
+        batch_stats = {'calls': 0}
+        text_first = translate_pages_text_first(
+            layout, [i for i in range(total) if i not in resumed], direction, api_key, endpoint_id, content_hash,
+            batch_stats, on_page=checkpoint_text_page
+        )
 
         for page_idx, page_image in enumerate(pages):
             page_num = page_idx + 1
+            check_job_cancelled()
+
+            if page_idx in resumed:
+                trans_data = resumed[page_idx]
+                routes.append({'route': trans_data.get('route', 'vision'), 'reason': 'resumed', 'page': page_num})
+                if trans_data.get('route') == 'text':
+                    translated_pages.append(generate_precise_preview(
+                        page_image, trans_data['blocks'], trans_data['page_width'], trans_data['page_height']
+                    ))
+                else:
+                    translated_pages.append(generate_translated_preview(page_image, trans_data.get('blocks', [])))
+                continue
 
-            # 翻译每页
-            result = translate_page_with_vision(page_image, target_lang, api_key, endpoint_id)
+            trans_data, route = text_first[page_idx]
+            routes.append(dict(route, page=page_num))
+            print(f"Page {page_num} route: {route['route']} ({route['reason']})")
+
+            if trans_data is not None:
+                if page_idx not in saved:
+                    # 内容缓存命中的页面（未经过检查点回调）；接口失败的页面也保存，显示原文
+                    save_page_translation(file_id, page_num, trans_data)
+                    job_page_done(page_num, text_translation_succeeded(trans_data))
+                preview = generate_precise_preview(
+                    page_image, trans_data['blocks'], trans_data['page_width'], trans_data['page_height']
+                )
+                translated_pages.append(preview)
+                continue
 
-            if result.get('success'):
-                trans_data = {
-                    'page': page_num,
-                    'original_text': result.get('original_text', ''),
-                    'translated_text': result.get('translated_text', ''),
-                    'blocks': result.get('blocks', [])
-                }
-                all_translations[str(page_num)] = trans_data
+            # 翻译每页（同一内容此前的视觉翻译结果可直接复用）
+            trans_data = load_cached_translation(content_hash, 'vision', direction, page_num)
+            if trans_data is None:
+                vision_image = render_source_page(upload_dir, page_idx, 'vision') or page_image
+                result = translate_page_with_vision(vision_image, target_lang, api_key, endpoint_id)
+                if result.get('success'):
+                    trans_data = {
+                        'page': page_num,
+                        'original_text': result.get('original_text', ''),
+                        'translated_text': result.get('translated_text', ''),
+                        'blocks': result.get('blocks', []),
+                        'route': 'vision'
+                    }
+                    save_cached_translation(content_hash, 'vision', direction, page_num, trans_data)
+
+            if trans_data is not None:
+                save_page_translation(file_id, page_num, trans_data)
+                job_page_done(page_num)
 
                 # 生成预览
                 preview = generate_translated_preview(page_image, trans_data['blocks'])
                 translated_pages.append(preview)
             else:
                 # 翻译失败，保持原图
+                job_page_done(page_num, False)
                 translated_pages.append(page_image)
 
-        # 保存所有翻译
-        metadata['translations'] = all_translations
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-
+        job = current_job()
         return jsonify({
             'success': True,
             'pages': translated_pages,
-            'total': total
+            'total': total,
+            'routes': routes,
+            'text_requests': batch_stats['calls'],
+            'skipped': batch_stats.get('skipped', {}),
+            'memory_reused': batch_stats.get('memory_reused', 0),
+            'resumed': len(resumed),
+            'failed_pages': sorted(job['failed']) if job else []
         })
 
     except Exception as e:
@@ -1311,7 +5091,7 @@ def pdf_translate_region():
 
 @app.route('/api/pdf/save-region-block', methods=['POST'])
 def pdf_save_region_block():
-    """保存截图翻译块到 metadata（用于导出 PDF）"""
+    """保存截图翻译块（用于导出 PDF）"""
     data = request.get_json()
     file_id = data.get('file_id', '')
     page = data.get('page', 1)
@@ -1320,56 +5100,12 @@ def pdf_save_region_block():
     if not file_id or not new_block:
         return jsonify({'success': False, 'error': '缺少参数'})
 
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
-
-    if not os.path.exists(metadata_path):
+    if load_document(file_id) is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        if 'translations' not in metadata:
-            metadata['translations'] = {}
-
-        page_key = str(page)
-        if page_key not in metadata['translations']:
-            metadata['translations'][page_key] = {'blocks': [], 'region_blocks': []}
-
-        trans_data = metadata['translations'][page_key]
-
-        # 确保 region_blocks 字段存在
-        if 'region_blocks' not in trans_data:
-            trans_data['region_blocks'] = []
-
-        # 移除与新块重叠的旧块
-        def is_overlapping(a, b):
-            ax1, ay1 = a.get('x', 0), a.get('y', 0)
-            ax2, ay2 = ax1 + a.get('width', 0), ay1 + a.get('height', 0)
-            bx1, by1 = b.get('x', 0), b.get('y', 0)
-            bx2, by2 = bx1 + b.get('width', 0), by1 + b.get('height', 0)
-
-            overlap_x = max(0, min(ax2, bx2) - max(ax1, bx1))
-            overlap_y = max(0, min(ay2, by2) - max(ay1, by1))
-            overlap_area = overlap_x * overlap_y
-
-            area_a = a.get('width', 1) * a.get('height', 1)
-            area_b = b.get('width', 1) * b.get('height', 1)
-
-            return overlap_area > area_a * 0.3 or overlap_area > area_b * 0.3
-
-        trans_data['region_blocks'] = [
-            b for b in trans_data['region_blocks']
-            if not is_overlapping(b, new_block)
-        ]
-
-        # 添加新块
-        trans_data['region_blocks'].append(new_block)
-
-        # 保存 metadata
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        # 移除与新块重叠的旧块并添加新块（单个事务）
+        add_region_block(file_id, page, new_block)
 
         return jsonify({'success': True})
 
@@ -1390,34 +5126,12 @@ def pdf_delete_region_block():
     if not file_id or not block_to_delete:
         return jsonify({'success': False, 'error': '缺少参数'})
 
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
-
-    if not os.path.exists(metadata_path):
+    if load_document(file_id) is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        page_key = str(page)
-        if page_key not in metadata.get('translations', {}):
-            return jsonify({'success': True})
-
-        trans_data = metadata['translations'][page_key]
-        region_blocks = trans_data.get('region_blocks', [])
-
         # 按位置匹配删除
-        def blocks_match(a, b):
-            return (abs(a.get('x', 0) - b.get('x', 0)) < 0.5 and
-                    abs(a.get('y', 0) - b.get('y', 0)) < 0.5)
-
-        trans_data['region_blocks'] = [
-            b for b in region_blocks if not blocks_match(b, block_to_delete)
-        ]
-
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        delete_region_block(file_id, page, block_to_delete)
 
         return jsonify({'success': True})
 
@@ -1502,7 +5216,8 @@ def pdf_export():
         file_id = data.get('file_id', '')
         mode = data.get('mode', 'translation_only')
         orientation = data.get('orientation', 'landscape')
-        frontend_blocks = data.get('translation_blocks', [])  # 前端拖拽后的位置
+        # 旧版前端导出时回传全部翻译块；新版编辑已通过补丁保存，直接读取服务器状态
+        frontend_blocks = data.get('translation_blocks', [])
     else:
         file_id = request.args.get('file_id', '')
         mode = request.args.get('mode', 'translation_only')
@@ -1514,17 +5229,14 @@ def pdf_export():
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
     source_path = os.path.join(upload_dir, 'source.pdf')
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
+    document = load_document(file_id)
 
-    if not os.path.exists(source_path):
+    if document is None or not os.path.exists(source_path):
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        translations = metadata.get('translations', {})
-        original_filename = metadata.get('filename', 'document.pdf')
+        translations = load_translations(file_id)
+        original_filename = document['filename']
         base_name = os.path.splitext(original_filename)[0]
 
         # 如果前端传来了 translation_blocks，优先使用（用户可能已拖动调整位置）
@@ -1535,14 +5247,26 @@ def pdf_export():
         if not translations:
             return jsonify({'success': False, 'error': '请先翻译文档'})
 
-        if mode == 'side_by_side':
-            # 左右对照导出
-            pdf_data = export_side_by_side(file_id, metadata, orientation, frontend_blocks)
-            filename_suffix = '_sidebyside'
-        else:
-            # 仅翻译结果
-            pdf_data = export_translation_only(file_id, metadata, frontend_blocks)
-            filename_suffix = '_translated'
+        filename_suffix = '_sidebyside' if mode == 'side_by_side' else '_translated'
+
+        # 按翻译状态计算缓存键，状态未变时直接返回上次导出结果
+        cache_key = compute_export_key(source_path, translations, mode, orientation)
+        etag = f'"{cache_key}"'
+        if request.if_none_match.contains(cache_key):
+            return Response(status=304, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+
+        pdf_data = export_cache_get(file_id, cache_key)
+        cache_status = 'hit'
+
+        if pdf_data is None:
+            cache_status = 'miss'
+            if mode == 'side_by_side':
+                # 左右对照导出
+                pdf_data = export_side_by_side(file_id, document, translations, orientation, frontend_blocks)
+            else:
+                # 仅翻译结果
+                pdf_data = export_translation_only(file_id, translations, frontend_blocks)
+            export_cache_put(file_id, cache_key, pdf_data)
 
         # 使用 ASCII 安全的文件名，中文用 URL 编码
         from urllib.parse import quote
@@ -1552,7 +5276,10 @@ def pdf_export():
             pdf_data,
             mimetype='application/pdf',
             headers={
-                'Content-Disposition': f"attachment; filename*=UTF-8''{safe_filename}"
+                'Content-Disposition': f"attachment; filename*=UTF-8''{safe_filename}",
+                'ETag': etag,
+                'Cache-Control': 'private, no-cache',
+                'X-Export-Cache': cache_status
             }
         )
 
@@ -1582,7 +5309,7 @@ def reorganize_translations_from_frontend(frontend_blocks):
     return translations
 
 
-def export_translation_only(file_id, metadata, frontend_blocks=None):
+def export_translation_only(file_id, translations, frontend_blocks=None):
     """导出仅翻译结果的 PDF"""
     import fitz
 
@@ -1592,116 +5319,197 @@ def export_translation_only(file_id, metadata, frontend_blocks=None):
     # 如果前端传来了翻译块，优先使用（用户可能已拖动调整）
     if frontend_blocks:
         translations = reorganize_translations_from_frontend(frontend_blocks)
-    else:
-        translations = metadata.get('translations', {})
+
+    # 如果是前端传来的数据，只有 region_blocks（百分比坐标）
+    # 如果是已保存的数据，可能有 blocks（PDF 坐标）和 region_blocks（百分比坐标）
+    use_blocks = not frontend_blocks
+
+    output_path = os.path.join(upload_dir, 'translated.pdf')
 
     # 打开 PDF
     doc = fitz.open(source_path)
+    total_pages = len(doc)
 
-    # 遍历每页添加翻译
-    for page_num_str, trans_data in translations.items():
-        page_num = int(page_num_str) - 1
-        if page_num >= len(doc):
-            continue
-
-        page = doc[page_num]
+    # 页数较多时按页码区间分给多个进程并行合成，再按顺序合并
+    parts = composite_pages_in_parallel(
+        compose_translation_only_range,
+        total_pages,
+        lambda start, end: (source_path, translations, use_blocks, start, end)
+    )
 
-        page_rect = page.rect
-        page_width = page_rect.width
-        page_height = page_rect.height
+    if parts is None:
+        # 遍历每页添加翻译
+        for page_num_str, trans_data in translations.items():
+            page_num = int(page_num_str) - 1
+            if page_num >= total_pages:
+                continue
+            overlay_translations_on_page(doc[page_num], trans_data, use_blocks)
+        doc.save(output_path)
+    else:
+        merged = merge_pdf_parts(parts)
+        # 分段合并会丢失书签，从源文档复制
+        toc = doc.get_toc(simple=False)
+        if toc:
+            try:
+                merged.set_toc(toc)
+            except Exception:
+                pass
+        merged.save(output_path, garbage=3, deflate=True)
+        merged.close()
 
-        # 如果是前端传来的数据，只有 region_blocks（百分比坐标）
-        # 如果是 metadata 数据，可能有 blocks（PDF 坐标）和 region_blocks（百分比坐标）
+    doc.close()
 
-        # 处理整页翻译的 blocks（仅从 metadata 时使用）
-        if not frontend_blocks:
-            blocks = trans_data.get('blocks', [])
-            for block in blocks:
-                bbox = block.get('bbox', [])
-                translated = block.get('translated', '')
-                font_size = block.get('font_size', 12)
+    with open(output_path, 'rb') as f:
+        return f.read()
 
-                if not bbox or not translated or len(bbox) < 4:
-                    continue
 
-                rect = fitz.Rect(bbox[0], bbox[1], bbox[2], bbox[3])
-                page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
+def overlay_translations_on_page(page, trans_data, use_blocks=True):
+    """在 PDF 页面上覆盖翻译文本"""
+    import fitz
 
-                text_font_size = min(font_size * 0.9, 14)
-                text_font_size = max(text_font_size, 8)
+    page_rect = page.rect
+    page_width = page_rect.width
+    page_height = page_rect.height
 
-                try:
-                    page.insert_textbox(
-                        rect,
-                        translated,
-                        fontsize=text_font_size,
-                        fontname="china-s",
-                        align=0
-                    )
-                except:
-                    try:
-                        page.insert_textbox(rect, translated, fontsize=text_font_size, align=0)
-                    except:
-                        pass
-
-        # 处理百分比坐标的 region_blocks（前端传来的或截图翻译）
-        region_blocks = trans_data.get('region_blocks', [])
-        for rb in region_blocks:
-            x_pct = rb.get('x', 0)
-            y_pct = rb.get('y', 0)
-            w_pct = rb.get('width', 0)
-            h_pct = rb.get('height', 0)
-            text = rb.get('text', '')
+    # 处理整页翻译的 blocks（仅使用已保存的数据时）
+    if use_blocks:
+        blocks = trans_data.get('blocks', [])
+        for block in blocks:
+            bbox = block.get('bbox', [])
+            translated = block.get('translated', '')
+            font_size = block.get('font_size', 12)
 
-            if not text:
+            if not bbox or not translated or len(bbox) < 4 or block.get('skip'):
                 continue
 
-            x0 = x_pct / 100 * page_width
-            y0 = y_pct / 100 * page_height
-            x1 = x0 + (w_pct / 100 * page_width)
-            y1 = y0 + (h_pct / 100 * page_height)
-
-            rect = fitz.Rect(x0, y0, x1, y1)
+            rect = fitz.Rect(bbox[0], bbox[1], bbox[2], bbox[3])
             page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
 
+            text_font_size = min(font_size * 0.9, 14)
+            text_font_size = max(text_font_size, 8)
+
             try:
-                page.insert_textbox(rect, text, fontsize=10, fontname="china-s", align=0)
+                page.insert_textbox(
+                    rect,
+                    translated,
+                    fontsize=text_font_size,
+                    fontname="china-s",
+                    align=0
+                )
             except:
                 try:
-                    page.insert_textbox(rect, text, fontsize=10, align=0)
+                    page.insert_textbox(rect, translated, fontsize=text_font_size, align=0)
                 except:
                     pass
 
-    # 保存并返回
-    output_path = os.path.join(upload_dir, 'translated.pdf')
-    doc.save(output_path)
-    doc.close()
+    # 处理百分比坐标的 region_blocks（前端传来的或截图翻译）
+    region_blocks = trans_data.get('region_blocks', [])
+    for rb in region_blocks:
+        x_pct = rb.get('x', 0)
+        y_pct = rb.get('y', 0)
+        w_pct = rb.get('width', 0)
+        h_pct = rb.get('height', 0)
+        text = rb.get('text', '')
 
-    with open(output_path, 'rb') as f:
-        return f.read()
+        if not text:
+            continue
 
+        x0 = x_pct / 100 * page_width
+        y0 = y_pct / 100 * page_height
+        x1 = x0 + (w_pct / 100 * page_width)
+        y1 = y0 + (h_pct / 100 * page_height)
 
-def export_side_by_side(file_id, metadata, orientation='landscape', frontend_blocks=None):
-    """导出左右对照的 PDF"""
-    from reportlab.lib.pagesizes import A4, landscape, portrait
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.utils import ImageReader
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    from PIL import Image
-    from io import BytesIO
+        rect = fitz.Rect(x0, y0, x1, y1)
+        page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
 
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    pages = metadata.get('pages', [])
+        try:
+            page.insert_textbox(rect, text, fontsize=10, fontname="china-s", align=0)
+        except:
+            try:
+                page.insert_textbox(rect, text, fontsize=10, align=0)
+            except:
+                pass
+
+
+def compose_translation_only_range(source_path, translations, use_blocks, start, end):
+    """子进程：合成 [start, end) 页的翻译覆盖，返回该区间的 PDF 字节"""
+    import fitz
+
+    doc = fitz.open(source_path)
+    for page_num in range(start, end):
+        trans_data = translations.get(str(page_num + 1))
+        if trans_data:
+            overlay_translations_on_page(doc[page_num], trans_data, use_blocks)
+
+    doc.select(list(range(start, end)))
+    data = doc.tobytes(garbage=1, deflate=True)
+    doc.close()
+    return data
+
+
+def export_side_by_side(file_id, document, translations, orientation='landscape', frontend_blocks=None):
+    """导出左右对照的 PDF"""
+    pages = load_document_pages(document)
 
     # 如果前端传来了翻译块，优先使用
     if frontend_blocks:
         translations = reorganize_translations_from_frontend(frontend_blocks)
-    else:
-        translations = metadata.get('translations', {})
+
+    # 缺少页面尺寸的翻译数据（PDF 坐标的 blocks 需要缩放）从布局索引补齐
+    layout = load_layout_index(os.path.join(TEMP_DIR, file_id))
+    if layout is not None:
+        for page_key, trans_data in translations.items():
+            page_idx = int(page_key) - 1
+            if trans_data.get('page_width') or not (0 <= page_idx < layout_page_count(layout)):
+                continue
+            page_info = layout_page_info(layout, page_idx)
+            trans_data['page_width'] = page_info['width']
+            trans_data['page_height'] = page_info['height']
 
     total_pages = len(pages)
 
+    # 原文页按导出分辨率从 source.pdf 重新渲染（子进程中渲染）
+    source_path = os.path.join(TEMP_DIR, file_id, 'source.pdf')
+    zooms = None
+    if os.path.exists(source_path):
+        import fitz
+
+        with fitz.open(source_path) as doc:
+            if len(doc) == total_pages:
+                _, content_width, content_height = side_by_side_layout(orientation)
+                zooms = render_zooms([page.rect for page in doc], 'export', (content_width, content_height))
+    if zooms is None:
+        source_path = None
+
+    # 只把各区间需要的页面图片传给子进程
+    parts = composite_pages_in_parallel(
+        compose_side_by_side_range,
+        total_pages,
+        lambda start, end: (
+            pages[start:end], start, total_pages,
+            {k: v for k, v in translations.items() if str(k).isdigit() and start < int(k) <= end},
+            orientation, source_path, zooms[start:end] if zooms else None
+        )
+    )
+
+    if parts is None:
+        return compose_side_by_side_range(pages, 0, total_pages, translations, orientation, source_path, zooms)
+
+    merged = merge_pdf_parts(parts)
+    data = merged.tobytes(garbage=3, deflate=True)
+    merged.close()
+    return data
+
+
+SIDE_BY_SIDE_MARGIN = 20
+SIDE_BY_SIDE_GAP = 10
+SIDE_BY_SIDE_LABEL_HEIGHT = 25
+
+
+def side_by_side_layout(orientation):
+    """左右对照导出的纸张尺寸和每侧可用区域 (page_size, content_width, content_height)"""
+    from reportlab.lib.pagesizes import A4, landscape, portrait
+
     # 设置页面尺寸
     if orientation == 'landscape':
         page_size = landscape(A4)  # 842 x 595
@@ -1709,15 +5517,31 @@ def export_side_by_side(file_id, metadata, orientation='landscape', frontend_blo
         page_size = portrait(A4)  # 595 x 842
 
     page_width, page_height = page_size
+    content_width = (page_width - SIDE_BY_SIDE_MARGIN * 2 - SIDE_BY_SIDE_GAP) / 2
+    content_height = page_height - SIDE_BY_SIDE_MARGIN * 2 - SIDE_BY_SIDE_LABEL_HEIGHT
+    return page_size, content_width, content_height
 
-    # 布局参数
-    margin = 20
-    gap = 10
-    label_height = 25
 
-    # 计算每侧可用区域
-    content_width = (page_width - margin * 2 - gap) / 2
-    content_height = page_height - margin * 2 - label_height
+def compose_side_by_side_range(page_images, start, total_pages, translations, orientation='landscape',
+                               source_path=None, zooms=None):
+    """合成左右对照页面（page_images 对应第 start+1 页起），返回 PDF 字节
+
+    传入 source_path 时原文页按 zooms（与 page_images 对应）从源 PDF 重新渲染。
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from PIL import Image
+    from io import BytesIO
+
+    page_size, content_width, content_height = side_by_side_layout(orientation)
+    page_width, page_height = page_size
+
+    # 布局参数
+    margin = SIDE_BY_SIDE_MARGIN
+    gap = SIDE_BY_SIDE_GAP
+    label_height = SIDE_BY_SIDE_LABEL_HEIGHT
 
     # 注册中文字体
     try:
@@ -1730,22 +5554,27 @@ def export_side_by_side(file_id, metadata, orientation='landscape', frontend_blo
     except:
         chinese_font = 'Helvetica'
 
+    source = None
+    if source_path:
+        import fitz
+        source = fitz.open(source_path)
+
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=page_size)
 
-    for page_num in range(total_pages):
+    for offset, original_b64 in enumerate(page_images):
+        page_num = start + offset
         page_key = str(page_num + 1)
 
         # 获取原图
-        original_b64 = pages[page_num]
         if ',' in original_b64:
             original_b64 = original_b64.split(',')[1]
         original_bytes = base64.b64decode(original_b64)
         original_img = Image.open(BytesIO(original_bytes))
 
-        # 生成翻译后图片
+        # 生成翻译后图片（在预览图上叠加，字号与预览一致）
         trans_data = translations.get(page_key, {})
-        translated_img = generate_translated_image(original_img.copy(), trans_data, metadata)
+        translated_img = generate_translated_image(original_img.copy(), trans_data, None)
 
         # 计算图片缩放
         img_w, img_h = original_img.size
@@ -1753,6 +5582,10 @@ def export_side_by_side(file_id, metadata, orientation='landscape', frontend_blo
         scaled_w = img_w * scale
         scaled_h = img_h * scale
 
+        if source is not None:
+            pix = source.load_page(page_num).get_pixmap(matrix=fitz.Matrix(zooms[offset], zooms[offset]), alpha=False)
+            original_img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
         # 左侧 - 原文
         left_x = margin + (content_width - scaled_w) / 2
         y = margin + label_height + (content_height - scaled_h) / 2
@@ -1782,6 +5615,8 @@ def export_side_by_side(file_id, metadata, orientation='landscape', frontend_blo
         c.showPage()
 
     c.save()
+    if source is not None:
+        source.close()
     return buffer.getvalue()
 
 
@@ -1819,7 +5654,7 @@ def generate_translated_image(img, trans_data, metadata):
         bbox = b.get('bbox', [])
         text = b.get('translated', '')
 
-        if not text or len(bbox) < 4:
+        if not text or len(bbox) < 4 or b.get('skip'):
             continue
 
         # bbox 是 [x0, y0, x1, y1] 格式，基于原始 PDF 尺寸
@@ -1881,19 +5716,245 @@ def generate_translated_image(img, trans_data, metadata):
         font = fonts.get(font_size, fonts[10])
         line_height = font_size + 2
 
-        # 计算实际需要的高度
-        actual_height = max(box_height, len(lines) * line_height + 4)
+        # 计算实际需要的高度
+        actual_height = max(box_height, len(lines) * line_height + 4)
+
+        # 绘制白色背景
+        draw.rectangle([x0-2, y0-2, x1+2, y0 + actual_height + 2], fill=(255, 255, 255))
+
+        # 绘制文字
+        current_y = y0 + 2
+        for line in lines:
+            draw.text((x0 + 2, current_y), line, fill=(0, 0, 0), font=font)
+            current_y += line_height
+
+    return img
+
+
+# ============ 并行页面合成 ============
+
+# 导出合成进程数（<=1 时不启用进程池），以及启用并行的最少页数
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', min(4, os.cpu_count() or 1)))
+EXPORT_PARALLEL_MIN_PAGES = int(os.environ.get('EXPORT_PARALLEL_MIN_PAGES', 8))
+
+_export_pool = None
+
+
+def get_export_pool():
+    """获取导出合成用的进程池（懒加载，进程间复用）"""
+    global _export_pool
+    if _export_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS)
+    return _export_pool
+
+
+def split_page_ranges(total_pages, parts):
+    """把 [0, total_pages) 均分为不超过 parts 个连续区间"""
+    parts = max(1, min(parts, total_pages))
+    size, extra = divmod(total_pages, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def composite_pages_in_parallel(worker, total_pages, make_args):
+    """按页码区间并行执行 worker(*make_args(start, end))，按顺序返回各区间结果
+
+    页数不足或未启用进程池时返回 None，由调用方走单进程路径。
+    """
+    global _export_pool
+
+    if EXPORT_WORKERS <= 1 or total_pages < EXPORT_PARALLEL_MIN_PAGES:
+        return None
+
+    # 每个进程分两个区间，页面复杂度不均时负载更平衡
+    ranges = split_page_ranges(total_pages, EXPORT_WORKERS * 2)
+
+    try:
+        pool = get_export_pool()
+        futures = [pool.submit(worker, *make_args(start, end)) for start, end in ranges]
+        return [f.result() for f in futures]
+    except Exception as e:
+        # 进程池异常（如子进程崩溃）时重建，本次退回单进程
+        print(f"Parallel compositing failed, falling back to serial: {e}")
+        try:
+            _export_pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+        _export_pool = None
+        return None
+
+
+def merge_pdf_parts(parts):
+    """按顺序合并各区间的 PDF 字节"""
+    import fitz
+
+    merged = fitz.open()
+    for part in parts:
+        part_doc = fitz.open('pdf', part)
+        merged.insert_pdf(part_doc)
+        part_doc.close()
+    return merged
+
+
+# ============ 导出缓存 ============
+
+EXPORT_CACHE_DIRNAME = 'export_cache'
+EXPORT_CACHE_VERSION = 2
+# 单个文档 / 全局的导出缓存上限（MB）
+EXPORT_CACHE_FILE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_FILE_MAX_MB', 50)) * 1024 * 1024
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_MB', 300)) * 1024 * 1024
+
+_file_digest_cache = {}  # path -> (size, mtime, sha256)
+
+
+def file_sha256(path):
+    """计算文件 SHA-256（按 size + mtime 缓存，避免重复读取大文件）"""
+    import hashlib
+
+    stat = os.stat(path)
+    cached = _file_digest_cache.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _file_digest_cache[path] = (stat.st_size, stat.st_mtime, digest)
+    return digest
+
+
+def export_font_signature():
+    """导出所用字体集的标识（字体文件变化时缓存失效）"""
+    font_path = "C:/Windows/Fonts/msyh.ttc"
+    if os.path.exists(font_path):
+        stat = os.stat(font_path)
+        return f'china-s|msyh:{stat.st_size}:{int(stat.st_mtime)}'
+    return 'china-s|default'
+
+
+def normalize_export_translations(translations):
+    """规范化翻译数据：只保留影响导出结果的字段，坐标统一精度"""
+    def num(value, default=0):
+        try:
+            return round(float(value), 2)
+        except (TypeError, ValueError):
+            return default
+
+    normalized = []
+    for page_key in sorted(translations, key=lambda k: int(k) if str(k).isdigit() else 0):
+        trans_data = translations[page_key] or {}
+        blocks = [
+            [[num(v) for v in b.get('bbox', [])[:4]], b.get('translated', ''), num(b.get('font_size', 12), 12)]
+            for b in trans_data.get('blocks', [])
+            if b.get('translated') and not b.get('skip')
+        ]
+        region_blocks = [
+            [num(rb.get('x', 0)), num(rb.get('y', 0)), num(rb.get('width', 0)), num(rb.get('height', 0)),
+             rb.get('text', '')]
+            for rb in trans_data.get('region_blocks', [])
+            if rb.get('text')
+        ]
+        if not blocks and not region_blocks:
+            continue
+        normalized.append([
+            str(page_key),
+            num(trans_data.get('page_width', 0)),
+            num(trans_data.get('page_height', 0)),
+            blocks,
+            region_blocks
+        ])
+    return normalized
+
+
+def compute_export_key(source_path, translations, mode, orientation):
+    """根据 (源 PDF, 翻译块, 模式, 方向, 字体, 原文页渲染设置) 计算导出缓存键"""
+    import hashlib
+
+    state = {
+        'v': EXPORT_CACHE_VERSION,
+        'source': file_sha256(source_path),
+        'mode': mode,
+        # 仅左右对照模式受页面方向影响
+        'orientation': orientation if mode == 'side_by_side' else '',
+        # 左右对照的原文页按导出分辨率重新渲染
+        'render': [RENDER_EXPORT_DPI, RENDER_PAGE_MAX_PIXELS, RENDER_REQUEST_MAX_PIXELS,
+                   RENDER_MIN_ZOOM, RENDER_MAX_ZOOM] if mode == 'side_by_side' else [],
+        'fonts': export_font_signature(),
+        'translations': normalize_export_translations(translations)
+    }
+    raw = json.dumps(state, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def export_cache_get(file_id, key):
+    """读取导出缓存，命中时刷新访问时间"""
+    path = os.path.join(TEMP_DIR, file_id, EXPORT_CACHE_DIRNAME, f'{key}.pdf')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path, None)
+        return data
+    except OSError:
+        return None
+
 
-        # 绘制白色背景
-        draw.rectangle([x0-2, y0-2, x1+2, y0 + actual_height + 2], fill=(255, 255, 255))
+def export_cache_put(file_id, key, data):
+    """写入导出缓存，并按单文档和全局上限淘汰最久未用的条目"""
+    cache_dir = os.path.join(TEMP_DIR, file_id, EXPORT_CACHE_DIRNAME)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{key}.pdf')
+        tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        evict_export_cache(list_export_cache_entries(cache_dir), EXPORT_CACHE_FILE_MAX_BYTES)
+
+        all_entries = []
+        for name in os.listdir(TEMP_DIR):
+            all_entries.extend(list_export_cache_entries(os.path.join(TEMP_DIR, name, EXPORT_CACHE_DIRNAME)))
+        evict_export_cache(all_entries, EXPORT_CACHE_MAX_BYTES)
+    except OSError as e:
+        print(f"Export cache write failed: {e}")
+
+
+def list_export_cache_entries(cache_dir):
+    """列出缓存目录中的条目 [(mtime, size, path)]"""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.pdf'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
 
-        # 绘制文字
-        current_y = y0 + 2
-        for line in lines:
-            draw.text((x0 + 2, current_y), line, fill=(0, 0, 0), font=font)
-            current_y += line_height
 
-    return img
+def evict_export_cache(entries, max_bytes):
+    """LRU 淘汰：按访问时间从旧到新删除，直到总大小不超过上限"""
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
 
 
 # ============ 导出功能 (旧版) ============
@@ -1976,11 +6037,610 @@ def export_pdf():
         return jsonify({'success': False, 'error': str(e)})
 
 
+# ============ PPT 处理 (SPEC-005) ============
+#
+# 文本按段落提取（段落是翻译单位），同时记录段落内每个 run 的文字和字体，位置用
+# loc = [shape_id, 表格行, 表格列, 段落序号] 标识。替换时译文写回原段落并沿用第一个
+# 有文字的 run 的字体格式。translated.pptx 按页增量更新：只改写本次翻译的幻灯片；
+# 预览图按页缓存为 translated_images/slide_{n}.png，只重新渲染改动的页。
+# 渲染优先使用 LibreOffice（转 PDF 后用 PyMuPDF 出图），未安装时用 Pillow 按形状位置绘制简易预览。
+
+PPT_PREVIEW_WIDTH = 1280  # Pillow 简易预览宽度（像素）
+SOFFICE_TIMEOUT = int(os.environ.get('SOFFICE_TIMEOUT', 120))  # 单次转换超时（秒）
+
+_ppt_locks = {}  # translated.pptx 路径 -> 锁，同一文档的增量更新串行执行
+_ppt_locks_lock = threading.Lock()
+
+
+def ppt_lock(path):
+    with _ppt_locks_lock:
+        return _ppt_locks.setdefault(path, threading.Lock())
+
+
+def iter_text_frames(shapes):
+    """遍历形状中的文本框（含组合内的形状和表格单元格），产出 (shape, 行, 列, text_frame)"""
+    from pptx.shapes.group import GroupShape
+
+    for shape in shapes:
+        if isinstance(shape, GroupShape):
+            yield from iter_text_frames(shape.shapes)
+        elif getattr(shape, 'has_table', False):
+            for r, row in enumerate(shape.table.rows):
+                for c, cell in enumerate(row.cells):
+                    yield shape, r, c, cell.text_frame
+        elif shape.has_text_frame:
+            yield shape, None, None, shape.text_frame
+
+
+def slide_paragraphs(slide):
+    """幻灯片内全部段落 {loc: paragraph}"""
+    paragraphs = {}
+    for shape, row, col, text_frame in iter_text_frames(slide.shapes):
+        for p_idx, paragraph in enumerate(text_frame.paragraphs):
+            paragraphs[(shape.shape_id, row, col, p_idx)] = paragraph
+    return paragraphs
+
+
+def extract_slide_texts(slide):
+    """提取一页幻灯片的文本段落（跳过空段落）"""
+    texts = []
+    for loc, paragraph in slide_paragraphs(slide).items():
+        text = paragraph.text.replace('\v', '\n')
+        if not text.strip():
+            continue
+        texts.append({
+            'text': text,
+            'loc': list(loc),
+            'runs': [
+                {
+                    'text': run.text,
+                    'font_size': run.font.size.pt if run.font.size else None,
+                    'font_name': run.font.name
+                }
+                for run in paragraph.runs
+            ]
+        })
+    return texts
+
+
+def extract_ppt_texts(pptx_path):
+    """提取所有幻灯片的文本段落，返回每页一个列表"""
+    from pptx import Presentation
+
+    prs = Presentation(pptx_path)
+    return [extract_slide_texts(slide) for slide in prs.slides]
+
+
+def replace_paragraph_text(paragraph, text):
+    """替换段落文字，沿用第一个有文字的 run 的字体格式"""
+    import copy
+    from pptx.oxml.ns import qn
+
+    rpr = None
+    for run in paragraph.runs:
+        if run.text.strip():
+            rpr = run._r.find(qn('a:rPr'))
+            break
+
+    paragraph.text = text  # 换行转为 <a:br/>
+    if rpr is None:
+        return
+    for r in paragraph._p.findall(qn('a:r')) + paragraph._p.findall(qn('a:br')):
+        old = r.find(qn('a:rPr'))
+        if old is not None:
+            r.remove(old)
+        r.insert(0, copy.deepcopy(rpr))
+
+
+def replace_ppt_texts(source_path, translations, output_path):
+    """把译文写入 output_path，只改动 translations 中的幻灯片
+
+    translations 为 {页序号(0 起): [{'loc', 'text'}]}；output_path 已存在时在其基础上
+    增量修改（保留之前翻译过的页），否则从源文件开始。
+    """
+    from pptx import Presentation
+
+    base_path = output_path if os.path.exists(output_path) else source_path
+    prs = Presentation(base_path)
+    slides = list(prs.slides)
+
+    for slide_idx, items in translations.items():
+        if not 0 <= slide_idx < len(slides):
+            continue
+        paragraphs = slide_paragraphs(slides[slide_idx])
+        for item in items:
+            paragraph = paragraphs.get(tuple(item.get('loc') or ()))
+            if paragraph is not None:
+                replace_paragraph_text(paragraph, item['text'])
+
+    tmp_path = f'{output_path}.{uuid.uuid4().hex[:8]}.tmp'
+    prs.save(tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def find_soffice(config=None):
+    """查找 LibreOffice 可执行文件：配置路径 > PATH > Windows 默认安装位置"""
+    import shutil
+
+    config = config if config is not None else read_config()
+    candidates = [config.get('soffice_path'), shutil.which('soffice'), shutil.which('libreoffice')]
+    if sys.platform == 'win32':
+        candidates += [
+            r'C:\Program Files\LibreOffice\program\soffice.exe',
+            r'C:\Program Files (x86)\LibreOffice\program\soffice.exe',
+        ]
+    for path in candidates:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def ppt_subset(pptx_path, slides, output_path):
+    """只保留指定幻灯片另存（单页渲染时避免转换整份文档）"""
+    from pptx import Presentation
+
+    prs = Presentation(pptx_path)
+    keep = set(slides)
+    slide_ids = prs.slides._sldIdLst
+    for idx, slide_id in reversed(list(enumerate(slide_ids))):
+        if idx not in keep:
+            prs.part.drop_rel(slide_id.rId)
+            slide_ids.remove(slide_id)
+    prs.save(output_path)
+
+
+def render_ppt_with_soffice(binary, pptx_path, slides):
+    """LibreOffice 转 PDF 后逐页出图，返回 {页序号: PNG 字节}"""
+    import fitz
+    import time
+    import shutil
+    import tempfile
+
+    started = time.perf_counter()
+    workdir = tempfile.mkdtemp(prefix='ppt_render_')
+    try:
+        input_path = os.path.join(workdir, 'deck.pptx')
+        if slides is None:
+            shutil.copyfile(pptx_path, input_path)
+        else:
+            ppt_subset(pptx_path, slides, input_path)
+
+        pdf_path = os.path.join(workdir, 'deck.pdf')
+        soffice_convert_to_pdf(binary, input_path, pdf_path)
+
+        doc = fitz.open(pdf_path)
+        order = sorted(set(slides)) if slides is not None else range(len(doc))
+        zooms = render_zooms([page.rect for page in doc], 'display')
+        images = {}
+        for page, slide_idx, zoom in zip(doc, order, zooms):
+            images[slide_idx] = render_page_png(page, zoom)
+        doc.close()
+
+        record_slide_render_time(time.perf_counter() - started, len(images))
+        return images
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def draw_slide_preview(prs, slide):
+    """未安装 LibreOffice 时的简易预览：按形状位置绘制图片和文字，返回 PNG 字节"""
+    from PIL import Image, ImageDraw, ImageFont
+    from io import BytesIO
+    from pptx.shapes.picture import Picture
+
+    scale = PPT_PREVIEW_WIDTH / prs.slide_width
+    img = Image.new('RGB', (PPT_PREVIEW_WIDTH, int(prs.slide_height * scale)), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    def box(shape):
+        return [int((shape.left or 0) * scale), int((shape.top or 0) * scale),
+                int(((shape.left or 0) + (shape.width or 0)) * scale),
+                int(((shape.top or 0) + (shape.height or 0)) * scale)]
+
+    def load_font(size):
+        try:
+            return ImageFont.truetype("C:/Windows/Fonts/msyh.ttc", size)
+        except Exception:
+            try:
+                return ImageFont.load_default(size=size)
+            except TypeError:
+                return ImageFont.load_default()
+
+    # 图片
+    for shape in slide.shapes:
+        if not isinstance(shape, Picture):
+            continue
+        try:
+            x0, y0, x1, y1 = box(shape)
+            picture = Image.open(BytesIO(shape.image.blob)).convert('RGB')
+            img.paste(picture.resize((max(1, x1 - x0), max(1, y1 - y0))), (x0, y0))
+        except Exception:
+            continue
+
+    # 文字（表格单元格按行高列宽定位）
+    for shape, row, col, text_frame in iter_text_frames(slide.shapes):
+        text = text_frame.text.replace('\v', '\n').strip()
+        if not text:
+            continue
+        x0, y0, x1, y1 = box(shape)
+        if row is not None:
+            columns = shape.table.columns
+            rows = shape.table.rows
+            x0 += int(sum(columns[i].width for i in range(col)) * scale)
+            y0 += int(sum(rows[i].height for i in range(row)) * scale)
+            x1 = x0 + int(columns[col].width * scale)
+        sizes = [run.font.size.pt for p in text_frame.paragraphs for run in p.runs if run.font.size]
+        font = load_font(max(8, int((sizes[0] if sizes else 18) * 12700 * scale)))
+        line_height = int(getattr(font, 'size', 11) * 1.3)
+        y = y0
+        for line in wrap_text(text, font, max(10, x1 - x0), draw):
+            if y > img.height:
+                break
+            draw.text((x0, y), line, fill=(0, 0, 0), font=font)
+            y += line_height
+
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_ppt_slides(pptx_path, slides=None):
+    """渲染幻灯片预览，返回 {页序号: PNG 字节}；slides 为 None 时渲染全部"""
+    binary = find_soffice()
+    if binary:
+        try:
+            return render_ppt_with_soffice(binary, pptx_path, slides)
+        except Exception as e:
+            print(f"LibreOffice render failed, falling back to simple preview: {e}")
+
+    from pptx import Presentation
+
+    prs = Presentation(pptx_path)
+    all_slides = list(prs.slides)
+    indices = range(len(all_slides)) if slides is None else slides
+    return {idx: draw_slide_preview(prs, all_slides[idx]) for idx in indices if 0 <= idx < len(all_slides)}
+
+
+def png_data_url(png_bytes):
+    return 'data:image/png;base64,' + base64.b64encode(png_bytes).decode('utf-8')
+
+
+def convert_ppt_to_images(pptx_path, output_dir=None, slides=None):
+    """幻灯片预览图 data URL 列表
+
+    output_dir 为预览缓存目录（slide_{n}.png）：指定 slides 时只重新渲染这些页，
+    其余页读取缓存（尚未渲染的页为 None）。
+    """
+    from pptx import Presentation
+
+    images = render_ppt_slides(pptx_path, slides)
+    if output_dir is None:
+        return [png_data_url(images[idx]) for idx in sorted(images)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    for idx, png_bytes in images.items():
+        with open(os.path.join(output_dir, f'slide_{idx + 1}.png'), 'wb') as f:
+            f.write(png_bytes)
+
+    pages = []
+    for idx in range(len(Presentation(pptx_path).slides)):
+        if idx in images:
+            pages.append(png_data_url(images[idx]))
+            continue
+        cached = os.path.join(output_dir, f'slide_{idx + 1}.png')
+        if os.path.exists(cached):
+            with open(cached, 'rb') as f:
+                pages.append(png_data_url(f.read()))
+        else:
+            pages.append(None)
+    return pages
+
+
+# ============ LibreOffice 渲染进程池 ============
+#
+# 每次转换都启动 soffice 要付出数秒冷启动。这里常驻至多 SOFFICE_WORKERS 个 headless soffice
+# （监听本机端口，各自独立的用户配置目录），通过 UNO 提交转换。空闲进程放在队列里，转换请求
+# 排队等待；取出时检查健康状态（进程存活且 UNO 连接可用），完成 SOFFICE_MAX_JOBS 次转换后
+# 回收重启，单次转换超过 SOFFICE_TIMEOUT 时结束该进程。进程在首次使用时才启动。
+# Python 环境没有 uno 模块（或 SOFFICE_POOL=0）时退回每次启动 soffice 转换。
+# 每页渲染耗时（转换 + 出图，按页数均摊）保留最近 SOFFICE_STATS_WINDOW 页，统计 p50/p95。
+
+SOFFICE_POOL = os.environ.get('SOFFICE_POOL', '1') != '0'
+SOFFICE_WORKERS = int(os.environ.get('SOFFICE_WORKERS', 2))
+SOFFICE_MAX_JOBS = int(os.environ.get('SOFFICE_MAX_JOBS', 50))
+SOFFICE_QUEUE_TIMEOUT = int(os.environ.get('SOFFICE_QUEUE_TIMEOUT', 300))  # 排队等待上限（秒）
+SOFFICE_START_TIMEOUT = 30  # 等待新进程接受 UNO 连接（秒）
+SOFFICE_STATS_WINDOW = 500
+
+_soffice_pool = None  # {'binary', 'idle': 空闲队列（None 表示尚未启动的槽位）, 'workers': {port: worker}}
+_soffice_pool_lock = threading.Lock()
+_soffice_stats = {'pool_jobs': 0, 'cold_jobs': 0, 'starts': 0, 'recycled': 0, 'failures': 0}
+_soffice_slide_times = []  # 最近每页渲染耗时（秒）
+_soffice_queue_waits = []  # 最近排队等待时间（秒）
+
+
+def load_uno():
+    """LibreOffice 的 UNO Python 绑定（可选依赖）"""
+    try:
+        import uno
+        return uno
+    except ImportError:
+        return None
+
+
+def soffice_process_kwargs():
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = 0x08000000  # CREATE_NO_WINDOW
+    return kwargs
+
+
+def profile_url(path):
+    return 'file:///' + path.replace('\\', '/').lstrip('/')
+
+
+def soffice_convert_cold(binary, input_path, output_path):
+    """启动一次 soffice 完成转换（无 UNO 时使用）"""
+    import shutil
+    import subprocess
+    import tempfile
+
+    outdir = tempfile.mkdtemp(prefix='soffice_out_')
+    try:
+        subprocess.run(
+            [binary, f"-env:UserInstallation={profile_url(os.path.join(outdir, 'profile'))}",
+             '--headless', '--norestore', '--convert-to', 'pdf', '--outdir', outdir, input_path],
+            capture_output=True, timeout=SOFFICE_TIMEOUT, **soffice_process_kwargs()
+        )
+        converted = os.path.join(outdir, os.path.splitext(os.path.basename(input_path))[0] + '.pdf')
+        if not os.path.exists(converted):
+            raise RuntimeError('LibreOffice 转换失败')
+        os.replace(converted, output_path)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+
+def free_local_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_soffice_worker(binary):
+    """启动一个监听模式的 soffice 并建立 UNO 连接"""
+    import time
+    import tempfile
+    import subprocess
+
+    uno = load_uno()
+    port = free_local_port()
+    profile = tempfile.mkdtemp(prefix='soffice_profile_')
+    process = subprocess.Popen(
+        [binary, f'-env:UserInstallation={profile_url(profile)}',
+         '--headless', '--invisible', '--nologo', '--nodefault', '--norestore', '--nolockcheck',
+         f'--accept=socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **soffice_process_kwargs()
+    )
+    worker = {'process': process, 'port': port, 'profile': profile, 'jobs': 0, 'desktop': None,
+              'started': time.time()}
+
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+    deadline = time.time() + SOFFICE_START_TIMEOUT
+    while True:
+        try:
+            ctx = resolver.resolve(f'uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext')
+            worker['desktop'] = ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+            break
+        except Exception:
+            if process.poll() is not None or time.time() > deadline:
+                stop_soffice_worker(worker)
+                raise RuntimeError('LibreOffice 进程启动失败')
+            time.sleep(0.25)
+
+    _soffice_stats['starts'] += 1
+    print(f"LibreOffice worker started on port {port}")
+    return worker
+
+
+def stop_soffice_worker(worker):
+    import shutil
+    import subprocess
+
+    process = worker['process']
+    try:
+        if worker.get('desktop') is not None and process.poll() is None:
+            worker['desktop'].terminate()
+        else:
+            process.terminate()
+    except Exception:
+        pass
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    shutil.rmtree(worker['profile'], ignore_errors=True)
+
+
+def soffice_worker_healthy(worker):
+    """进程存活且 UNO 连接可用"""
+    if worker['process'].poll() is not None:
+        return False
+    try:
+        worker['desktop'].getFrames().getCount()
+        return True
+    except Exception:
+        return False
+
+
+def uno_convert_to_pdf(worker, input_path, output_path):
+    """在常驻进程中打开文档并导出 PDF；超时则结束进程（UNO 调用随之报错）"""
+    uno = load_uno()
+    from com.sun.star.beans import PropertyValue
+
+    def props(**values):
+        result = []
+        for name, value in values.items():
+            prop = PropertyValue()
+            prop.Name = name
+            prop.Value = value
+            result.append(prop)
+        return tuple(result)
+
+    watchdog = threading.Timer(SOFFICE_TIMEOUT, worker['process'].kill)
+    watchdog.start()
+    try:
+        doc = worker['desktop'].loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(input_path)), '_blank', 0, props(Hidden=True, ReadOnly=True)
+        )
+        if doc is None:
+            raise RuntimeError('LibreOffice 无法打开文档')
+        try:
+            doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)),
+                           props(FilterName='impress_pdf_Export'))
+        finally:
+            doc.close(True)
+    finally:
+        watchdog.cancel()
+
+
+def get_soffice_pool(binary):
+    """获取渲染进程池（懒加载，进程在首次取用时启动）"""
+    global _soffice_pool
+    import queue
+    import atexit
+
+    with _soffice_pool_lock:
+        if _soffice_pool is None or _soffice_pool['binary'] != binary:
+            idle = queue.Queue()
+            for _ in range(SOFFICE_WORKERS):
+                idle.put(None)
+            _soffice_pool = {'binary': binary, 'idle': idle, 'workers': {}}
+            atexit.register(shutdown_soffice_pool, _soffice_pool)
+        return _soffice_pool
+
+
+def shutdown_soffice_pool(pool):
+    for worker in list(pool['workers'].values()):
+        stop_soffice_worker(worker)
+    pool['workers'].clear()
+
+
+def retire_soffice_worker(pool, worker, reason):
+    pool['workers'].pop(worker['port'], None)
+    stop_soffice_worker(worker)
+    print(f"LibreOffice worker on port {worker['port']} retired ({reason}, {worker['jobs']} jobs)")
+
+
+def append_sample(samples, value, window=None):
+    window = window or SOFFICE_STATS_WINDOW
+    samples.append(value)
+    if len(samples) > window:
+        del samples[:len(samples) - window]
+
+
+def soffice_convert_to_pdf(binary, input_path, output_path):
+    """转换为 PDF：有 UNO 时由进程池中的常驻进程完成，否则启动一次 soffice"""
+    import time
+    import queue
+
+    if not SOFFICE_POOL or load_uno() is None:
+        soffice_convert_cold(binary, input_path, output_path)
+        _soffice_stats['cold_jobs'] += 1
+        return
+
+    pool = get_soffice_pool(binary)
+    waited = time.perf_counter()
+    try:
+        worker = pool['idle'].get(timeout=SOFFICE_QUEUE_TIMEOUT)
+    except queue.Empty:
+        raise RuntimeError('渲染队列繁忙，请稍后重试')
+    append_sample(_soffice_queue_waits, time.perf_counter() - waited)
+
+    try:
+        if worker is not None and worker['jobs'] >= SOFFICE_MAX_JOBS:
+            retire_soffice_worker(pool, worker, 'recycle')
+            _soffice_stats['recycled'] += 1
+            worker = None
+        elif worker is not None and not soffice_worker_healthy(worker):
+            retire_soffice_worker(pool, worker, 'unhealthy')
+            worker = None
+        if worker is None:
+            worker = start_soffice_worker(binary)
+            pool['workers'][worker['port']] = worker
+
+        uno_convert_to_pdf(worker, input_path, output_path)
+        worker['jobs'] += 1
+        _soffice_stats['pool_jobs'] += 1
+    except Exception:
+        _soffice_stats['failures'] += 1
+        if worker is not None:
+            retire_soffice_worker(pool, worker, 'failed')
+            worker = None
+        raise
+    finally:
+        pool['idle'].put(worker)
+
+
+def record_slide_render_time(seconds, slides):
+    for _ in range(slides):
+        append_sample(_soffice_slide_times, seconds / slides)
+
+
+def percentile_ms(samples, pct):
+    if not samples:
+        return None
+    values = sorted(samples)
+    k = max(0, min(len(values) - 1, int(round(pct / 100 * (len(values) - 1)))))
+    return round(values[k] * 1000, 1)
+
+
+@app.route('/api/ppt/render-stats', methods=['GET'])
+def ppt_render_stats():
+    """幻灯片渲染统计：进程池状态、每页渲染耗时 p50/p95、排队等待 p95"""
+    binary = find_soffice()
+    if not binary:
+        mode = 'preview'  # 未安装 LibreOffice，使用 Pillow 简易预览
+    elif SOFFICE_POOL and load_uno() is not None:
+        mode = 'pool'
+    else:
+        mode = 'cold'
+
+    pool = _soffice_pool
+    workers = []
+    if pool is not None:
+        workers = [
+            {'port': w['port'], 'jobs': w['jobs'], 'alive': w['process'].poll() is None}
+            for w in list(pool['workers'].values())
+        ]
+
+    slide_times = list(_soffice_slide_times)
+    return jsonify({
+        'success': True,
+        'mode': mode,
+        'workers': workers,
+        'max_workers': SOFFICE_WORKERS,
+        'max_jobs': SOFFICE_MAX_JOBS,
+        'stats': dict(_soffice_stats),
+        'slides': len(slide_times),
+        'slide_ms_p50': percentile_ms(slide_times, 50),
+        'slide_ms_p95': percentile_ms(slide_times, 95),
+        'queue_wait_ms_p95': percentile_ms(list(_soffice_queue_waits), 95)
+    })
+
+
 # ============ 统一文档 API (SPEC-006) ============
 
 @app.route('/api/doc/upload', methods=['POST'])
 def doc_upload():
     """统一文档上传 API - 支持 PDF 和 PPT"""
+    too_large = check_upload_length()
+    if too_large:
+        return jsonify({'success': False, 'error': too_large})
+
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': '没有上传文件'})
 
@@ -1989,44 +6649,25 @@ def doc_upload():
         return jsonify({'success': False, 'error': '文件名为空'})
 
     filename = file.filename.lower()
-    file_id = uuid.uuid4().hex[:8]
-    upload_dir = os.path.join(TEMP_DIR, file_id)
-    os.makedirs(upload_dir, exist_ok=True)
 
     # 检测文件类型
     if filename.endswith('.pdf'):
         doc_type = 'pdf'
-        source_file = 'source.pdf'
     elif filename.endswith('.pptx') or filename.endswith('.ppt'):
         doc_type = 'ppt'
-        source_file = 'source.pptx'
     else:
         return jsonify({'success': False, 'error': '不支持的文件格式，请上传 PDF 或 PPT'})
 
     try:
-        file_path = os.path.join(upload_dir, source_file)
-        file.save(file_path)
-
-        if doc_type == 'pdf':
-            pages = convert_pdf_to_images(file_path)
-            texts = []  # PDF 暂不提取文本结构
-        else:
-            pages = convert_ppt_to_images(file_path, upload_dir)
-            texts = extract_ppt_texts(file_path)
+        file_id, upload_dir, content_hash, content = ingest_upload(file, doc_type)
+        pages = content['pages']
+        texts = content['texts']
 
         if not pages:
+            delete_document(file_id, content_hash)
             return jsonify({'success': False, 'error': f'无法解析 {doc_type.upper()} 文件'})
 
-        # 保存元数据
-        metadata = {
-            'type': doc_type,
-            'filename': file.filename,
-            'total': len(pages),
-            'texts': texts,
-            'translations': {}  # 每页翻译状态
-        }
-        with open(os.path.join(upload_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        create_document(file_id, doc_type, file.filename, content_hash, content)
 
         return jsonify({
             'success': True,
@@ -2044,6 +6685,7 @@ def doc_upload():
 
 
 @app.route('/api/doc/translate', methods=['POST'])
+@upstream_class('page')
 def doc_translate():
     """统一翻译 API - 翻译单页"""
     data = request.get_json()
@@ -2055,16 +6697,13 @@ def doc_translate():
         return jsonify({'success': False, 'error': '缺少 file_id'})
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
+    document = load_document(file_id)
 
-    if not os.path.exists(metadata_path):
+    if document is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        doc_type = metadata.get('type', 'pdf')
+        doc_type = document['type']
         page_idx = page - 1
 
         # 获取翻译 API 配置
@@ -2075,30 +6714,38 @@ def doc_translate():
         if not api_key or not endpoint_id:
             return jsonify({'success': False, 'error': '未配置翻译 API，请在设置中配置豆包 API'})
 
+        direction = 'en2zh' if target_lang == 'zh' else 'zh2en'
+
         if doc_type == 'ppt':
             # PPT: 提取文本框翻译
-            texts = metadata.get('texts', [])
+            texts = document['texts']
             if page_idx < 0 or page_idx >= len(texts):
                 return jsonify({'success': False, 'error': '页码无效'})
 
-            page_texts = texts[page_idx]
-            original_texts = [t['text'] for t in page_texts if t.get('text', '').strip()]
+            page_texts = [t for t in texts[page_idx] if t.get('text', '').strip()]
+            original_texts = [t['text'] for t in page_texts]
 
             if not original_texts:
+                pages = load_document_pages(document)
                 return jsonify({
                     'success': True,
                     'page': page,
                     'message': '该页无文本内容',
-                    'preview': metadata.get('pages', [])[page_idx] if page_idx < len(metadata.get('pages', [])) else None
+                    'preview': pages[page_idx] if page_idx < len(pages) else None
                 })
 
-            # 批量翻译
-            combined_text = '\n---\n'.join(original_texts)
-            translated_combined = translate_with_doubao(combined_text, target_lang, api_key, endpoint_id)
-            translated_texts = translated_combined.split('\n---\n')
-
-            while len(translated_texts) < len(original_texts):
-                translated_texts.append(original_texts[len(translated_texts)])
+            # 批量翻译（免译段落原样保留）
+            stats = {}
+            translated_texts = translate_texts_batched(
+                original_texts,
+                lambda text, references=None: translate_with_doubao(
+                    text, target_lang, api_key, endpoint_id, references
+                ),
+                separator='\n---\n',
+                stats=stats,
+                direction=direction,
+                memory=direction
+            )
 
             # 保存翻译结果
             trans_data = {
@@ -2106,30 +6753,20 @@ def doc_translate():
                 'original': original_texts,
                 'translated': translated_texts[:len(original_texts)]
             }
-            with open(os.path.join(upload_dir, f'trans_page_{page}.json'), 'w', encoding='utf-8') as f:
-                json.dump(trans_data, f, ensure_ascii=False, indent=2)
+            save_state_file(os.path.join(upload_dir, f'trans_page_{page}.state'), trans_data)
 
-            # 生成翻译后的 PPT 和预览
+            # 只改写并重新渲染本页，其余页沿用 translated.pptx 和预览缓存
             source_path = os.path.join(upload_dir, 'source.pptx')
             translated_path = os.path.join(upload_dir, 'translated.pptx')
-
-            # 读取所有已翻译页面
-            all_trans = []
-            for i in range(len(texts)):
-                tf = os.path.join(upload_dir, f'trans_page_{i+1}.json')
-                if os.path.exists(tf):
-                    with open(tf, 'r', encoding='utf-8') as f:
-                        pt = json.load(f)
-                        all_trans.append(pt.get('translated', []))
-                else:
-                    all_trans.append([t['text'] for t in texts[i]])
-
-            replace_ppt_texts(source_path, all_trans, translated_path)
-
-            # 生成预览图
             trans_dir = os.path.join(upload_dir, 'translated_images')
-            os.makedirs(trans_dir, exist_ok=True)
-            trans_pages = convert_ppt_to_images(translated_path, trans_dir)
+            slide_trans = [
+                {'loc': t.get('loc'), 'text': translated}
+                for t, translated in zip(page_texts, trans_data['translated'])
+                if translated != t['text']  # 未改动的段落保留原有格式
+            ]
+            with ppt_lock(translated_path):
+                replace_ppt_texts(source_path, {page_idx: slide_trans}, translated_path)
+                trans_pages = convert_ppt_to_images(translated_path, trans_dir, slides=[page_idx])
             preview = trans_pages[page_idx] if page_idx < len(trans_pages) else None
 
             return jsonify({
@@ -2137,19 +6774,21 @@ def doc_translate():
                 'page': page,
                 'original_texts': original_texts,
                 'translated_texts': translated_texts[:len(original_texts)],
-                'preview': preview
+                'preview': preview,
+                'skipped': stats.get('skipped', {})
             })
 
         else:
             # PDF: 使用豆包视觉模型直接翻译整页
-            pages = metadata.get('pages', [])
+            pages = load_document_pages(document)
             if page_idx < 0 or page_idx >= len(pages):
                 return jsonify({'success': False, 'error': '页码无效'})
 
             page_image = pages[page_idx]
 
-            # 使用豆包视觉模型翻译
-            result = translate_image_with_doubao(page_image, target_lang, api_key, endpoint_id)
+            # 使用豆包视觉模型翻译（按视觉模型输入尺寸重新渲染）
+            vision_image = render_source_page(upload_dir, page_idx, 'vision') or page_image
+            result = translate_image_with_doubao(vision_image, target_lang, api_key, endpoint_id)
 
             if result.get('success'):
                 # 保存翻译结果
@@ -2159,8 +6798,7 @@ def doc_translate():
                     'translated_text': result.get('translation', ''),
                     'blocks': result.get('blocks', [])  # 文本块位置信息
                 }
-                with open(os.path.join(upload_dir, f'trans_page_{page}.json'), 'w', encoding='utf-8') as f:
-                    json.dump(trans_data, f, ensure_ascii=False, indent=2)
+                save_state_file(os.path.join(upload_dir, f'trans_page_{page}.state'), trans_data)
 
                 return jsonify({
                     'success': True,
@@ -2178,6 +6816,7 @@ def doc_translate():
         return jsonify({'success': False, 'error': str(e)})
 
 
+@image_cached('image_translate', ok=lambda result: result.get('success'))
 def translate_image_with_doubao(image_data, target_lang, api_key, endpoint_id):
     """使用豆包视觉模型翻译图片中的文字"""
     import urllib.request
@@ -2187,8 +6826,7 @@ def translate_image_with_doubao(image_data, target_lang, api_key, endpoint_id):
     else:
         prompt = "请识别图片中的所有文字，并将其翻译成英文。请按以下格式返回：\n原文：[识别到的原文]\n翻译：[翻译结果]"
 
-    if ',' in image_data:
-        image_data = image_data.split(',')[1]
+    image_url = prepare_vision_image(image_data)
 
     payload = {
         "model": endpoint_id,
@@ -2197,7 +6835,7 @@ def translate_image_with_doubao(image_data, target_lang, api_key, endpoint_id):
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
+                    {"type": "image_url", "image_url": {"url": image_url}}
                 ]
             }
         ],
@@ -2211,8 +6849,7 @@ def translate_image_with_doubao(image_data, target_lang, api_key, endpoint_id):
         req.add_header('Content-Type', 'application/json')
         req.add_header('Authorization', f'Bearer {api_key}')
 
-        with urllib.request.urlopen(req, timeout=60) as response:
-            result = json.loads(response.read().decode('utf-8'))
+        result = upstream_json(req, timeout=60)
 
         content = result['choices'][0]['message']['content']
 
@@ -2237,6 +6874,8 @@ def translate_image_with_doubao(image_data, target_lang, api_key, endpoint_id):
 
 
 @app.route('/api/doc/translate-all', methods=['POST'])
+@upstream_class('bulk')
+@translation_job('translate_all')
 def doc_translate_all():
     """统一翻译 API - 翻译全部页面"""
     data = request.get_json()
@@ -2247,17 +6886,14 @@ def doc_translate_all():
         return jsonify({'success': False, 'error': '缺少 file_id'})
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
+    document = load_document(file_id)
 
-    if not os.path.exists(metadata_path):
+    if document is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        doc_type = metadata.get('type', 'pdf')
-        total_pages = metadata.get('total', 0)
+        doc_type = document['type']
+        total_pages = document['total']
 
         config = read_config()
         api_key = config.get('doubao_api_key')
@@ -2267,66 +6903,109 @@ def doc_translate_all():
             return jsonify({'success': False, 'error': '未配置翻译 API'})
 
         translated_pages = []
+        routes = []
+        batch_stats = {'calls': 0}
+        direction = 'en2zh' if target_lang == 'zh' else 'zh2en'
 
         if doc_type == 'ppt':
-            texts = metadata.get('texts', [])
+            texts = [[t for t in page_texts if t.get('text', '').strip()] for page_texts in document['texts']]
             all_translations = []
+            slide_trans = {}
+
+            # 全部幻灯片的文本按 token 预算跨页打包请求，再按顺序散回各页
+            translated_texts = translate_texts_batched(
+                [t['text'] for page_texts in texts for t in page_texts],
+                lambda text, references=None: translate_with_doubao(
+                    text, target_lang, api_key, endpoint_id, references
+                ),
+                separator='\n---\n',
+                stats=batch_stats,
+                direction=direction,
+                memory=direction
+            )
 
+            offset = 0
             for page_idx, page_texts in enumerate(texts):
-                original_texts = [t['text'] for t in page_texts if t.get('text', '').strip()]
-
-                if not original_texts:
-                    all_translations.append([])
-                    continue
-
-                combined_text = '\n---\n'.join(original_texts)
-                translated_combined = translate_with_doubao(combined_text, target_lang, api_key, endpoint_id)
-                translated_texts = translated_combined.split('\n---\n')
-
-                while len(translated_texts) < len(original_texts):
-                    translated_texts.append(original_texts[len(translated_texts)])
-
-                all_translations.append(translated_texts[:len(original_texts)])
-
-            # 生成翻译后的 PPT
+                all_translations.append(translated_texts[offset:offset + len(page_texts)])
+                offset += len(page_texts)
+                if page_texts:
+                    slide_trans[page_idx] = [
+                        {'loc': t.get('loc'), 'text': translated}
+                        for t, translated in zip(page_texts, all_translations[-1])
+                        if translated != t['text']  # 未改动的段落保留原有格式
+                    ]
+
+            # 一次写入全部页的译文，整份文档只转换一次
+            check_job_cancelled()
             source_path = os.path.join(upload_dir, 'source.pptx')
             translated_path = os.path.join(upload_dir, 'translated.pptx')
-            replace_ppt_texts(source_path, all_translations, translated_path)
-
-            # 生成预览图
             trans_dir = os.path.join(upload_dir, 'translated_images')
-            os.makedirs(trans_dir, exist_ok=True)
-            translated_pages = convert_ppt_to_images(translated_path, trans_dir)
+            with ppt_lock(translated_path):
+                replace_ppt_texts(source_path, slide_trans, translated_path)
+                translated_pages = convert_ppt_to_images(translated_path, trans_dir)
 
             # 保存翻译数据
-            with open(os.path.join(upload_dir, 'all_translations.json'), 'w', encoding='utf-8') as f:
-                json.dump(all_translations, f, ensure_ascii=False, indent=2)
+            save_state_file(os.path.join(upload_dir, 'all_translations.state'), all_translations)
 
         else:
-            # PDF: 逐页翻译
-            pages = metadata.get('pages', [])
+            # PDF: 逐页翻译，有文本层的页面不走视觉模型
+            pages = load_document_pages(document)
             all_translations = []
+            layout = load_layout_index(upload_dir)
+            text_first = translate_pages_text_first(
+                layout, range(len(pages)), direction, api_key, endpoint_id, document['content_hash'], batch_stats
+            )
 
             for page_idx, page_image in enumerate(pages):
-                result = translate_image_with_doubao(page_image, target_lang, api_key, endpoint_id)
+                if job_cancelled(current_job()):
+                    # 保留已完成页面的译文
+                    save_state_file(os.path.join(upload_dir, 'all_translations.state'), all_translations)
+                    raise JobCancelled()
+                trans_data, route = text_first[page_idx]
+                routes.append(dict(route, page=page_idx + 1))
+
+                if trans_data is not None:
+                    blocks = trans_data['blocks']
+                    all_translations.append({
+                        'page': page_idx + 1,
+                        'original_text': '\n'.join(b['original'] for b in blocks),
+                        'translated_text': '\n'.join(b['translated'] for b in blocks),
+                        'blocks': blocks,
+                        'page_width': trans_data['page_width'],
+                        'page_height': trans_data['page_height'],
+                        'route': 'text'
+                    })
+                    translated_pages.append(generate_precise_preview(
+                        page_image, blocks, trans_data['page_width'], trans_data['page_height']
+                    ))
+                    job_page_done(page_idx + 1)
+                    continue
+
+                vision_image = render_source_page(upload_dir, page_idx, 'vision') or page_image
+                result = translate_image_with_doubao(vision_image, target_lang, api_key, endpoint_id)
                 if result.get('success'):
                     all_translations.append({
                         'page': page_idx + 1,
                         'original_text': result.get('original_text', ''),
-                        'translated_text': result.get('translation', '')
+                        'translated_text': result.get('translation', ''),
+                        'route': 'vision'
                     })
+                    job_page_done(page_idx + 1)
                     translated_pages.append(page_image)  # PDF 暂返回原图
                 else:
-                    all_translations.append({'page': page_idx + 1, 'error': result.get('error')})
+                    all_translations.append({'page': page_idx + 1, 'error': result.get('error'), 'route': 'vision'})
                     translated_pages.append(page_image)
 
-            with open(os.path.join(upload_dir, 'all_translations.json'), 'w', encoding='utf-8') as f:
-                json.dump(all_translations, f, ensure_ascii=False, indent=2)
+            save_state_file(os.path.join(upload_dir, 'all_translations.state'), all_translations)
 
         return jsonify({
             'success': True,
             'pages': translated_pages,
-            'total': len(translated_pages)
+            'total': len(translated_pages),
+            'routes': routes,
+            'text_requests': batch_stats['calls'],
+            'skipped': batch_stats.get('skipped', {}),
+            'memory_reused': batch_stats.get('memory_reused', 0)
         })
 
     except Exception as e:
@@ -2344,17 +7023,14 @@ def doc_export():
         return jsonify({'success': False, 'error': '缺少 file_id'})
 
     upload_dir = os.path.join(TEMP_DIR, file_id)
-    metadata_path = os.path.join(upload_dir, 'metadata.json')
+    document = load_document(file_id)
 
-    if not os.path.exists(metadata_path):
+    if document is None:
         return jsonify({'success': False, 'error': '文件不存在'})
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-
-        doc_type = metadata.get('type', 'pdf')
-        original_filename = metadata.get('filename', 'document')
+        doc_type = document['type']
+        original_filename = document['filename']
         base_name = os.path.splitext(original_filename)[0]
 
         if doc_type == 'ppt':
@@ -2395,7 +7071,7 @@ def doc_export():
             width, height = A4
             c = canvas.Canvas(buffer, pagesize=A4)
 
-            pages = metadata.get('pages', [])
+            pages = load_document_pages(document)
 
             for i, page_data in enumerate(pages):
                 if page_data.startswith('data:image'):
@@ -2417,10 +7093,8 @@ def doc_export():
                 c.drawImage(ImageReader(img), x, y, width=new_width, height=new_height)
 
                 # 读取该页翻译结果并覆盖显示
-                trans_file = os.path.join(upload_dir, f'trans_page_{i+1}.json')
-                if os.path.exists(trans_file):
-                    with open(trans_file, 'r', encoding='utf-8') as f:
-                        trans_data = json.load(f)
+                trans_data = load_state_file(os.path.join(upload_dir, f'trans_page_{i+1}.state'))
+                if trans_data is not None:
                     # TODO: 根据位置信息覆盖翻译文本
                     translated_text = trans_data.get('translated_text', '')
                     if translated_text:
@@ -2448,6 +7122,270 @@ def doc_export():
         return jsonify({'success': False, 'error': str(e)})
 
 
+# ============ 词汇表增量重译 ============
+#
+# 已保存的文本层翻译块按原文建倒排索引 block_terms（英文按词、中日韩文字按相邻双字），随块
+# 写入/删除同步维护。词汇表增删改时记录变化的术语（原文与译文，修改时含旧值），重译接口据此
+# 经索引找出含这些术语、且翻译早于该次变化的块，只把这些段落重新发送翻译，再刷新所在页的
+# 预览；导出缓存按内容失效，之后的导出直接使用新译文。手动编辑过的译文不会被覆盖。
+
+TERM_WORD_RE = re.compile(r'[a-z0-9]+')
+TERM_CJK_RE = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+GLOSSARY_CHANGES_KEEP = 1000  # 保留的词汇表变更记录条数
+
+
+def text_term_tokens(text):
+    """原文的索引词：英文/数字按词（小写），中日韩文字按相邻双字（单字成段时取单字）"""
+    text = text.lower()
+    tokens = set(TERM_WORD_RE.findall(text))
+    for run in TERM_CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.add(run)
+        tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def is_retranslatable_block(block):
+    """文本层翻译块，且未被手动编辑、不是与词汇表无关的免译段落"""
+    return (bool(block.get('original')) and bool(block.get('bbox')) and not block.get('edited')
+            and block.get('skip') in (None, 'glossary'))
+
+
+def index_block_terms(conn, file_id, block_id, block):
+    if not block.get('original') or not block.get('bbox'):
+        return
+    conn.executemany(
+        'INSERT INTO block_terms (file_id, token, block_id) VALUES (?, ?, ?)',
+        [(file_id, token, block_id) for token in text_term_tokens(block['original'])]
+    )
+
+
+def ensure_block_terms(file_id):
+    """迁移前已翻译的文档补建倒排索引（每个文档一次）"""
+    conn = get_db()
+    row = conn.execute('SELECT terms_indexed FROM documents WHERE file_id = ?', (file_id,)).fetchone()
+    if row is None or row['terms_indexed']:
+        return
+
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM block_terms WHERE file_id = ?', (file_id,))
+        for r in conn.execute('SELECT id, data FROM blocks WHERE file_id = ?', (file_id,)).fetchall():
+            index_block_terms(conn, file_id, r['id'], decode_state(r['data']))
+        conn.execute('UPDATE documents SET terms_indexed = 1 WHERE file_id = ?', (file_id,))
+
+
+def term_candidate_blocks(conn, file_id, term):
+    """经倒排索引找出原文可能包含 term 的块 id；term 无可用索引词时返回 None（需逐块检查）"""
+    term = term.lower()
+    clauses = []
+    words = TERM_WORD_RE.findall(term)
+    for i, word in enumerate(words):
+        if i == len(words) - 1:
+            # 末词按前缀匹配（复数、词形变化）
+            clauses.append(('token >= ? AND token < ?', (word, word + '\uffff')))
+        else:
+            clauses.append(('token = ?', (word,)))
+    for run in TERM_CJK_RE.findall(term):
+        clauses.extend(('token = ?', (run[i:i + 2],)) for i in range(len(run) - 1))
+    if not clauses:
+        return None
+
+    candidates = None
+    for clause, params in clauses:
+        ids = {r[0] for r in conn.execute(
+            f'SELECT block_id FROM block_terms WHERE file_id = ? AND {clause}', (file_id,) + params)}
+        candidates = ids if candidates is None else candidates & ids
+        if not candidates:
+            break
+    return candidates
+
+
+def glossary_affected_blocks(file_id, terms=None):
+    """原文含指定术语的可重译块 [(block_id, page, block)]
+
+    terms 为空时使用词汇表变更记录，只返回所在页翻译早于该术语变化的块。
+    """
+    ensure_block_terms(file_id)
+    conn = get_db()
+    if terms is None:
+        wanted = [(r['term'], r['changed']) for r in conn.execute(
+            'SELECT term, MAX(changed) AS changed FROM glossary_changes GROUP BY term')]
+    else:
+        wanted = [(t, None) for t in terms]
+    updated = {r['page']: r['updated'] for r in conn.execute(
+        'SELECT page, updated FROM pages WHERE file_id = ?', (file_id,))}
+
+    matched = {}
+    for term, changed in wanted:
+        lowered = str(term).strip().lower()
+        if not lowered:
+            continue
+        candidates = term_candidate_blocks(conn, file_id, lowered)
+        if candidates is None:
+            rows = conn.execute('SELECT id, page, data FROM blocks WHERE file_id = ?', (file_id,)).fetchall()
+        else:
+            candidates = sorted(candidates - set(matched))
+            rows = []
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                rows.extend(conn.execute(
+                    f'SELECT id, page, data FROM blocks WHERE id IN ({",".join("?" * len(chunk))})', chunk))
+
+        for row in rows:
+            if row['id'] in matched or (changed is not None and updated.get(row['page'], 0) >= changed):
+                continue
+            block = decode_state(row['data'])
+            if is_retranslatable_block(block) and lowered in block['original'].lower():
+                matched[row['id']] = (row['page'], block)
+
+    return sorted(((block_id, page, block) for block_id, (page, block) in matched.items()),
+                  key=lambda item: (item[1], item[0]))
+
+
+def save_retranslated_blocks(file_id, updates, pending_pages=()):
+    """写回重译结果 {block_id: (translated, skip)}，返回涉及的页码
+
+    重译期间被删除或手动编辑的块跳过；pending_pages 中的页仍有段落重译失败，不更新翻译时间，
+    下次重译时会再次处理。
+    """
+    import time
+
+    versions = {}
+    with db_transaction() as conn:
+        now = time.time()
+        for block_id, (translated, skip) in updates.items():
+            row = conn.execute('SELECT page, data FROM blocks WHERE id = ? AND file_id = ?',
+                               (block_id, file_id)).fetchone()
+            if row is None:
+                continue
+            block = decode_state(row['data'])
+            if block.get('edited'):
+                continue
+            block['translated'] = translated
+            block.pop('failed', None)
+            if skip:
+                block['skip'] = skip
+            else:
+                block.pop('skip', None)
+            conn.execute('UPDATE blocks SET data = ? WHERE id = ?', (encode_state(block), block_id))
+            versions.setdefault(row['page'], None)
+
+        for page in versions:
+            version = conn.execute('SELECT version FROM pages WHERE file_id = ? AND page = ?',
+                                   (file_id, page)).fetchone()[0]
+            if page not in pending_pages:
+                conn.execute('UPDATE pages SET updated = ? WHERE file_id = ? AND page = ?', (now, file_id, page))
+            versions[page] = (version, bump_page_version(conn, file_id, page))
+
+    for page, (version, new_version) in versions.items():
+        update_page_grid(file_id, page, version, new_version)  # 只改译文，块位置不变
+    return sorted(versions)
+
+
+def record_glossary_change(*terms):
+    """记录变化的术语（原文/译文），供增量重译定位受影响的段落"""
+    import time
+
+    terms = sorted({t.strip() for t in terms if t and t.strip()})
+    if not terms:
+        return
+    with db_transaction() as conn:
+        now = time.time()
+        conn.executemany('INSERT INTO glossary_changes (term, changed) VALUES (?, ?)', [(t, now) for t in terms])
+        conn.execute('DELETE FROM glossary_changes WHERE seq <= (SELECT MAX(seq) FROM glossary_changes) - ?',
+                     (GLOSSARY_CHANGES_KEEP,))
+
+
+@app.route('/api/pdf/retranslate-glossary', methods=['POST'])
+@upstream_class('bulk')
+@translation_job('retranslate_glossary', 'en2zh')
+def pdf_retranslate_glossary():
+    """词汇表变化后增量重译：只重新翻译含变化术语的段落，返回受影响页的翻译块和预览
+
+    terms 可选，显式指定术语（例如直接修改了词汇表文件）；默认使用词汇表接口记录的变化。
+    """
+    data = request.get_json()
+    file_id = data.get('file_id', '')
+    direction = data.get('direction', 'en2zh')
+    terms = data.get('terms')
+
+    if not file_id:
+        return jsonify({'success': False, 'error': '缺少 file_id'})
+    if terms is not None and not isinstance(terms, list):
+        return jsonify({'success': False, 'error': 'terms 必须是列表'})
+
+    document = load_document(file_id)
+    if document is None:
+        return jsonify({'success': False, 'error': '文件不存在'})
+
+    try:
+        affected = glossary_affected_blocks(file_id, terms)
+        if not affected:
+            return jsonify({'success': True, 'segments': 0, 'failed': 0, 'pages': [], 'text_requests': 0})
+
+        config = read_config()
+        api_key = config.get('doubao_api_key')
+        endpoint_id = config.get('doubao_endpoint_id')
+        if not api_key or not endpoint_id:
+            return jsonify({'success': False, 'error': '未配置豆包 API，请在设置中配置'})
+
+        texts = [block['original'] for _, _, block in affected]
+        skips = classify_skip_segments(texts, direction)
+        stats = {'calls': 0}
+        failed_segments = set()
+        translated_texts = translate_texts_batched(
+            texts, text_translation_call(direction, api_key, endpoint_id), stats=stats, skips=skips,
+            failed=failed_segments
+        )
+
+        updates = {}
+        pending_pages = set()
+        for i, (block_id, page, block) in enumerate(affected):
+            translated = translated_texts[i].strip() if i < len(translated_texts) else ''
+            if i not in skips and (i in failed_segments or not translated):
+                pending_pages.add(page)
+                continue
+            updates[block_id] = (translated, skips.get(i))
+
+        changed_pages = save_retranslated_blocks(file_id, updates, pending_pages)
+        for page in changed_pages:
+            job_page_done(page)
+
+        page_images = load_document_pages(document)
+        pages = []
+        for page in changed_pages:
+            check_job_cancelled()
+            trans_data = load_page_translation(file_id, page)
+            preview = None
+            if trans_data and 0 < page <= len(page_images):
+                preview = generate_precise_preview(
+                    page_images[page - 1], trans_data['blocks'], trans_data['page_width'], trans_data['page_height']
+                )
+            pages.append({
+                'page': page,
+                'blocks': trans_data['blocks'] if trans_data else [],
+                'preview': preview,
+                'page_width': trans_data.get('page_width') if trans_data else None,
+                'page_height': trans_data.get('page_height') if trans_data else None
+            })
+
+        failed = len(affected) - len(updates)
+        print(f"Glossary retranslate {file_id}: {len(updates)} segments on {len(pages)} pages, "
+              f"{failed} failed, {stats['calls']} requests")
+        return jsonify({
+            'success': True,
+            'segments': len(updates),
+            'failed': failed,
+            'pages': pages,
+            'text_requests': stats['calls']
+        })
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)})
+
+
 # ============ 词汇表 API (SPEC-008) ============
 
 GLOSSARY_PATH = os.path.join(CONFIG_DIR, 'glossary.json')
@@ -2495,6 +7433,7 @@ def add_glossary_term():
     }
     data['glossary'].append(new_term)
     save_glossary(data)
+    record_glossary_change(source, target)
 
     return jsonify({'success': True, 'term': new_term})
 
@@ -2506,11 +7445,14 @@ def update_glossary_term(term_id):
 
     for term in data['glossary']:
         if term['id'] == term_id:
+            old_terms = (term['source'], term['target'])
             term['source'] = req.get('source', term['source'])
             term['target'] = req.get('target', term['target'])
             term['context'] = req.get('context', term.get('context', ''))
             term['note'] = req.get('note', term.get('note', ''))
             save_glossary(data)
+            if (term['source'], term['target']) != old_terms:
+                record_glossary_change(term['source'], term['target'], *old_terms)
             return jsonify({'success': True})
 
     return jsonify({'success': False, 'error': '词条不存在'})
@@ -2519,11 +7461,12 @@ def update_glossary_term(term_id):
 def delete_glossary_term(term_id):
     """删除词条"""
     data = load_glossary()
-    original_len = len(data['glossary'])
+    removed = [t for t in data['glossary'] if t['id'] == term_id]
     data['glossary'] = [t for t in data['glossary'] if t['id'] != term_id]
 
-    if len(data['glossary']) < original_len:
+    if removed:
         save_glossary(data)
+        record_glossary_change(removed[0]['source'], removed[0]['target'])
         return jsonify({'success': True})
 
     return jsonify({'success': False, 'error': '词条不存在'})
@@ -2552,6 +7495,10 @@ def open_glossary_file():
 # ============ 启动服务 ============
 
 if __name__ == '__main__':
+    # PyInstaller 打包后导出进程池需要
+    import multiprocessing
+    multiprocessing.freeze_support()
+
     # 支持 Render 的 PORT 环境变量
     port = int(os.environ.get('PORT', os.environ.get('FLASK_PORT', 2008)))
     host = os.environ.get('HOST', '0.0.0.0')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+幻灯片渲染延迟对比
+
+生成一份多页 PPTX，按单页依次渲染（与逐页翻译后的预览更新一致），比较每次启动
+soffice 与常驻进程池的每页渲染耗时。进程池需要 LibreOffice 的 UNO Python 绑定。
+
+用法:
+    python benchmarks/bench_ppt_render.py               # 8 页，每页渲染一次
+    python benchmarks/bench_ppt_render.py -s 20 -n 40 -m pool
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import app  # noqa: E402
+
+
+def make_deck(path, slides):
+    from pptx import Presentation
+
+    prs = Presentation()
+    for i in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f'Quarterly review {i + 1}'
+        slide.placeholders[1].text_frame.text = (
+            'Revenue grew 12.5% year over year.\nRetention improved across all regions.'
+        )
+    prs.save(path)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(pct / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def bench_mode(mode, binary, deck_path, slides, renders):
+    app.SOFFICE_POOL = mode == 'pool'
+    latencies = []
+    for i in range(renders):
+        start = time.perf_counter()
+        app.render_ppt_with_soffice(binary, deck_path, [i % slides])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print(f"{mode:<6} n={renders:<3} mean={sum(latencies) / len(latencies):8.1f}ms "
+          f"p50={percentile(latencies, 50):8.1f}ms p95={percentile(latencies, 95):8.1f}ms "
+          f"first={latencies[0]:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='幻灯片渲染延迟对比')
+    parser.add_argument('-s', '--slides', type=int, default=8)
+    parser.add_argument('-n', '--renders', type=int, help='渲染次数（默认等于页数）')
+    parser.add_argument('-m', '--modes', nargs='+', choices=['cold', 'pool'], default=['cold', 'pool'])
+    args = parser.parse_args()
+
+    binary = app.find_soffice()
+    if not binary:
+        print('未找到 LibreOffice (soffice)')
+        return
+    modes = args.modes
+    if 'pool' in modes and app.load_uno() is None:
+        print('当前 Python 环境没有 uno 模块，跳过进程池')
+        modes = [m for m in modes if m != 'pool']
+
+    with tempfile.TemporaryDirectory() as workdir:
+        deck_path = os.path.join(workdir, 'bench.pptx')
+        make_deck(deck_path, args.slides)
+        for mode in modes:
+            bench_mode(mode, binary, deck_path, args.slides, args.renders or args.slides)
+
+    if app._soffice_pool is not None:
+        app.shutdown_soffice_pool(app._soffice_pool)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+文档状态序列化耗时对比
+
+生成一份多页文档的翻译状态，比较旧版 metadata.json (indent=2) 与各状态编码的
+保存/读取耗时和体积，以及 SQLite 状态存储的整份写入、整份读取和单页读取耗时。
+
+用法:
+    python benchmarks/bench_serialization.py               # 120 页
+    python benchmarks/bench_serialization.py -p 300 -r 10
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import app  # noqa: E402
+
+ORIGINAL = ('Revenue grew 12.5% year over year, driven by strong demand in the '
+            'enterprise segment and improved retention across all regions. ')
+TRANSLATED = '受企业客户需求强劲以及各地区留存率提升的推动，营收同比增长 12.5%。'
+
+
+def make_page(page_num, blocks_per_page):
+    rnd = random.Random(page_num)
+    blocks = []
+    for i in range(blocks_per_page):
+        x0, y0 = rnd.uniform(40, 300), 60 + i * 28
+        bbox = [x0, y0, x0 + rnd.uniform(150, 250), y0 + 24]
+        blocks.append({
+            'original': ORIGINAL * rnd.randint(1, 3),
+            'translated': TRANSLATED * rnd.randint(1, 3),
+            'bbox': bbox,
+            'font_size': 11.0,
+            'font_sizes': [11.0, 11.0, 9.5],
+            'source_bboxes': [bbox, [bbox[0], bbox[1] + 12, bbox[2], bbox[3]]]
+        })
+    region_blocks = [
+        {'x': rnd.uniform(0, 80), 'y': rnd.uniform(0, 90), 'width': 15, 'height': 4, 'text': TRANSLATED}
+        for _ in range(3)
+    ]
+    return {
+        'page': page_num,
+        'blocks': blocks,
+        'region_blocks': region_blocks,
+        'page_width': 595.0,
+        'page_height': 842.0,
+        'route': 'text'
+    }
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def bench_files(translations, workdir, repeat):
+    metadata = {'filename': 'bench.pdf', 'total': len(translations), 'translations': translations}
+
+    legacy_path = os.path.join(workdir, 'metadata.json')
+
+    def save_legacy():
+        with open(legacy_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    def load_legacy():
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    save_ms, _ = timed(save_legacy, repeat)
+    load_ms, _ = timed(load_legacy, repeat)
+    print(f"{'json indent=2':<16} save={save_ms:8.1f}ms load={load_ms:8.1f}ms "
+          f"size={os.path.getsize(legacy_path) / 1024:8.1f}KB")
+
+    for codec in sorted(app.STATE_CODECS):
+        app.STATE_CODEC = codec
+        path = os.path.join(workdir, f'translations_{codec}.state')
+        save_ms, _ = timed(lambda: app.save_state_file(path, metadata), repeat)
+        load_ms, loaded = timed(lambda: app.load_state_file(path), repeat)
+        assert loaded == metadata
+        print(f"{codec:<16} save={save_ms:8.1f}ms load={load_ms:8.1f}ms "
+              f"size={os.path.getsize(path) / 1024:8.1f}KB")
+
+
+def bench_store(translations, workdir, repeat):
+    app.STATE_DB_PATH = os.path.join(workdir, 'state.db')
+    file_id = 'bench01'
+    app.create_document(file_id, 'pdf', 'bench.pdf', None, {'pages': list(translations), 'texts': []})
+
+    def save_all():
+        for page_key, trans_data in translations.items():
+            app.save_page_translation(file_id, int(page_key), trans_data)
+
+    save_ms, _ = timed(save_all, repeat)
+    load_ms, loaded = timed(lambda: app.load_translations(file_id), repeat)
+    page_ms, _ = timed(lambda: app.load_page_translation(file_id, len(translations) // 2), repeat * 10)
+    block = {'x': 10, 'y': 10, 'width': 12, 'height': 4, 'text': TRANSLATED}
+    edit_ms, _ = timed(lambda: app.add_region_block(file_id, 1, block), repeat * 10)
+    assert len(loaded) == len(translations)
+    print(f"{'sqlite ' + app.STATE_CODEC:<16} save={save_ms:8.1f}ms load={load_ms:8.1f}ms "
+          f"page={page_ms:6.2f}ms block_edit={edit_ms:6.2f}ms "
+          f"size={os.path.getsize(app.STATE_DB_PATH) / 1024:8.1f}KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文档状态序列化耗时对比')
+    parser.add_argument('-p', '--pages', type=int, default=120)
+    parser.add_argument('-b', '--blocks', type=int, default=25, help='每页文字块数')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    translations = {str(i): make_page(i, args.blocks) for i in range(1, args.pages + 1)}
+    print(f"{args.pages} 页，每页 {args.blocks} 个文字块，取 {args.repeat} 次最佳")
+
+    default_codec = app.STATE_CODEC
+    with tempfile.TemporaryDirectory() as workdir:
+        bench_files(translations, workdir, args.repeat)
+        app.STATE_CODEC = default_codec
+        bench_store(translations, workdir, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
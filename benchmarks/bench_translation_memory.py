@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+模糊翻译记忆查找耗时
+
+向临时状态库写入大量合成段落的翻译记忆，再用原样的段落（精确命中）、改动过一个词或数字的
+段落（近似命中）和全新段落（未命中）查询，输出每段的平均查找耗时与命中情况。段落按 -b 条一批
+调用 tm_lookup（翻译时按页/按批查询），每批耗时除以段数得到每段耗时。
+
+用法:
+    python benchmarks/bench_translation_memory.py               # 10 万条记忆，每批 40 段
+    python benchmarks/bench_translation_memory.py -s 1000000 -q 2000 -b 1
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import app  # noqa: E402
+
+SYLLABLES = 'ba be ci do fu ga he ki lo mu na ne pi ro su ta ve wi xo za ren tor mil dex'.split()
+WORDS = sorted({''.join(random.Random(i).choice(SYLLABLES) for _ in range(1 + i % 3)) for i in range(4000)})
+
+
+def make_segment(rnd):
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(6, 16))]
+    words.insert(rnd.randint(0, len(words)), str(rnd.randint(1, 999)))
+    return ' '.join(words).capitalize() + '.'
+
+
+def mutate(rnd, text):
+    """替换一个词，模拟修订后的段落"""
+    words = text.rstrip('.').split()
+    i = rnd.randrange(len(words))
+    if not words[i].isdigit():
+        words[i] = rnd.choice(WORDS)
+    return ' '.join(words) + '.'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(pct / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模糊翻译记忆查找耗时')
+    parser.add_argument('-s', '--segments', type=int, default=100000, help='记忆条数')
+    parser.add_argument('-q', '--queries', type=int, default=1000)
+    parser.add_argument('-b', '--batch', type=int, default=40, help='每次查询的段落数')
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    with tempfile.TemporaryDirectory() as workdir:
+        app.STATE_DB_PATH = os.path.join(workdir, 'state.db')
+        app.GLOSSARY_PATH = os.path.join(workdir, 'glossary.json')
+
+        sources = []
+        start = time.perf_counter()
+        for _ in range(0, args.segments, 5000):
+            batch = [make_segment(rnd) for _ in range(min(5000, args.segments - len(sources)))]
+            app.tm_add([(s, '译文 ' + s) for s in batch], 'en2zh')
+            sources.extend(batch)
+        print(f"写入 {len(sources)} 条: {time.perf_counter() - start:.1f}s, "
+              f"库大小 {os.path.getsize(app.STATE_DB_PATH) / 1024 / 1024:.1f}MB")
+
+        for label, queries in (
+            ('exact', [rnd.choice(sources) for _ in range(args.queries)]),
+            ('near', [mutate(rnd, rnd.choice(sources)) for _ in range(args.queries)]),
+            ('miss', [make_segment(random.Random(-i)) + ' novel' for i in range(args.queries)]),
+        ):
+            latencies = []  # 每段耗时（批耗时 / 段数）
+            hits = reused = 0
+            for start in range(0, len(queries), args.batch):
+                batch = queries[start:start + args.batch]
+                t0 = time.perf_counter()
+                matches = app.tm_lookup(batch, 'en2zh')
+                latencies.append((time.perf_counter() - t0) * 1000 / len(batch))
+                hits += len(matches)
+                reused += sum(match[3] for match in matches.values())
+            print(f"{label:<5} n={len(queries):<5} batch={args.batch:<3} "
+                  f"per-segment mean={sum(latencies) / len(latencies):6.3f}ms "
+                  f"p50={percentile(latencies, 50):6.3f}ms p95={percentile(latencies, 95):6.3f}ms "
+                  f"hits={hits} reused={reused}")
+
+
+if __name__ == '__main__':
+    main()
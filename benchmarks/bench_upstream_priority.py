@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+批量翻译期间的实时请求延迟
+
+用一个只能同时处理有限请求、每次耗时固定的模拟上游替换 urlopen，启动若干线程持续发出
+bulk 类请求（模拟全部翻译），同时按固定间隔发出 interactive 请求（模拟截图翻译），
+输出两类请求的端到端延迟。-f 选项把所有请求都当作同一类别，用于对比先到先得的排队。
+
+用法:
+    python benchmarks/bench_upstream_priority.py               # 8 个批量线程
+    python benchmarks/bench_upstream_priority.py -b 16 -n 40 -f
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import app  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def make_upstream(capacity, service_seconds):
+    """模拟上游：最多 capacity 个请求并行，多余的在服务端排队"""
+    gate = threading.Semaphore(capacity)
+    body = json.dumps({'choices': [{'message': {'content': 'ok'}}]}).encode('utf-8')
+
+    def urlopen(req, timeout=None):
+        with gate:
+            time.sleep(service_seconds)
+        return FakeResponse(body)
+    return urlopen
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(pct / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def report(label, latencies):
+    if not latencies:
+        print(f"{label:<12} n=0")
+        return
+    print(f"{label:<12} n={len(latencies):<5} mean={sum(latencies) / len(latencies):8.1f}ms "
+          f"p50={percentile(latencies, 50):8.1f}ms p95={percentile(latencies, 95):8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量翻译期间的实时请求延迟')
+    parser.add_argument('-b', '--bulk-threads', type=int, default=8)
+    parser.add_argument('-n', '--interactive', type=int, default=20, help='实时请求数')
+    parser.add_argument('-c', '--capacity', type=int, default=app.UPSTREAM_CONCURRENCY, help='上游并发能力')
+    parser.add_argument('-s', '--service-ms', type=float, default=50)
+    parser.add_argument('-f', '--fifo', action='store_true', help='所有请求同一类别（先到先得）')
+    args = parser.parse_args()
+
+    urllib.request.urlopen = make_upstream(args.capacity, args.service_ms / 1000)
+    bulk_class = 'interactive' if args.fifo else 'bulk'
+    stop = threading.Event()
+    bulk_latencies = []
+
+    def call(cls, latencies):
+        start = time.perf_counter()
+        app.upstream_class(cls)(lambda: app.upstream_json(urllib.request.Request('http://upstream'), timeout=5))()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    def bulk_worker():
+        while not stop.is_set():
+            call(bulk_class, bulk_latencies)
+
+    workers = [threading.Thread(target=bulk_worker, daemon=True) for _ in range(args.bulk_threads)]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.service_ms / 1000 * 4)
+
+    interactive_latencies = []
+    for _ in range(args.interactive):
+        call('interactive', interactive_latencies)
+        time.sleep(args.service_ms / 1000)
+
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    print(f"上游并发 {args.capacity}，调度并发 {app.UPSTREAM_CONCURRENCY}，"
+          f"{args.bulk_threads} 个批量线程，{'先到先得' if args.fifo else '优先级调度'}")
+    report('interactive', interactive_latencies)
+    report('bulk', bulk_latencies)
+
+
+if __name__ == '__main__':
+    main()
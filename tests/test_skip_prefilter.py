@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""免译预筛（classify_skip_segment）的回归用例"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import app  # noqa: E402
+
+# 要点列表、幻灯片中的普通文字：行尾分号、单个箭头/比较符都不能当作代码
+PROSE = [
+    'Revenue grew 10%;',
+    'Note: see below;',
+    'Costs;',
+    'Step 1;',
+    'Input -> Output',
+    'A == B only if the totals match',
+    'Input -> Process -> Output -> Review',
+    'Q1 -> Q2 -> Q3',
+    'Revenue = Price × Volume',
+    'Margin = 20%;',
+    'Cost <= Budget; Time >= Plan',
+    'Return on investment rose 5%;',
+    'From 2020 to 2023 sales doubled;',
+    'Import duties fell;',
+    'Let us review the plan;',
+    'Class A shares (voting)',
+    'Public sector (excluding defence);',
+    'See Appendix (page 4);',
+    'Use the save() button;',
+    'If (and only if) margins hold:',
+    'for each region in scope:',
+    'Q3(est) up 10% vs Q2(act)',
+    'Dear {name}, thank you',
+]
+
+CODE = [
+    'x = foo(bar);',
+    'x += 1;',
+    'items[i] = value;',
+    'result = compute(a, b)',
+    'console.log(value);',
+    'if (a == b) { return c; }',
+    'while (i < n) {',
+    'for i in range(10):',
+    'def main(args):',
+    'class Foo(Base):',
+    'int main() {',
+    'public static void main(String[] args) {',
+    'const total = 0;',
+    'let x = 5;',
+    'return x + 1;',
+    'import numpy as np',
+    'from os import path',
+    '#include <stdio.h>',
+    'std::vector<int> v;',
+    'a && b || c == d',
+    'i++; j--;',
+]
+
+
+@pytest.mark.parametrize('text', PROSE)
+def test_prose_is_translated(text):
+    assert app.classify_skip_segment(text, 'en2zh') is None
+
+
+@pytest.mark.parametrize('text', CODE)
+def test_code_is_skipped(text):
+    assert app.classify_skip_segment(text, 'en2zh') == 'code'